@@ -1,5 +1,21 @@
 from __future__ import absolute_import
 
-from .database import *
-from .filesystem import *
-from .retrieval import *
+import importlib
+
+#-- Subpackages whose public names are available from the top level.  They
+#-- are imported on first access rather than here, so that importing any
+#-- one module (e.g. for the database command line tools) does not also load
+#-- calcos, matplotlib and the monitors.
+_SUBPACKAGES = ['database', 'filesystem', 'retrieval']
+
+def __getattr__(name):
+    if name in _SUBPACKAGES:
+        return importlib.import_module('.' + name, __name__)
+
+    #-- Later subpackages take precedence, as they did with star imports
+    for subpackage in reversed(_SUBPACKAGES):
+        module = importlib.import_module('.' + subpackage, __name__)
+        if not name.startswith('_') and hasattr(module, name):
+            return getattr(module, name)
+
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
@@ -22,15 +22,10 @@ __all__ = ['X_UNBINNED',
            'FUVA_string',
            'FUVB_string',
            'MODAL_GAIN_LIMIT',
-           'TIMESTAMP']
+           'timestamp']
 
 import os
-import time
 from datetime import datetime
-import glob
-from astropy.io import fits
-import numpy as np
-import yaml
 
 X_UNBINNED = 16384
 Y_UNBINNED = 1024
@@ -59,5 +54,25 @@ FUVB_string = '_01_'
 
 MODAL_GAIN_LIMIT = 3
 
-date_time = str(datetime.now())
-TIMESTAMP = (date_time.split()[0]+'T'+date_time.split()[1] ).replace(':','-')
+_TIMESTAMP = None
+
+def timestamp():
+    """Time of the first call, formatted for use in file names
+
+    Fixed once set so all products of a single run share it.
+    """
+
+    global _TIMESTAMP
+
+    if _TIMESTAMP is None:
+        date_time = str(datetime.now())
+        _TIMESTAMP = (date_time.split()[0]+'T'+date_time.split()[1] ).replace(':','-')
+
+    return _TIMESTAMP
+
+def __getattr__(name):
+    #-- TIMESTAMP used to be computed at import, keep it available
+    if name == 'TIMESTAMP':
+        return timestamp()
+
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
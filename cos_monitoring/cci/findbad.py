@@ -10,26 +10,43 @@ __status__ = 'Active'
 
 import os
 import glob
+import time
 import logging
 logger = logging.getLogger(__name__)
 
 from astropy.io import fits
 import numpy as np
+import matplotlib as mpl
+mpl.use('Agg')
 import matplotlib.pyplot as plt
 from matplotlib.backends.backend_pdf import PdfPages
 import multiprocessing as mp
 from sqlalchemy.engine import create_engine
-from sqlalchemy import and_, distinct
+from sqlalchemy import and_, distinct, func, tuple_, inspect
 import scipy
 from scipy.optimize import leastsq, newton, curve_fit
 
-from .constants import Y_BINNING, X_BINNING
+from .constants import Y_BINNING, X_BINNING, XLEN, YLEN
+from ..utils import mjd_to_year
 from ..database.db_tables import open_settings, load_connection
-from ..database.db_tables import Flagged, GainTrends, Gain
+from ..database.db_tables import Flagged, GainTrends, GainJumps, Gain, TrendProgress
 
 #-------------------------------------------------------------------------------
 
-def time_trends(save_dir):
+def time_trends(save_dir, rebuild=False):
+    """Flag low gain superpixels and measure their degredation with time
+
+    Only superpixels with measurements added since the last run are
+    re-evaluated, unless rebuild is set.
+
+    Parameters
+    ----------
+    save_dir : str
+        directory to write the projection files to
+    rebuild : bool, optional
+        clear the flagged and gain_trends tables and evaluate everything
+    """
+
     logger.debug('Finding trends with time')
 
     for item in glob.glob(os.path.join(save_dir, 'cumulative_gainmap_*.png')):
@@ -40,22 +57,29 @@ def time_trends(save_dir):
     Session, engine = load_connection(settings['connection_string'])
     session = Session()
 
-    #-- Clean out previous results from flagged table
-    logger.debug("Deleting flagged table")
-    session.query(Flagged).delete()
+    #-- progress recorded before the checked_* columns can not tell which
+    #-- rows were committed late, start over from a full evaluation
+    inspector = inspect(engine)
+    if 'trend_progress' in inspector.get_table_names() and \
+            not 'checked_gain_id' in [column['name'] for column in inspector.get_columns('trend_progress')]:
+        logger.info("Recreating trend_progress table")
+        TrendProgress.__table__.drop(engine)
+        TrendProgress.__table__.create(engine)
 
-    #-- Clean out previous results from gain trends table
-    logger.debug("Deleting GainTrends table")
-    session.query(GainTrends).delete()
+    if rebuild:
+        #-- Clean out previous results from flagged table
+        logger.debug("Deleting flagged table")
+        session.query(Flagged).delete()
 
-    #-- Force commit.
-    session.commit()
-    session.close()
-    engine.dispose()
+        #-- Clean out previous results from gain trends table
+        logger.debug("Deleting GainTrends table")
+        session.query(GainTrends).delete()
 
+        session.query(GainJumps).delete()
+        session.query(TrendProgress).delete()
 
-    Session, engine = load_connection(settings['connection_string'])
-    session = Session()
+        #-- Force commit.
+        session.commit()
 
     pool = mp.Pool(processes=settings['num_cpu'])
     logger.debug("looking for segment/dethv combinations")
@@ -66,32 +90,19 @@ def time_trends(save_dir):
     session.close()
     engine.dispose()
 
-    logger.debug("finding bad pixels for all HV/Segments")
-    pool.map(find_flagged, all_combos)
-
-    logger.debug("Measuring gain degredation slopes")
-    pool.map(measure_slopes, all_combos)
-
+    logger.debug("finding bad pixels and degredation slopes for all HV/Segments")
+    evaluated = pool.map(update_trends, all_combos)
 
     settings = open_settings()
     Session, engine = load_connection(settings['connection_string'])
     session = Session()
-    #-- write projection files
-    for (segment, dethv) in all_combos:
-        results = session.query(GainTrends).filter(and_(GainTrends.segment==segment,
-                                                         GainTrends.dethv==dethv))
-
-        slope_image = np.zeros((1024, 16384))
-        intercept_image = np.zeros((1024, 16384))
-        bad_image = np.zeros((1024, 16384))
-
-        for row in results:
-            y = row.y * Y_BINNING
-            x = row.x * X_BINNING
-            slope_image[y:y+Y_BINNING, x:x+X_BINNING] = row.slope
-            intercept_image[y:y+Y_BINNING, x:x+X_BINNING] = row.intercept
+    #-- write projection files of the segment/HVs with new results
+    for (segment, dethv), coords in zip(all_combos, evaluated):
+        out_file = projection_file(save_dir, segment, dethv)
+        if coords == [] and os.path.exists(out_file):
+            continue
 
-            bad_image[y:y+Y_BINNING, x:x+X_BINNING] = row.mjd
+        slope_image, intercept_image, bad_image = projection_images(session, segment, dethv)
 
         if slope_image.any():
             logger.debug("Outputing projection files for {} {}".format(segment, dethv))
@@ -103,6 +114,182 @@ def time_trends(save_dir):
 
 #-------------------------------------------------------------------------------
 
+def update_trends(args):
+    segment, hvlevel = args
+
+    settings = open_settings()
+    Session, engine = load_connection(settings['connection_string'])
+
+    session = Session()
+
+    coords = update_superpixel_trends(session, segment, hvlevel)
+
+    session.close()
+    engine.dispose()
+
+    return coords
+
+#-------------------------------------------------------------------------------
+
+#-- seconds the ids below the highest one scanned must stay unchanged before
+#-- they are taken as committed.  Ingest transactions (pipeline batches, queue
+#-- workers) are far shorter, but can commit their rows out of id order.
+SETTLE_TIME = 24 * 3600
+
+def update_superpixel_trends(session, segment, hvlevel, settle=SETTLE_TIME):
+    """Bring the flagged and gain_trends rows of segment and hvlevel up to date
+
+    Progress is kept in the trend_progress table.  Gain rows up to
+    last_gain_id have been evaluated and are settled.  Rows up to
+    checked_gain_id have been evaluated too, but a concurrent ingest may
+    still commit rows with lower ids there, so the number of rows in that
+    window is recounted every run.  If it changed, every superpixel in the
+    window is evaluated again; once it has stayed the same for settle
+    seconds, last_gain_id moves up to checked_gain_id.
+
+    Superpixels measured by new rows have their flagged and gain_trends
+    rows replaced, the rest are left as they are, and the gain_jumps rows
+    are rescanned from the earliest new measurement on.  Without recorded
+    progress every superpixel is evaluated.
+
+    Parameters
+    ----------
+    session : session object
+        database session
+    segment : str
+        FUVA or FUVB
+    hvlevel : int
+        DETHV of the gainmaps
+    settle : float, optional
+        seconds before the scanned window is taken as committed
+
+    Returns
+    -------
+    coords : list or None
+        (x, y) of the superpixels evaluated, None if all were
+    """
+
+    now = time.time()
+    progress = session.query(TrendProgress).filter(and_(TrendProgress.segment==segment,
+                                                        TrendProgress.dethv==hvlevel)).first()
+
+    if progress is None:
+        last_id, n_rows = session.query(func.max(Gain.id), func.count(Gain.id)).\
+                                  filter(and_(Gain.segment==segment,
+                                              Gain.dethv==hvlevel)).one()
+        progress = TrendProgress(segment=segment, dethv=hvlevel, last_gain_id=0,
+                                 checked_gain_id=last_id or 0, checked_rows=n_rows, checked_at=now)
+        session.add(progress)
+        coords = None
+        start_mjd = None
+
+        for table in (Flagged, GainTrends, GainJumps):
+            session.query(table).filter(and_(table.segment==segment,
+                                             table.dethv==hvlevel)).delete(synchronize_session=False)
+    else:
+        n_window = session.query(func.count(Gain.id)).\
+                           filter(and_(Gain.segment==segment,
+                                       Gain.dethv==hvlevel,
+                                       Gain.id>progress.last_gain_id,
+                                       Gain.id<=progress.checked_gain_id)).scalar()
+
+        late = n_window != progress.checked_rows
+        if late:
+            logger.info("{}, {}: {} rows committed below id {} since the last run".format(segment,
+                                                                                         hvlevel,
+                                                                                         n_window - progress.checked_rows,
+                                                                                         progress.checked_gain_id))
+            since = progress.last_gain_id
+        elif now - progress.checked_at >= settle:
+            progress.last_gain_id = progress.checked_gain_id
+            since = progress.last_gain_id
+            n_window = 0
+        else:
+            since = progress.checked_gain_id
+
+        #-- rows after since, the late ones included, with the newest id and
+        #-- the earliest date of each superpixel
+        new_rows = session.query(Gain.x, Gain.y, func.max(Gain.id), func.min(Gain.expstart), func.count(Gain.id)).\
+                           filter(and_(Gain.segment==segment,
+                                       Gain.dethv==hvlevel,
+                                       Gain.id>since)).\
+                           group_by(Gain.x, Gain.y).all()
+
+        if not new_rows:
+            logger.debug("{}, {}: no new measurements".format(segment, hvlevel))
+            progress.checked_rows = n_window
+            session.commit()
+            return []
+
+        last_id = max(row[2] for row in new_rows)
+        n_rows = sum(row[4] for row in new_rows)
+        dates = [row[3] for row in new_rows if row[3] is not None]
+        start_mjd = min(dates) if dates else None
+        coords = [(x, y) for x, y, row_id, mjd, count in new_rows
+                  if x is not None and y is not None and 400//Y_BINNING <= y <= 600//Y_BINNING]
+
+        #-- the late rows were read again, the others are still in the window
+        progress.checked_rows = n_rows if late else n_window + n_rows
+        progress.checked_gain_id = max(last_id, progress.checked_gain_id)
+        progress.checked_at = now
+
+        #-- flag_superpixels updates the flagged rows itself
+        for chunk in _chunks(coords):
+            session.query(GainTrends).filter(and_(GainTrends.segment==segment,
+                                                  GainTrends.dethv==hvlevel,
+                                                  tuple_(GainTrends.x, GainTrends.y).in_(chunk))).delete(synchronize_session=False)
+
+    logger.debug("{}, {}: evaluating {} superpixels".format(segment,
+                                                           hvlevel,
+                                                           'all' if coords is None else len(coords)))
+
+    flag_superpixels(session, segment, hvlevel, coords, start_mjd)
+    slope_superpixels(session, segment, hvlevel, coords)
+    scan_gain_jumps(session, segment, hvlevel, start_mjd)
+
+    session.commit()
+
+    return coords
+
+#-------------------------------------------------------------------------------
+
+def _chunks(coords, chunk_size=500):
+    for i in range(0, len(coords), chunk_size):
+        yield coords[i:i + chunk_size]
+
+#-------------------------------------------------------------------------------
+
+def _coordinate_query(query, table, coords):
+    """Run query over the coords, chunk by chunk, or all rows if coords is None"""
+
+    if coords is None:
+        return query.all()
+
+    results = []
+    for chunk in _chunks(coords):
+        results += query.filter(tuple_(table.x, table.y).in_(chunk)).all()
+
+    return results
+
+#-------------------------------------------------------------------------------
+
+def _gain_dates(start_mjd=None):
+    """Condition on the dates of the gain rows to read, from start_mjd on
+
+    Nothing bad happened before 2010, and some of the early gainmaps are
+    odd, so those are always left out.  The year condition lets a table
+    partitioned by year be read only from the partition of start_mjd on.
+    """
+
+    if start_mjd is None:
+        return and_(Gain.year>=2010, Gain.expstart>55197)
+
+    return and_(Gain.year>=max(2010, mjd_to_year(start_mjd)),
+                Gain.expstart>55197,
+                Gain.expstart>=start_mjd)
+
+#-------------------------------------------------------------------------------
+
 def find_flagged(args):
     segment, hvlevel = args
 
@@ -111,58 +298,97 @@ def find_flagged(args):
 
     session = Session()
 
-    all_coords = [(row.x, row.y) for row in session.query(Gain.x, Gain.y).distinct(Gain.x, Gain.y).filter(and_(Gain.segment==segment,
-                                                                                                     Gain.dethv==hvlevel,
-                                                                                                     Gain.gain<=3,
-                                                                                                     Gain.counts>=30))]
+    n_flagged = flag_superpixels(session, segment, hvlevel)
     logger.debug("{}, {}: found {} superpixels below 3.".format(segment,
                                                          hvlevel,
-                                                         len(all_coords)))
+                                                         n_flagged))
 
+    session.close()
+    engine.dispose()
+
+#-------------------------------------------------------------------------------
 
-    for x, y in all_coords:
+def flag_superpixels(session, segment, hvlevel, coords=None, start_mjd=None):
+    """Flag every superpixel of segment and hvlevel whose gain fell to 3
 
-        #--filter above and below possible spectral locations
-        if (y > 600//Y_BINNING) or (y < 400//Y_BINNING):
-            continue
+    The first MJD with gain <= 3 of every superpixel in the possible
+    spectral locations is found with a single grouped query, counting only
+    superpixels where at least one such measurement had >= 30 counts.  The
+    Flagged rows are written with one bulk insert.
 
-        #-- Nothing bad before 2010,
-        #-- and there are some weird gainmaps back there
-        #-- filtering out for now.
-        results = session.query(Gain).filter(and_(Gain.segment==segment,
-                                                  Gain.dethv==hvlevel,
-                                                  Gain.x==x,
-                                                  Gain.y==y,
-                                                  Gain.expstart>55197))
-
-        all_gain = []
-        all_counts = []
-        all_std = []
-        all_expstart = []
-        for row in results:
-            all_gain.append(row.gain)
-            all_counts.append(row.counts)
-            all_std.append(row.std)
-            all_expstart.append(row.expstart)
-
-        all_gain = np.array(all_gain)
-        all_expstart = np.array(all_expstart)
-
-        below_thresh = np.where(all_gain <= 3)[0]
-
-        if len(below_thresh):
-            MJD_bad = all_expstart[below_thresh].min()
-
-            MJD_bad = round(MJD_bad, 5)
-            session.add(Flagged(mjd=MJD_bad,
-                                segment=segment,
-                                dethv=hvlevel,
-                                x=x,
-                                y=y))
+    With start_mjd, only the measurements from then on are read and the
+    flagged rows of the coords are updated: a flagged superpixel keeps the
+    earlier of its two dates, and the whole history is read only for the
+    superpixels flagged for the first time.
 
+    Parameters
+    ----------
+    session : session object
+        database session
+    segment : str
+        FUVA or FUVB
+    hvlevel : int
+        DETHV of the gainmaps
+    coords : list, optional
+        (x, y) of the superpixels to evaluate, all by default
+    start_mjd : float, optional
+        earliest new measurement of the coords
+
+    Returns
+    -------
+    n_flagged : int
+        number of superpixels flagged or updated
+    """
+
+    #--filter above and below possible spectral locations
+    query = session.query(Gain.x, Gain.y, func.min(Gain.expstart).label('mjd'), func.max(Gain.counts).label('counts')).\
+                    filter(and_(Gain.segment==segment,
+                                Gain.dethv==hvlevel,
+                                Gain.gain<=3,
+                                Gain.y>=400//Y_BINNING,
+                                Gain.y<=600//Y_BINNING)).\
+                    group_by(Gain.x, Gain.y)
+
+    full_history = query.filter(_gain_dates()).having(func.max(Gain.counts)>=30)
+
+    if coords is None or start_mjd is None:
+        flagged = {(row.x, row.y): row.mjd for row in _coordinate_query(full_history, Gain, coords)}
+        replaced = coords or []
+    else:
+        old = _coordinate_query(session.query(Flagged.x, Flagged.y, Flagged.mjd).\
+                                        filter(and_(Flagged.segment==segment,
+                                                    Flagged.dethv==hvlevel)), Flagged, coords)
+        old = {(row.x, row.y): row.mjd for row in old}
+
+        flagged = {}
+        first_flags = []
+        for row in _coordinate_query(query.filter(_gain_dates(start_mjd)), Gain, coords):
+            if (row.x, row.y) in old:
+                flagged[(row.x, row.y)] = min(old[(row.x, row.y)], row.mjd)
+            elif row.counts is not None and row.counts >= 30:
+                first_flags.append((row.x, row.y))
+
+        #-- earlier measurements of low gain, but too few counts, count too
+        if first_flags:
+            flagged.update({(row.x, row.y): row.mjd for row in _coordinate_query(full_history, Gain, first_flags)})
+
+        replaced = [key for key in flagged if key in old]
+
+    for chunk in _chunks(replaced):
+        session.query(Flagged).filter(and_(Flagged.segment==segment,
+                                           Flagged.dethv==hvlevel,
+                                           tuple_(Flagged.x, Flagged.y).in_(chunk))).delete(synchronize_session=False)
+
+    rows = [{'mjd': round(mjd, 5),
+             'segment': segment,
+             'dethv': hvlevel,
+             'x': x,
+             'y': y} for (x, y), mjd in flagged.items()]
+
+    session.bulk_insert_mappings(Flagged, rows)
     session.commit()
-    session.close()
-    engine.dispose()
+
+    return len(rows)
 
 #-------------------------------------------------------------------------------
 
@@ -174,74 +400,154 @@ def measure_slopes(args):
 
     session = Session()
 
-
     logger.debug("{}, {}: Measuring gain degredation slopes.".format(segment, hvlevel))
 
-    all_coords = [(row.x, row.y) for row in session.query(Gain.x, Gain.y).distinct(Gain.x, Gain.y).filter(and_(Gain.segment==segment,
-                                                                                                               Gain.dethv==hvlevel))]
+    n_trends = slope_superpixels(session, segment, hvlevel)
+    logger.debug("{}, {}: measured {} slopes.".format(segment, hvlevel, n_trends))
 
-    for x, y in all_coords:
+    session.close()
+    engine.dispose()
 
-        #--filter above and below possible spectral locations
-        if (y > 600//Y_BINNING) or (y < 400//Y_BINNING):
-            continue
+#-------------------------------------------------------------------------------
 
-        #-- Nothing bad before 2010,
-        #-- and there are some weird gainmaps back there
-        #-- filtering out for now.
-        results = session.query(Gain).filter(and_(Gain.segment==segment,
-                                                  Gain.dethv==hvlevel,
-                                                  Gain.x==x,
-                                                  Gain.y==y,
-                                                  Gain.gain>0,
-                                                  Gain.expstart>55197))
-
-        all_gain = []
-        all_counts = []
-        all_expstart = []
-        for row in results:
-            all_gain.append(row.gain)
-            all_counts.append(row.counts)
-            all_expstart.append(row.expstart)
-
-        all_gain = np.array(all_gain)
-        all_expstart = np.array(all_expstart)
-
-        if not len(all_gain) > 5:
-            continue
+def slope_superpixels(session, segment, hvlevel, coords=None):
+    """Measure the gain degredation of every superpixel of segment and hvlevel
 
-        sorted_index = all_gain.argsort()
-        all_gain = all_gain[sorted_index]
-        all_expstart = all_expstart[sorted_index]
+    The measurements of all superpixels in the possible spectral locations
+    are read with one query and fit at once by fit_slopes.  The GainTrends
+    rows are written with one bulk insert.
 
+    Parameters
+    ----------
+    session : session object
+        database session
+    segment : str
+        FUVA or FUVB
+    hvlevel : int
+        DETHV of the gainmaps
+    coords : list, optional
+        (x, y) of the superpixels to evaluate, all by default
 
-        fit, parameters, success = time_fitting(all_expstart, all_gain)
+    Returns
+    -------
+    n_trends : int
+        number of superpixels with a measured slope
+    """
 
-        if success:
-            intercept = parameters[1]
-            slope = parameters[0]
+    #-- the fit needs every measurement of a superpixel
+    #--filter above and below possible spectral locations
+    results = session.query(Gain.x, Gain.y, Gain.expstart, Gain.gain).\
+                      filter(and_(Gain.segment==segment,
+                                  Gain.dethv==hvlevel,
+                                  Gain.gain>0,
+                                  _gain_dates(),
+                                  Gain.y>=400//Y_BINNING,
+                                  Gain.y<=600//Y_BINNING))
+
+    results = _coordinate_query(results, Gain, coords)
+
+    if not len(results):
+        return 0
+
+    x, y, expstart, gain = (np.array(column, dtype=np.float64) for column in zip(*results))
+
+    trends = fit_slopes(x.astype(int), y.astype(int), expstart, gain)
+
+    rows = [{'mjd': round(mjd, 5),
+             'segment': segment,
+             'dethv': hvlevel,
+             'x': x,
+             'y': y,
+             'slope': round(slope, 5),
+             'intercept': round(intercept, 5)} for x, y, slope, intercept, mjd in zip(trends['x'].tolist(),
+                                                                                       trends['y'].tolist(),
+                                                                                       trends['slope'].tolist(),
+                                                                                       trends['intercept'].tolist(),
+                                                                                       trends['mjd'].tolist())]
+
+    session.bulk_insert_mappings(GainTrends, rows)
+    session.commit()
 
-            f = lambda x, a, b: a * x + b - 3
-            fprime = lambda x, a, b: a
+    return len(rows)
 
-            try:
-                date_bad = newton(f, all_gain[-1], fprime, args=tuple(parameters), tol=1e-5, maxiter=1000)
-            except RuntimeError:
-                date_bad = 0
+#-------------------------------------------------------------------------------
 
+def _grouped_line(group, n_groups, x_fit, y_fit, weight):
+    """Least-squares line through the weighted points of every group
 
-            session.add(GainTrends(mjd=round(date_bad, 5),
-                                   segment=segment,
-                                   dethv=hvlevel,
-                                   x=x,
-                                   y=y,
-                                   slope=round(slope, 5),
-                                   intercept=round(intercept, 5)))
+    Sums are taken about the mean of each group to keep precision with
+    MJD-sized x values.
+    """
 
-            session.commit()
+    n = np.bincount(group, weight, n_groups)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean_x = np.bincount(group, weight * x_fit, n_groups) / n
+        mean_y = np.bincount(group, weight * y_fit, n_groups) / n
 
-    session.close()
-    engine.dispose()
+        dx = x_fit - mean_x[group]
+        sxx = np.bincount(group, weight * dx * dx, n_groups)
+        sxy = np.bincount(group, weight * dx * y_fit, n_groups)
+
+        slope = np.where(sxx > 0, sxy / sxx, 0)
+
+    intercept = mean_y - slope * mean_x
+
+    return slope, intercept, n, sxx
+
+#-------------------------------------------------------------------------------
+
+def fit_slopes(x, y, expstart, gain, min_points=6, clip=1.5, min_kept=4):
+    """Fit a line to the gain with time of every superpixel at once
+
+    The same fit as time_fitting, for ragged per-superpixel arrays: a
+    first fit, removal of points further than clip times the spread of
+    the fitted values, and a refit of the rest.  Superpixels with fewer
+    than min_points measurements, or fewer than min_kept left after
+    clipping, are not fit.
+
+    Parameters
+    ----------
+    x, y : np.ndarray
+        superpixel coordinates of each measurement
+    expstart : np.ndarray
+        MJD of each measurement
+    gain : np.ndarray
+        measured gain
+
+    Returns
+    -------
+    trends : dict
+        x, y, slope, intercept and mjd arrays of every fit superpixel,
+        mjd being the date the line reaches a gain of 3 (0 for a flat
+        line)
+    """
+
+    pixel = np.asarray(y, dtype=np.int64) * XLEN + np.asarray(x, dtype=np.int64)
+    pixels, group = np.unique(pixel, return_inverse=True)
+    n_groups = len(pixels)
+
+    expstart = np.asarray(expstart, dtype=np.float64)
+    gain = np.asarray(gain, dtype=np.float64)
+
+    slope, intercept, n, sxx = _grouped_line(group, n_groups, expstart, gain, np.ones(len(gain)))
+
+    #-- spread of the fitted values, |slope| times the spread of the dates
+    fit_sigma = np.abs(slope) * np.sqrt(sxx / n)
+    residual = np.abs(slope[group] * expstart + intercept[group] - gain)
+    keep = (residual < clip * fit_sigma[group]).astype(np.float64)
+
+    slope, intercept, n_kept, sxx = _grouped_line(group, n_groups, expstart, gain, keep)
+
+    success = (n >= min_points) & (n_kept >= min_kept)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mjd = np.where(slope != 0, (3 - intercept) / slope, 0)
+
+    return {'x': (pixels % XLEN)[success],
+            'y': (pixels // XLEN)[success],
+            'slope': slope[success],
+            'intercept': intercept[success],
+            'mjd': mjd[success]}
 
 #-------------------------------------------------------------------------------
 
@@ -264,29 +570,179 @@ def check_rapid_changes(x_values, y_values):
 
     """
 
-    gain_thresh = 5
+    zeros = np.zeros(len(x_values), dtype=int)
+    jumps = find_jumps(zeros, zeros, x_values, y_values)
+
+    return jumps['mjd'].tolist()
+
+#-------------------------------------------------------------------------------
+
+def find_jumps(x, y, expstart, gain, gain_thresh=5, mjd_thresh=28):
+    """Find rapid gain changes of every superpixel at once
+
+    Measurements are sorted by superpixel and time, and each is compared
+    to the previous measurement of the same superpixel.  Changes of more
+    than gain_thresh PHA within mjd_thresh days are returned.
+
+    Parameters
+    ----------
+    x, y : np.ndarray
+        superpixel coordinates of each measurement
+    expstart : np.ndarray
+        MJD of each measurement
+    gain : np.ndarray
+        measured gain
+
+    Returns
+    -------
+    jumps : dict
+        x, y, mjd, previous_mjd and gain_change arrays of every jump, mjd
+        being the date of the measurement after the jump
+    """
+
+    x = np.asarray(x)
+    y = np.asarray(y)
+    expstart = np.asarray(expstart, dtype=np.float64)
+    gain = np.asarray(gain, dtype=np.float64)
+
+    order = np.lexsort((expstart, x, y))
+    x, y, expstart, gain = x[order], y[order], expstart[order], gain[order]
+
+    same_pixel = (x[1:] == x[:-1]) & (y[1:] == y[:-1])
+    gain_change = gain[1:] - gain[:-1]
+    jump = same_pixel & (np.abs(gain_change) > gain_thresh) & (expstart[1:] - expstart[:-1] < mjd_thresh)
+
+    index = np.where(jump)[0]
+
+    return {'x': x[index + 1],
+            'y': y[index + 1],
+            'mjd': expstart[index + 1],
+            'previous_mjd': expstart[index],
+            'gain_change': gain_change[index]}
+
+#-------------------------------------------------------------------------------
+
+def scan_gain_jumps(session, segment, hvlevel, start_mjd=None):
+    """Record the rapid gain changes of every superpixel of segment and hvlevel
+
+    All measurements from 28 days before start_mjd on are read with one
+    query and scanned by find_jumps.  That window holds the previous
+    measurement of any jump at or after start_mjd, so the gain_jumps rows
+    from start_mjd on are replaced and earlier ones are left as they are.
+
+    Parameters
+    ----------
+    session : session object
+        database session
+    segment : str
+        FUVA or FUVB
+    hvlevel : int
+        DETHV of the gainmaps
+    start_mjd : float, optional
+        earliest date to rescan, everything by default
+
+    Returns
+    -------
+    n_jumps : int
+        number of jumps found
+    """
+
     mjd_thresh = 28
-    #Set initial values at ridiculous numbers
-    previous_gain = y_values[0]
-    previous_mjd = x_values[0]
 
-    jumps = []
-    for gain, mjd in zip(y_values, x_values):
-        gain_diff = np.abs(previous_gain - gain)
-        mjd_diff = np.abs(previous_mjd - mjd)
-        if (gain_diff > gain_thresh) and (mjd_diff < mjd_thresh):
-            jumps.append(mjd)
+    old_jumps = session.query(GainJumps).filter(and_(GainJumps.segment==segment,
+                                                     GainJumps.dethv==hvlevel))
+    results = session.query(Gain.x, Gain.y, Gain.expstart, Gain.gain).\
+                      filter(and_(Gain.segment==segment,
+                                  Gain.dethv==hvlevel,
+                                  Gain.gain>0))
+
+    if start_mjd is not None:
+        old_jumps = old_jumps.filter(GainJumps.mjd>=round(start_mjd, 5))
+        results = results.filter(_gain_dates(start_mjd - mjd_thresh))
+    else:
+        results = results.filter(_gain_dates())
+
+    old_jumps.delete(synchronize_session=False)
+    results = results.all()
+
+    if not len(results):
+        session.commit()
+        return 0
+
+    x, y, expstart, gain = (np.array(column, dtype=np.float64) for column in zip(*results))
+
+    jumps = find_jumps(x.astype(int), y.astype(int), expstart, gain, mjd_thresh=mjd_thresh)
+
+    if start_mjd is not None:
+        new = np.round(jumps['mjd'], 5) >= round(start_mjd, 5)
+        jumps = {key: value[new] for key, value in jumps.items()}
+
+    rows = [{'mjd': round(mjd, 5),
+             'previous_mjd': round(previous_mjd, 5),
+             'gain_change': round(gain_change, 3),
+             'segment': segment,
+             'dethv': hvlevel,
+             'x': x,
+             'y': y} for x, y, mjd, previous_mjd, gain_change in zip(jumps['x'].tolist(),
+                                                                     jumps['y'].tolist(),
+                                                                     jumps['mjd'].tolist(),
+                                                                     jumps['previous_mjd'].tolist(),
+                                                                     jumps['gain_change'].tolist())]
+
+    session.bulk_insert_mappings(GainJumps, rows)
+    session.commit()
+
+    return len(rows)
 
-        previous_gain = gain
-        previous_mjd = mjd
+#-------------------------------------------------------------------------------
 
-    return jumps
+def projection_images(session, segment, dethv):
+    """Binned slope, intercept and projected bad date images of a segment/HV
+
+    Parameters
+    ----------
+    session : session object
+        database session
+    segment : str
+        FUVA or FUVB
+    dethv : int
+        DETHV of the gainmaps
+
+    Returns
+    -------
+    slope_image, intercept_image, bad_image : np.ndarray
+        float32 images at the binned (YLEN, XLEN) resolution of the gainmaps
+    """
+
+    results = session.query(GainTrends.x,
+                            GainTrends.y,
+                            GainTrends.slope,
+                            GainTrends.intercept,
+                            GainTrends.mjd).filter(and_(GainTrends.segment==segment,
+                                                        GainTrends.dethv==dethv)).all()
+
+    images = [np.zeros((YLEN, XLEN), dtype=np.float32) for i in range(3)]
+
+    if len(results):
+        x, y, slope, intercept, mjd = (np.array(column) for column in zip(*results))
+        for image, values in zip(images, (slope, intercept, mjd)):
+            image[y.astype(int), x.astype(int)] = values
+
+    return images
+
+#-------------------------------------------------------------------------------
+
+def projection_file(out_dir, segment, dethv):
+    return os.path.join(out_dir, 'proj_bad_{}_{}.fits'.format(segment, dethv))
 
 #-------------------------------------------------------------------------------
 
 def write_projection(out_dir, slope_image, intercept_image, bad_image, segment, dethv):
     """Writs a fits file with information useful for post-monitoring analysis.
 
+    The images are written at the binned resolution of the gainmaps, with
+    the binning in the XBINNING and YBINNING keywords.
+
     Parameters
     ----------
     slope_image : np.ndarray
@@ -310,29 +766,35 @@ def write_projection(out_dir, slope_image, intercept_image, bad_image, segment,
     """
 
     hdu_out = fits.HDUList(fits.PrimaryHDU())
-    hdu_out[0].header.update('TELESCOP', 'HST')
-    hdu_out[0].header.update('INSTRUME', 'COS')
-    hdu_out[0].header.update('DETECTOR', 'FUV')
-    hdu_out[0].header.update('OPT_ELEM', 'ANY')
-    hdu_out[0].header.update('Fsave_dirILETYPE', 'PROJ_BAD')
-    hdu_out[0].header.update('DETHV', dethv)
+    hdu_out[0].header['TELESCOP'] = 'HST'
+    hdu_out[0].header['INSTRUME'] = 'COS'
+    hdu_out[0].header['DETECTOR'] = 'FUV'
+    hdu_out[0].header['OPT_ELEM'] = 'ANY'
+    hdu_out[0].header['FILETYPE'] = 'PROJ_BAD'
+    hdu_out[0].header['DETHV'] = dethv
+    hdu_out[0].header['XBINNING'] = X_BINNING
+    hdu_out[0].header['YBINNING'] = Y_BINNING
 
-    hdu_out[0].header.update('SEGMENT', segment)
+    hdu_out[0].header['SEGMENT'] = segment
 
     #---Ext 1
-    hdu_out.append(fits.ImageHDU(data=bad_image))
-    hdu_out[1].header.update('EXTNAME', 'PROJBAD')
+    hdu_out.append(fits.ImageHDU(data=np.asarray(bad_image, dtype=np.float32)))
+    hdu_out[1].header['EXTNAME'] = 'PROJBAD'
 
     #---Ext 2
-    hdu_out.append(fits.ImageHDU(data=slope_image))
-    hdu_out[2].header.update('EXTNAME', 'SLOPE')
+    hdu_out.append(fits.ImageHDU(data=np.asarray(slope_image, dtype=np.float32)))
+    hdu_out[2].header['EXTNAME'] = 'SLOPE'
 
     #---Ext 3
-    hdu_out.append(fits.ImageHDU(data=intercept_image))
-    hdu_out[3].header.update('EXTNAME', 'INTERCEPT')
+    hdu_out.append(fits.ImageHDU(data=np.asarray(intercept_image, dtype=np.float32)))
+    hdu_out[3].header['EXTNAME'] = 'INTERCEPT'
+
+    for ext in hdu_out[1:]:
+        ext.header['XBINNING'] = X_BINNING
+        ext.header['YBINNING'] = Y_BINNING
 
     #---Writeout
-    hdu_out.writeto(os.path.join(out_dir, 'proj_bad_{}_{}.fits'.format(segment, dethv)) ,clobber=True)
+    hdu_out.writeto(projection_file(out_dir, segment, dethv), overwrite=True)
     hdu_out.close()
 
 #-------------------------------------------------------------------------------
@@ -359,8 +821,8 @@ def time_fitting(x_fit, y_fit):
     ###First fit iteration and remove outliers
     POLY_FIT_ORDER = 1
 
-    slope, intercept = scipy.polyfit(x_fit, y_fit, POLY_FIT_ORDER)
-    fit = scipy.polyval((slope, intercept), x_fit)
+    slope, intercept = np.polyfit(x_fit, y_fit, POLY_FIT_ORDER)
+    fit = np.polyval((slope, intercept), x_fit)
     fit_sigma = fit.std()
     include_index = np.where(np.abs(fit-y_fit) < 1.5*fit_sigma)[0]
 
@@ -370,8 +832,8 @@ def time_fitting(x_fit, y_fit):
     x_fit_clipped = x_fit[include_index]
     y_fit_clipped = y_fit[include_index]
 
-    parameters = scipy.polyfit(x_fit_clipped, y_fit_clipped, POLY_FIT_ORDER)
-    fit = scipy.polyval(parameters, x_fit)
+    parameters = np.polyfit(x_fit_clipped, y_fit_clipped, POLY_FIT_ORDER)
+    fit = np.polyval(parameters, x_fit)
 
     return fit, parameters, True
 
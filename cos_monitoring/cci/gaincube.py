@@ -0,0 +1,311 @@
+from __future__ import absolute_import, print_function, division
+
+"""Time series of the measured gain of every superpixel.
+
+The binned gain images of one segment and DETHV are stacked into a
+(time, y, x) cube so the history of a superpixel, or of a detector region
+over a time window, can be read without opening every gainmap.
+
+The cube is split along time into blocks of BLOCK_SIZE gainmaps, each
+written to its own tile-compressed FITS file.  Tiles span the whole block
+in time and a small (TILE_Y, TILE_X) area, so reading one superpixel
+decompresses a single tile per block.  New gainmaps only rewrite the last
+block.  An index file lists the MJD, block and layer of every gainmap in
+the cube.
+
+"""
+
+__author__ = 'Justin Ely'
+__maintainer__ = 'Justin Ely'
+__email__ = 'ely@stsci.edu'
+__status__ = 'Active'
+
+import os
+import glob
+import argparse
+import logging
+logger = logging.getLogger(__name__)
+
+from astropy.io import fits
+import numpy as np
+import fitsio
+
+from .constants import YLEN, XLEN
+
+__all__ = ['GainCube', 'update_gain_cubes', 'known_gainmaps']
+
+BLOCK_SIZE = 64
+TILE_Y = 16
+TILE_X = 64
+
+#-------------------------------------------------------------------------------
+
+class GainCube(object):
+    """Gainmap time series of one segment and DETHV
+
+    Parameters
+    ----------
+    directory : str
+        directory holding the cube files
+    segment : str
+        FUVA or FUVB
+    dethv : int
+        high voltage of the gainmaps
+    block_size : int, optional
+        number of gainmaps per block file
+    """
+
+    def __init__(self, directory, segment, dethv, block_size=BLOCK_SIZE):
+        self.directory = directory
+        self.segment = segment
+        self.dethv = int(dethv)
+        self.block_size = block_size
+
+        self.root = os.path.join(directory, 'gaincube_{}_{}'.format(segment, self.dethv))
+        self.index_file = self.root + '_index.fits'
+
+        if os.path.exists(self.index_file):
+            index, header = fitsio.read(self.index_file, ext='INDEX', header=True)
+            self.block_size = header['BLOCKSIZ']
+            self.names = [name.decode().strip() if isinstance(name, bytes) else name.strip()
+                          for name in index['NAME']]
+            self.mjd = index['MJD'].astype(np.float64)
+            self.block = index['BLOCK'].astype(np.int32)
+            self.layer = index['LAYER'].astype(np.int32)
+        else:
+            self.names = []
+            self.mjd = np.zeros(0)
+            self.block = np.zeros(0, dtype=np.int32)
+            self.layer = np.zeros(0, dtype=np.int32)
+
+    def __len__(self):
+        return len(self.names)
+
+    def block_file(self, block):
+        return '{}_{:03d}.fits'.format(self.root, block)
+
+    def _write(self, filename, write_function):
+        """Write through a temporary file so readers never see a partial file"""
+
+        tmp_file = filename + '.tmp'
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+
+        with fitsio.FITS(tmp_file, 'rw') as out:
+            write_function(out)
+
+        os.rename(tmp_file, filename)
+
+    def _read_block(self, block, *slices):
+        with fitsio.FITS(self.block_file(block)) as hdu:
+            if slices:
+                return hdu['GAIN'][slices]
+            return hdu['GAIN'].read()
+
+    def append(self, names, mjds, images):
+        """Add gainmaps to the end of the cube
+
+        Parameters
+        ----------
+        names : list
+            basenames of the gainmaps
+        mjds : list
+            EXPSTART of each gainmap
+        images : list
+            binned gain image of each gainmap
+        """
+
+        if not len(names):
+            return
+
+        names = list(names)
+        mjds = np.asarray(mjds, dtype=np.float64)
+        images = np.asarray(images, dtype=np.float32)
+
+        if not images.shape[1:] == (YLEN, XLEN):
+            raise ValueError("Gainmaps of shape {} do not match ({}, {})".format(images.shape[1:], YLEN, XLEN))
+
+        start = len(self)
+        position = np.arange(start, start + len(names))
+        blocks = position // self.block_size
+
+        for block in np.unique(blocks):
+            new = images[blocks == block]
+
+            #-- the last block may already be partly filled
+            n_stored = np.sum(self.block == block)
+            if n_stored:
+                new = np.concatenate([self._read_block(block), new])
+
+            def write_block(out, data=new):
+                out.write(data,
+                          extname='GAIN',
+                          compress='GZIP_2',
+                          tile_dims=[len(data), TILE_Y, TILE_X],
+                          qlevel=None)
+
+            self._write(self.block_file(block), write_block)
+
+        self.names += names
+        self.mjd = np.concatenate([self.mjd, mjds])
+        self.block = np.concatenate([self.block, blocks.astype(np.int32)])
+        self.layer = np.concatenate([self.layer, (position % self.block_size).astype(np.int32)])
+
+        index = np.zeros(len(self), dtype=[('NAME', 'S64'), ('MJD', 'f8'), ('BLOCK', 'i4'), ('LAYER', 'i4')])
+        index['NAME'] = self.names
+        index['MJD'] = self.mjd
+        index['BLOCK'] = self.block
+        index['LAYER'] = self.layer
+
+        def write_index(out):
+            out.write(index, extname='INDEX',
+                      header={'SEGMENT': self.segment, 'DETHV': self.dethv, 'BLOCKSIZ': self.block_size})
+
+        self._write(self.index_file, write_index)
+
+    def region(self, y0=0, y1=YLEN, x0=0, x1=XLEN, start_mjd=-np.inf, end_mjd=np.inf):
+        """Gain of a detector region over a time window
+
+        Only the blocks holding gainmaps in the window are read, and of
+        those only the tiles covering the region.
+
+        Returns
+        -------
+        mjd : np.ndarray
+            EXPSTART of each gainmap in the window, increasing
+        gain : np.ndarray
+            (time, y1-y0, x1-x0) gain, 0 where not measured
+        """
+
+        selected = np.where((self.mjd >= start_mjd) & (self.mjd <= end_mjd))[0]
+        selected = selected[np.argsort(self.mjd[selected], kind='stable')]
+
+        gain = np.zeros((len(selected), y1 - y0, x1 - x0), dtype=np.float32)
+        for block in np.unique(self.block[selected]):
+            in_block = np.where(self.block[selected] == block)[0]
+            layers = self.layer[selected[in_block]]
+
+            data = self._read_block(block,
+                                    slice(layers.min(), layers.max() + 1),
+                                    slice(y0, y1),
+                                    slice(x0, x1))
+            gain[in_block] = data[layers - layers.min()]
+
+        return self.mjd[selected], gain
+
+    def history(self, y, x, start_mjd=-np.inf, end_mjd=np.inf):
+        """Measurements of one superpixel
+
+        Returns
+        -------
+        mjd : np.ndarray
+            EXPSTART of each gainmap that measured the superpixel
+        gain : np.ndarray
+            measured gain
+        """
+
+        mjd, gain = self.region(y, y + 1, x, x + 1, start_mjd, end_mjd)
+        gain = gain[:, 0, 0]
+        measured = gain > 0
+
+        return mjd[measured], gain[measured]
+
+#-------------------------------------------------------------------------------
+
+def known_gainmaps(cube_dir):
+    """Cubes in cube_dir and the names of the gainmaps they hold
+
+    Returns
+    -------
+    cubes : dict
+        {(segment, dethv): GainCube}
+    known : set
+        basenames of every gainmap in a cube
+    """
+
+    cubes = {}
+    known = set()
+    for index_file in glob.glob(os.path.join(cube_dir, 'gaincube_*_index.fits')):
+        header = fitsio.read_header(index_file, ext='INDEX')
+        key = (header['SEGMENT'].strip(), int(header['DETHV']))
+
+        cubes[key] = GainCube(cube_dir, *key)
+        known.update(cubes[key].names)
+
+    return cubes, known
+
+#-------------------------------------------------------------------------------
+
+def update_gain_cubes(gainmap_dir, cube_dir=None, block_size=BLOCK_SIZE):
+    """Append gainmaps not yet in the cubes of their segment and DETHV
+
+    The cube indices list the gainmaps already stored, so only the headers
+    of new gainmaps are read.
+
+    Parameters
+    ----------
+    gainmap_dir : str
+        directory holding the gainmaps
+    cube_dir : str, optional
+        directory holding the cubes, gainmap_dir by default
+    block_size : int, optional
+        number of gainmaps per block file of new cubes
+
+    Returns
+    -------
+    n_added : int
+        number of gainmaps appended
+    """
+
+    from .gainmap import index_gainmaps, read_gainmap
+
+    cube_dir = cube_dir or gainmap_dir
+    cubes, known = known_gainmaps(cube_dir)
+
+    new_maps = {}
+    for segment, item, expstart, dethv in index_gainmaps(gainmap_dir, skip=known):
+        key = (segment, int(dethv))
+        if not key in cubes:
+            cubes[key] = GainCube(cube_dir, segment, dethv, block_size)
+
+        new_maps.setdefault(key, []).append((expstart, item))
+
+    n_added = 0
+    for key, maps in sorted(new_maps.items()):
+        cube = cubes[key]
+
+        #-- a block at a time, to bound memory
+        maps.sort()
+        for i in range(0, len(maps), cube.block_size):
+            chunk = maps[i:i + cube.block_size]
+            cube.append([os.path.basename(item) for expstart, item in chunk],
+                        [expstart for expstart, item in chunk],
+                        [read_gainmap(item).dense('GAIN') for expstart, item in chunk])
+
+        logger.info("Added {} gainmaps to the {} {} gain cube".format(len(maps), *key))
+        n_added += len(maps)
+
+    return n_added
+
+#-------------------------------------------------------------------------------
+
+def update_gain_cubes_entry():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-d",
+                        '--dir',
+                        type=str,
+                        default='/grp/hst/cos/Monitors/CCI/',
+                        help="directory containing the gainmaps")
+
+    parser.add_argument("-c",
+                        '--cube-dir',
+                        type=str,
+                        default=None,
+                        help="directory holding the cubes, the gainmap directory by default")
+
+    args = parser.parse_args()
+
+    n_added = update_gain_cubes(args.dir, args.cube_dir)
+    print("Added {} gainmaps to the gain cubes".format(n_added))
+
+#-------------------------------------------------------------------------------
@@ -31,6 +31,8 @@ import time
 from datetime import datetime
 import gzip
 import glob
+import multiprocessing as mp
+import functools
 import logging
 logger = logging.getLogger(__name__)
 
@@ -38,12 +40,14 @@ from astropy.io import fits
 from astropy.modeling import models, fitting
 import numpy as np
 import matplotlib as mpl
+mpl.use('Agg')
 import matplotlib.pyplot as plt
 import scipy
 from scipy.optimize import leastsq, newton, curve_fit
 import fitsio
 
-from ..utils import rebin, enlarge
+from ..utils import rebin, enlarge, mjd_to_year
+from ..utils.reffiles import get_catalog, read_table
 from .constants import *  ## I know this is bad, but shut up.
 #from db_interface import session, engine, Gain
 
@@ -69,6 +73,7 @@ class CCI:
         self.xbinning = kwargs.get('xbinning', 1)
         self.ybinning = kwargs.get('ybinning', 1)
         self.mincounts = kwargs.get('mincounts', 30)
+        self.num_cpu = kwargs.get('num_cpu', 1)
 
         path, cci_name = os.path.split(filename)
         cci_name, ext = os.path.splitext(cci_name)
@@ -82,7 +87,10 @@ class CCI:
         if not self.numfiles:
             return
 
-        gainmap, counts, std = measure_gainimage(self.big_array)
+        if self.num_cpu > 1:
+            gainmap, counts, std = measure_gainimage_tiled(self.big_array, self.num_cpu)
+        else:
+            gainmap, counts, std = measure_gainimage(self.big_array, counts_im=self.cnt02_30_image)
         self.gain_image = gainmap
         self.std_image = std
 
@@ -103,9 +111,7 @@ class CCI:
 
         if kwargs.get('ignore_spots', True):
             ### Dynamic when delivered to CRDS
-            reffiles = glob.glob(os.path.join(os.environ['lref'], '*spot.fits'))
-            creation_dates = np.array([fits.getval(item, 'DATE') for item in reffiles])
-            spottab = reffiles[creation_dates.argmax()]
+            spottab = get_catalog().latest('spot')
 
             if os.path.exists(spottab):
                 regions = read_spottab(spottab,
@@ -140,8 +146,6 @@ class CCI:
         hdu = fitsio.FITS(self.input_file)
         primary = hdu[0].read_header()
 
-        assert (hdu[2].read().shape == (Y_UNBINNED, X_UNBINNED)), 'ERROR: Input CCI not standard dimensions'
-
         self.detector = primary['DETECTOR']
         self.segment = primary['SEGMENT']
         self.obsmode = primary['OBSMODE']
@@ -158,10 +162,7 @@ class CCI:
 
         if self.expstart:
             #----Finds to most recently created HVTAB
-            hvtable_list = glob.glob(os.path.join(os.environ['lref'], '*hv.fits'))
-            HVTAB = hvtable_list[np.array([fits.getval(item, 'DATE') for item in hvtable_list]).argmax()]
-
-            hvtab = fits.open(HVTAB)
+            self.hvtab = get_catalog().latest('hv')
 
             if self.segment == 'FUVA':
                 hv_string = 'HVLEVELA'
@@ -170,17 +171,40 @@ class CCI:
 
         self.file_list = [line[0].decode("utf-8") for line in hdu[1].read()]
 
-        self.big_array = np.array([rebin(hdu[i+2].read(), bins=(self.ybinning, self.xbinning)) for i in range(32)])
-        self.get_counts(self.big_array)
-        self.extracted_charge = self.pha_to_coulombs(self.big_array)
+        self.big_array = read_cci_cube(hdu, self.ybinning, self.xbinning)
+        hdu.close()
+
+        self.derive_products()
 
         self.gain_image = np.zeros((YLEN, XLEN))
+        self.std_image = np.zeros((YLEN, XLEN))
         self.modal_gain_width = np.zeros((YLEN, XLEN))
 
-        self.cnt00_00 = len(self.big_array[0].nonzero()[0])
-        self.cnt01_01 = len(self.big_array[1].nonzero()[0])
-        self.cnt02_30 = len(self.big_array[2:31].nonzero()[0])
-        self.cnt31_31 = len(self.big_array[31:].nonzero()[0])
+    def derive_products(self):
+        """Compute the counts, charge and PHA range images of the cube.
+
+        Done once after loading.  The images and their numbers of non-zero
+        pixels are kept on the object and reused when writing.
+        """
+
+        cube = self.big_array
+
+        self.cnt00_00_image = cube[0]
+        self.cnt01_01_image = cube[1]
+        self.cnt02_30_image = cube[2:31].sum(axis=0, dtype=np.int64)
+        self.cnt31_31_image = cube[31]
+
+        self.counts_image = self.add_accum(self.cnt00_00_image +
+                                           self.cnt01_01_image +
+                                           self.cnt02_30_image +
+                                           self.cnt31_31_image)
+        self.extracted_charge = self.pha_to_coulombs(cube)
+
+        nonzero = np.count_nonzero(cube.reshape(len(cube), -1), axis=1)
+        self.cnt00_00 = int(nonzero[0])
+        self.cnt01_01 = int(nonzero[1])
+        self.cnt02_30 = int(nonzero[2:31].sum())
+        self.cnt31_31 = int(nonzero[31:].sum())
 
     def get_counts(self, in_array):
         """collapse pha arrays to get total counts accross all
@@ -189,7 +213,10 @@ class CCI:
         Will also search for and add in accum data if any exists.
         """
 
-        out_array = np.sum(in_array, axis=0)
+        self.counts_image = self.add_accum(np.sum(in_array, axis=0))
+
+    def add_accum(self, out_array):
+        """Add in accum data to a counts image, if any exists."""
 
         ###Test before implementation
         ###Should only effect counts and charge extensions.
@@ -204,12 +231,12 @@ class CCI:
 
         if os.path.exists(accum_name):
             accum_data = rebin(fits.getdata(CCI_DIR+accum_name, 0),bins=(Y_BINNING,self.xbinning))
-            out_array += accum_data
+            out_array = out_array + accum_data
             self.accum_data = accum_data
         else:
             self.accum_data = None
 
-        self.counts_image = out_array
+        return out_array
 
     def pha_to_coulombs(self, in_array):
         """Convert pha to picocoloumbs to calculate extracted charge.
@@ -217,20 +244,26 @@ class CCI:
         Equation comes from D. Sahnow.
         """
 
-        coulomb_value = 1.0e-12*10**((np.array(range(0,32))-11.75)/20.5)
-        zlen, ylen, xlen = in_array.shape
-        out_array = np.zeros((ylen, xlen))
+        coulomb_value = 1.0e-12*10**((np.arange(len(in_array))-11.75)/20.5)
 
-        for pha,layer in enumerate(in_array):
-            out_array += (coulomb_value[pha]*layer)
+        return np.tensordot(coulomb_value, in_array, axes=1)
 
-        return out_array
+    def gainmap(self):
+        """Measured gain, std and counts as a SparseGainmap"""
+
+        return SparseGainmap.from_dense(self.gain_image,
+                                        self.std_image,
+                                        self.counts_image)
 
     def write(self, out_name=None):
         '''Write current CCI object to fits file.
 
         Output files are used in later analysis to determine when
-        regions fall below the threshold.
+        regions fall below the threshold.  Since GMAPVERS 2 the gain is
+        stored as a coordinate list of the measured superpixels (see
+        SparseGainmap) in the GAINMAP extension, replacing the dense
+        MOD_GAIN image, and the counts and charge images are tile
+        compressed.  The extensions are in the same order as before.
         '''
 
         out_name = out_name or self.cci_name + '_gainmap.fits'
@@ -247,6 +280,7 @@ class CCI:
         hdu_out[0].header['DETECTOR'] = 'FUV'
         hdu_out[0].header['OPT_ELEM'] = 'ANY'
         hdu_out[0].header['FILETYPE'] = 'GAINMAP'
+        hdu_out[0].header['GMAPVERS'] = 2
 
         hdu_out[0].header['XBINNING'] = self.xbinning
         hdu_out[0].header['YBINNING'] = self.ybinning
@@ -272,31 +306,28 @@ class CCI:
         hdu_out[1].header['EXTNAME'] = 'FILES'
 
         #-------EXT=2
-        hdu_out.append(fits.ImageHDU(data=self.gain_image))
-        hdu_out[2].header['EXTNAME'] = 'MOD_GAIN'
+        hdu_out.append(self.gainmap().to_hdu())
 
         #-------EXT=3
-        hdu_out.append(fits.ImageHDU(data=self.counts_image))
-        hdu_out[3].header['EXTNAME'] = 'COUNTS'
+        hdu_out.append(compressed_image(self.counts_image, 'COUNTS'))
 
         #-------EXT=4
-        hdu_out.append(fits.ImageHDU(data=self.extracted_charge))
-        hdu_out[4].header['EXTNAME'] = 'CHARGE'
+        hdu_out.append(compressed_image(self.extracted_charge, 'CHARGE'))
 
         #-------EXT=5
-        hdu_out.append(fits.ImageHDU(data=self.big_array[0]))
+        hdu_out.append(fits.ImageHDU(data=self.cnt00_00_image))
         hdu_out[5].header['EXTNAME'] = 'cnt00_00'
 
         #-------EXT=6
-        hdu_out.append(fits.ImageHDU(data=self.big_array[1]))
+        hdu_out.append(fits.ImageHDU(data=self.cnt01_01_image))
         hdu_out[6].header['EXTNAME'] = 'cnt01_01'
 
         #-------EXT=7
-        hdu_out.append(fits.ImageHDU(data=np.sum(self.big_array[2:31],axis=0)))
+        hdu_out.append(fits.ImageHDU(data=self.cnt02_30_image))
         hdu_out[7].header['EXTNAME'] = 'cnt02_30'
 
         #-------EXT=8
-        hdu_out.append(fits.ImageHDU(data=self.big_array[31]))
+        hdu_out.append(fits.ImageHDU(data=self.cnt31_31_image))
         hdu_out[8].header['EXTNAME'] = 'cnt31_31'
 
 
@@ -306,6 +337,160 @@ class CCI:
 
 #------------------------------------------------------------
 
+class SparseGainmap(object):
+    """Coordinate list of the measured superpixels of a gainmap
+
+    Only superpixels with a gain are measured, outside the spectral stripes
+    the gain image is zero, so only the (y, x) and values of the measured
+    superpixels are kept.
+
+    Parameters
+    ----------
+    y, x : np.ndarray
+        coordinates of the superpixels
+    shape : tuple, optional
+        shape of the dense images
+    **columns
+        GAIN, STD and COUNTS of each superpixel, absent fields are 0
+    """
+
+    fields = ('GAIN', 'STD', 'COUNTS')
+
+    def __init__(self, y, x, shape=(YLEN, XLEN), **columns):
+        self.y = np.asarray(y, dtype=np.int32)
+        self.x = np.asarray(x, dtype=np.int32)
+        self.shape = tuple(shape)
+
+        self.columns = {field: np.asarray(columns[field], dtype=np.float32) if field in columns
+                        else np.zeros(len(self.y), dtype=np.float32) for field in self.fields}
+
+    def __len__(self):
+        return len(self.y)
+
+    @classmethod
+    def from_dense(cls, gain, std=None, counts=None):
+        """Keep the superpixels where gain > 0"""
+
+        y, x = np.nonzero(gain > 0)
+        images = {field: image for field, image in zip(cls.fields, (gain, std, counts))
+                  if image is not None}
+
+        return cls(y, x, gain.shape, **{field: image[y, x] for field, image in images.items()})
+
+    def dense(self, field='GAIN'):
+        """Full image of one field, 0 where not measured"""
+
+        image = np.zeros(self.shape, dtype=np.float32)
+        image[self.y, self.x] = self.columns[field]
+
+        return image
+
+    def to_hdu(self, extname='GAINMAP'):
+        """Binary table of the coordinate list"""
+
+        columns = [fits.Column('Y', 'I', array=self.y.astype(np.int16)),
+                   fits.Column('X', 'I', array=self.x.astype(np.int16))]
+        columns += [fits.Column(field, 'E', array=self.columns[field]) for field in self.fields]
+
+        hdu = fits.BinTableHDU.from_columns(columns, name=extname)
+        hdu.header['YLEN'] = self.shape[0]
+        hdu.header['XLEN'] = self.shape[1]
+
+        return hdu
+
+    @classmethod
+    def from_hdu(cls, hdu):
+        """Read a table written by to_hdu"""
+
+        data = hdu.data
+        shape = (hdu.header['YLEN'], hdu.header['XLEN'])
+
+        return cls(data['Y'], data['X'], shape, **{field: data[field] for field in cls.fields})
+
+#------------------------------------------------------------
+
+def compressed_image(data, name):
+    """Losslessly tile-compressed image extension
+
+    Integer images are Rice compressed, floating point images are gzipped
+    without quantization.
+    """
+
+    if np.issubdtype(data.dtype, np.integer) or np.array_equal(data, np.round(data)):
+        return fits.CompImageHDU(data.astype(np.int32), name=name, compression_type='RICE_1')
+
+    return fits.CompImageHDU(data, name=name, compression_type='GZIP_2', quantize_level=0)
+
+#------------------------------------------------------------
+
+def read_gainmap(filename):
+    """Measured gain, std and counts of a gainmap file as a SparseGainmap
+
+    Gainmaps written before GMAPVERS 2, with a dense MOD_GAIN image in
+    place of the GAINMAP table, are converted.
+    """
+
+    with fits.open(filename) as hdu:
+        names = [ext.name for ext in hdu]
+
+        if 'GAINMAP' in names:
+            return SparseGainmap.from_hdu(hdu['GAINMAP'])
+
+        counts = hdu['COUNTS'].data if 'COUNTS' in names else None
+        return SparseGainmap.from_dense(hdu['MOD_GAIN'].data, counts=counts)
+
+#------------------------------------------------------------
+
+def read_cci_cube(hdu, ybinning=1, xbinning=1, shape=(Y_UNBINNED, X_UNBINNED), n_pha=32, rows_per_read=64):
+    """Read and bin the PHA images of a CCI into one int32 cube
+
+    The image shapes are checked from the headers, and each image is read in
+    bands of rows that are binned straight into the preallocated cube, so
+    only one band of one image is held unbinned at a time.  The cube is
+    returned read-only.
+
+    Parameters
+    ----------
+    hdu : fitsio.FITS
+        open CCI file, PHA images are in extensions 2 to n_pha + 1
+    ybinning, xbinning : int, optional
+        binning factors
+    shape : tuple, optional
+        expected (y, x) shape of each unbinned image
+    n_pha : int, optional
+        number of PHA images
+    rows_per_read : int, optional
+        number of unbinned rows read at a time, rounded to a multiple of
+        ybinning
+
+    Returns
+    -------
+    cube : np.ndarray
+        (n_pha, y // ybinning, x // xbinning) int32 array
+    """
+
+    ylen, xlen = shape
+    rows_per_read = max(ybinning, rows_per_read - rows_per_read % ybinning)
+
+    cube = np.empty((n_pha, ylen // ybinning, xlen // xbinning), dtype=np.int32)
+
+    for pha in range(n_pha):
+        ext = hdu[pha + 2]
+        assert (tuple(ext.get_dims()) == tuple(shape)), 'ERROR: Input CCI not standard dimensions'
+
+        for y_start in range(0, ylen, rows_per_read):
+            y_end = min(y_start + rows_per_read, ylen)
+            band = ext[y_start:y_end, :]
+
+            band.reshape((y_end - y_start) // ybinning, ybinning, xlen // xbinning, xbinning).\
+                sum(axis=(1, 3), dtype=np.int32, out=cube[pha, y_start // ybinning:y_end // ybinning])
+
+    cube.flags.writeable = False
+
+    return cube
+
+#------------------------------------------------------------
+
 def rename(input_file, mode='move'):
     """Rename CCI file from old to new naming convention
 
@@ -386,13 +571,13 @@ def read_brftab(filename, segment):
         left, right, top, bottom corners of the active area
     """
 
-    with fits.open(filename) as hdu:
-        index = np.where(hdu[1].data['segment'] == segment)[0]
+    data = read_table(filename)
+    index = np.where(data['segment'] == segment)[0]
 
-        left = hdu[1].data[index]['A_LEFT']
-        right = hdu[1].data[index]['A_RIGHT']
-        top = hdu[1].data[index]['A_HIGH']
-        bottom = hdu[1].data[index]['A_LOW']
+    left = data[index]['A_LEFT']
+    right = data[index]['A_RIGHT']
+    top = data[index]['A_HIGH']
+    bottom = data[index]['A_LOW']
 
     return left[0], right[0], top[0], bottom[0]
 
@@ -417,77 +602,318 @@ def read_spottab(filename, segment, expstart, expend):
 
 
     """
-    with fits.open(filename) as hdu:
-        index = np.where((hdu[1].data['SEGMENT'] == segment) &
-                         (hdu[1].data['START'] < expend) &
-                         (hdu[1].data['STOP'] > expstart))[0]
+    data = read_table(filename)
+    index = np.where((data['SEGMENT'] == segment) &
+                     (data['START'] < expend) &
+                     (data['STOP'] > expstart))[0]
 
-        rows = hdu[1].data[index]
+    rows = data[index]
 
-        return zip(rows['LX'], rows['LY'], rows['DX'], rows['DY'])
+    return zip(rows['LX'], rows['LY'], rows['DX'], rows['DY'])
 
 #-------------------------------------------------------------------------------
 
-def make_all_hv_maps():
-    for hv in range(150, 179):
-        tmp_hdu = fits.open(os.path.join( MONITOR_DIR, 'total_gain.fits'))
-        for ext in (1, 2):
-            tmp_hdu[ext].data -= .393 * (float(178) - hv)
-        tmp_hdu.writeto( os.path.join( MONITOR_DIR, 'total_gain_%d.fits' % hv ), clobber=True )
-        print('WRITING  total_gain_{}.fits TO {}'.format(hv, MONITOR_DIR))
+#-- Change of modal gain per DETHV step, and the DETHV total_gain.fits is
+#-- scaled to.
+GAIN_PER_HV_STEP = .393
+REFERENCE_HV = 178
+
+@functools.lru_cache(maxsize=8)
+def _binned_total_gain(filename, extname, mtime):
+    """One extension of total_gain.fits at binned resolution
+
+    The composites are enlarged copies of binned images, so every
+    Y_BINNING x X_BINNING block holds one value.  Only those values are
+    taken from the memory-mapped file.
+    """
+
+    with fits.open(filename, memmap=True) as hdu:
+        data = np.array(hdu[extname].data[::Y_BINNING, ::X_BINNING])
+
+    data.flags.writeable = False
+
+    return data
 
 #-------------------------------------------------------------------------------
 
-def make_total_gain(gainmap_dir=None, segment='FUV', start_mjd=55055, end_mjd=70000, min_hv=163, max_hv=175, reverse=False):
-    if segment == 'FUVA':
-        search_string = 'l_*_00_???_cci_gainmap.fits'
-    elif segment == 'FUVB':
-        search_string = 'l_*_01_???_cci_gainmap.fits'
+def total_gain_at_hv(segment, dethv, which='INIT', binned=True, filename=None):
+    """Total gain map of a segment adjusted to dethv
 
+    The measured superpixels of total_gain.fits are shifted by
+    GAIN_PER_HV_STEP for every step dethv is below REFERENCE_HV.  This
+    replaces the total_gain_{hv}.fits files once written by
+    make_all_hv_maps.
 
-    all_datasets = [item for item in glob.glob(os.path.join(gainmap_dir, search_string))]
+    Parameters
+    ----------
+    segment : str
+        FUVA or FUVB
+    dethv : int
+        high voltage to adjust to
+    which : str, optional
+        INIT or LAST composite
+    binned : bool, optional
+        return the map at binned resolution, full resolution otherwise
+    filename : str, optional
+        total gain file, total_gain.fits in MONITOR_DIR by default
 
-    if not len(all_datasets):
-        search_string = search_string + '.gz'
-        all_datasets = [item for item in glob.glob(os.path.join(gainmap_dir, search_string))]
+    Returns
+    -------
+    gain : np.ndarray
+        new, writable array of the adjusted gain, 0 where not measured
+    """
 
-    all_datasets.sort()
+    filename = filename or os.path.join(MONITOR_DIR, 'total_gain.fits')
 
-    print("Combining {} datasets".format(len(all_datasets)))
+    base = _binned_total_gain(filename, '{}{}'.format(segment, which), os.stat(filename).st_mtime)
 
-    if reverse:
-        all_datasets = all_datasets[::-1]
+    gain = np.where(base > 0, base - GAIN_PER_HV_STEP * (REFERENCE_HV - int(dethv)), base)
 
-    out_data = np.zeros((YLEN, XLEN))
+    if not binned:
+        gain = enlarge(gain, x=X_BINNING, y=Y_BINNING)
 
-    for item in all_datasets:
+    return gain
 
-        cci_hdu = fits.open(item)
-        if not cci_hdu[0].header['EXPSTART'] >= start_mjd:
-            continue
-        if not cci_hdu[0].header['EXPSTART'] <= end_mjd:
-            continue
+#-------------------------------------------------------------------------------
 
-        if not cci_hdu[0].header['DETHV'] >= min_hv:
-            continue
-        if not cci_hdu[0].header['DETHV'] <= max_hv:
-            continue
+#-- gainmap file name pattern of each segment
+GAINMAP_PATTERNS = {'FUVA': 'l_*_00_???_cci_gainmap.fits',
+                    'FUVB': 'l_*_01_???_cci_gainmap.fits'}
+
+def index_gainmaps(gainmap_dir, segments=('FUVA', 'FUVB'), skip=()):
+    """Primary header information of the gainmaps in gainmap_dir
+
+    Compressed gainmaps are only used for a segment without uncompressed
+    ones.
+
+    Parameters
+    ----------
+    gainmap_dir : str
+        directory holding the gainmaps
+    segments : tuple, optional
+        segments to look for
+    skip : set, optional
+        basenames of gainmaps already known, their headers are not read
+
+    Returns
+    -------
+    index : list
+        (segment, filename, EXPSTART, DETHV) of each gainmap, sorted by name
+    """
+
+    index = []
+    for segment in segments:
+        search_string = GAINMAP_PATTERNS[segment]
+
+        all_datasets = glob.glob(os.path.join(gainmap_dir, search_string))
+        if not len(all_datasets):
+            all_datasets = glob.glob(os.path.join(gainmap_dir, search_string + '.gz'))
 
-        test_list.append(item)
-        cci_data = cci_hdu['MOD_GAIN'].data
+        for item in sorted(all_datasets):
+            if os.path.basename(item) in skip:
+                continue
+
+            header = fits.getheader(item, 0)
+            index.append((segment, item, header['EXPSTART'], header['DETHV']))
 
-        dethv = cci_hdu[0].header['DETHV']
+    return index
+
+#-------------------------------------------------------------------------------
 
-        index = np.where(cci_data)
-        #cci_data[index] += .393 * (float(178) - dethv)
+class GainComposite(object):
+    """First-valid and last-valid gain of every superpixel
 
-        index_both = np.where((cci_data > 0) & (out_data > 0))
-        #mean_data = np.mean([cci_data, out_data], axis=0)
+    For each segment the earliest (INIT) and latest (LAST) measured gain of
+    each superpixel is kept along with the EXPSTART, DETHV and source
+    gainmap of that value.  New gainmaps are folded in one at a time, so
+    the composite can be saved and brought up to date with only the
+    gainmaps added since.
+
+    Values are compared by EXPSTART, so gainmaps may be folded in any
+    order.
+    """
+
+    fields = (('GAIN', np.float64, 0), ('MJD', np.float64, 0), ('DETHV', np.int16, 0), ('SOURCE', np.int32, -1))
+
+    def __init__(self, start_mjd=55055, end_mjd=70000, min_hv=163, max_hv=175, segments=('FUVA', 'FUVB')):
+        self.start_mjd = start_mjd
+        self.end_mjd = end_mjd
+        self.min_hv = min_hv
+        self.max_hv = max_hv
+        self.segments = tuple(segments)
+
+        #-- every gainmap examined: basename, segment, EXPSTART, DETHV, used
+        self.seen = []
+
+        self.state = {}
+        for segment in self.segments:
+            for which in ('INIT', 'LAST'):
+                for field, dtype, blank in self.fields:
+                    self.state[(segment, which, field)] = np.full((YLEN, XLEN), blank, dtype=dtype)
+
+    def bounds(self):
+        return (self.start_mjd, self.end_mjd, self.min_hv, self.max_hv, self.segments)
+
+    def accepts(self, expstart, dethv):
+        """Is a gainmap taken at expstart and dethv within the bounds"""
+
+        return (self.start_mjd <= expstart <= self.end_mjd) and (self.min_hv <= dethv <= self.max_hv)
+
+    def fold(self, segment, filename, expstart, dethv, data):
+        """Add the measured superpixels of one gainmap
+
+        Parameters
+        ----------
+        segment : str
+            FUVA or FUVB
+        filename : str
+            gainmap the data came from
+        expstart : float
+            EXPSTART of the gainmap
+        dethv : int
+            DETHV of the gainmap
+        data : SparseGainmap or np.ndarray
+            binned gainmap, or its gain image with 0 where not measured
+        """
+
+        if not isinstance(data, SparseGainmap):
+            data = SparseGainmap.from_dense(data)
+
+        measured = data.columns['GAIN'] != 0
+        y, x, gain = data.y[measured], data.x[measured], data.columns['GAIN'][measured]
+
+        source = len(self.seen)
+        self.seen.append((os.path.basename(filename), segment, expstart, dethv, True))
+
+        init_mjd = self.state[(segment, 'INIT', 'MJD')]
+        init_src = self.state[(segment, 'INIT', 'SOURCE')]
+        last_mjd = self.state[(segment, 'LAST', 'MJD')]
+        last_src = self.state[(segment, 'LAST', 'SOURCE')]
+
+        for which, newer in (('INIT', (init_src[y, x] < 0) | (expstart < init_mjd[y, x])),
+                             ('LAST', (last_src[y, x] < 0) | (expstart >= last_mjd[y, x]))):
+            index = (y[newer], x[newer])
+            self.state[(segment, which, 'GAIN')][index] = gain[newer]
+            self.state[(segment, which, 'MJD')][index] = expstart
+            self.state[(segment, which, 'DETHV')][index] = dethv
+            self.state[(segment, which, 'SOURCE')][index] = source
+
+    def update(self, gainmap_dir):
+        """Fold in the gainmaps of gainmap_dir not seen before
+
+        Returns
+        -------
+        n_added : int
+            number of gainmaps folded in
+        """
+
+        known = {item[0] for item in self.seen}
+
+        n_added = 0
+        for segment, item, expstart, dethv in index_gainmaps(gainmap_dir, self.segments, skip=known):
+            if not self.accepts(expstart, dethv):
+                self.seen.append((os.path.basename(item), segment, expstart, dethv, False))
+                continue
 
-        out_data[index] = cci_data[index]
-        #out_data[index_both] = mean_data[index_both]
+            self.fold(segment, item, expstart, dethv, read_gainmap(item))
+            n_added += 1
 
-    return enlarge(out_data, x=X_BINNING, y=Y_BINNING)
+        logger.info("Folded {} new gainmaps into the total gain".format(n_added))
+
+        return n_added
+
+    def images(self):
+        """INIT and LAST gain of each segment at full detector resolution
+
+        Returns
+        -------
+        composites : dict
+            {(segment, 'INIT'): image, (segment, 'LAST'): image}
+        """
+
+        return {(segment, which): enlarge(self.state[(segment, which, 'GAIN')], x=X_BINNING, y=Y_BINNING)
+                for segment in self.segments for which in ('INIT', 'LAST')}
+
+    def save(self, filename):
+        """Write the composite state to a FITS file"""
+
+        hdu_out = fits.HDUList(fits.PrimaryHDU())
+        hdu_out[0].header['FILETYPE'] = 'GAIN STATE'
+        hdu_out[0].header['EXPSTART'] = self.start_mjd
+        hdu_out[0].header['EXP_END'] = self.end_mjd
+        hdu_out[0].header['MIN_HV'] = self.min_hv
+        hdu_out[0].header['MAX_HV'] = self.max_hv
+        hdu_out[0].header['SEGMENTS'] = ' '.join(self.segments)
+
+        names, segments, expstarts, dethvs, used = zip(*self.seen) if self.seen else ([], [], [], [], [])
+        hdu_out.append(fits.BinTableHDU.from_columns([fits.Column('NAME', '64A', array=np.array(names, dtype='S64')),
+                                                      fits.Column('SEGMENT', '4A', array=np.array(segments, dtype='S4')),
+                                                      fits.Column('EXPSTART', 'D', array=np.array(expstarts, dtype=np.float64)),
+                                                      fits.Column('DETHV', 'I', array=np.array(dethvs, dtype=np.int16)),
+                                                      fits.Column('USED', 'L', array=np.array(used, dtype=bool))],
+                                                     name='SOURCES'))
+
+        for (segment, which, field), data in sorted(self.state.items()):
+            hdu_out.append(fits.ImageHDU(data=data, name='{}{}_{}'.format(segment, which, field)))
+
+        hdu_out.writeto(filename, overwrite=True)
+
+    @classmethod
+    def load(cls, filename):
+        """Read a composite state written by save"""
+
+        with fits.open(filename) as hdu:
+            header = hdu[0].header
+            composite = cls(header['EXPSTART'], header['EXP_END'],
+                            header['MIN_HV'], header['MAX_HV'],
+                            header['SEGMENTS'].split())
+
+            sources = hdu['SOURCES'].data
+            composite.seen = [(str(name), str(segment), float(expstart), int(dethv), bool(used))
+                              for name, segment, expstart, dethv, used in zip(sources['NAME'],
+                                                                             sources['SEGMENT'],
+                                                                             sources['EXPSTART'],
+                                                                             sources['DETHV'],
+                                                                             sources['USED'])]
+
+            for segment, which, field in composite.state:
+                composite.state[(segment, which, field)] = hdu['{}{}_{}'.format(segment, which, field)].data.copy()
+
+        return composite
+
+#-------------------------------------------------------------------------------
+
+def make_total_gains(gainmap_dir, start_mjd=55055, end_mjd=70000, min_hv=163, max_hv=175, segments=('FUVA', 'FUVB')):
+    """Combine gainmaps into the first-valid and last-valid gain of each segment
+
+    Candidates are chosen from the header index and the gain of each is
+    read once, updating both composites.
+
+    Returns
+    -------
+    composites : dict
+        {(segment, 'INIT'): image, (segment, 'LAST'): image}, enlarged to
+        full detector resolution.  INIT holds the earliest measured gain of
+        each superpixel and LAST the latest.
+    """
+
+    composite = GainComposite(start_mjd, end_mjd, min_hv, max_hv, segments)
+    composite.update(gainmap_dir)
+
+    return composite.images()
+
+#-------------------------------------------------------------------------------
+
+def make_total_gain(gainmap_dir=None, segment='FUV', start_mjd=55055, end_mjd=70000, min_hv=163, max_hv=175, reverse=False):
+    """Combined gain of one segment, the earliest valid gain of each
+    superpixel with reverse=True and the latest otherwise.
+
+    Use make_total_gains to get several composites in one pass.
+    """
+
+    composites = make_total_gains(gainmap_dir, start_mjd, end_mjd, min_hv, max_hv, segments=(segment,))
+
+    return composites[(segment, 'INIT' if reverse else 'LAST')]
 
 #------------------------------------------------------------
 
@@ -528,6 +954,14 @@ def make_all_gainmaps_entry():
                         default=175,
                         help="Maximum DETHV of gainmaps to include.")
 
+    parser.add_argument('--state',
+                        type=str,
+                        default=None,
+                        help="File keeping the composite state between runs")
+
+    parser.add_argument('--rebuild',
+                        action='store_true',
+                        help="Rebuild the composite state from all gainmaps")
 
     args = parser.parse_args()
 
@@ -538,12 +972,19 @@ def make_all_gainmaps_entry():
                       start_mjd=args.start,
                       end_mjd=args.end,
                       min_hv=args.hvmin,
-                      max_hv=args.hvmax)
+                      max_hv=args.hvmax,
+                      state_file=args.state,
+                      rebuild=args.rebuild)
 
 #------------------------------------------------------------
 
-def make_all_gainmaps(filename, gainmap_dir, start_mjd=55055, end_mjd=70000, min_hv=163, max_hv=175):
-    """
+def make_all_gainmaps(filename, gainmap_dir, start_mjd=55055, end_mjd=70000, min_hv=163, max_hv=175,
+                      state_file=None, rebuild=False):
+    """Write the INIT and LAST total gain of both segments to filename
+
+    With state_file the composite state is kept between runs, and only
+    gainmaps added since the last run are read.  The state is rebuilt from
+    all gainmaps if rebuild is set or the MJD and HV bounds have changed.
 
     """
 
@@ -566,20 +1007,27 @@ def make_all_gainmaps(filename, gainmap_dir, start_mjd=55055, end_mjd=70000, min
     hdu_out[0].header['CCI_DIR'] = gainmap_dir
 
     #-- Data ext
-    hdu_out.append(fits.ImageHDU(data=make_total_gain(gainmap_dir, 'FUVA', start_mjd, end_mjd, min_hv, max_hv, reverse=True)))
-    hdu_out[1].header['EXTNAME'] = 'FUVAINIT'
-    hdu_out.append(fits.ImageHDU(data=make_total_gain(gainmap_dir, 'FUVB', start_mjd, end_mjd, min_hv, max_hv,  reverse=True)))
-    hdu_out[2].header['EXTNAME'] = 'FUVBINIT'
-    hdu_out.append(fits.ImageHDU(data=make_total_gain(gainmap_dir, 'FUVA', start_mjd, end_mjd, min_hv, max_hv)))
-    hdu_out[3].header['EXTNAME'] = 'FUVALAST'
-    hdu_out.append(fits.ImageHDU(data=make_total_gain(gainmap_dir, 'FUVB', start_mjd, end_mjd, min_hv, max_hv)))
-    hdu_out[4].header['EXTNAME'] = 'FUVBLAST'
-    hdu_out.writeto(filename, clobber=True)
+    composite = None
+    if state_file and os.path.exists(state_file) and not rebuild:
+        composite = GainComposite.load(state_file)
+        if not composite.bounds() == (start_mjd, end_mjd, min_hv, max_hv, ('FUVA', 'FUVB')):
+            logger.info("Gain state {} has different bounds, rebuilding".format(state_file))
+            composite = None
+
+    if composite is None:
+        composite = GainComposite(start_mjd, end_mjd, min_hv, max_hv)
+
+    composite.update(gainmap_dir)
+    if state_file:
+        composite.save(state_file)
+
+    composites = composite.images()
+    for extname in ('FUVAINIT', 'FUVBINIT', 'FUVALAST', 'FUVBLAST'):
+        hdu_out.append(fits.ImageHDU(data=composites[(extname[:4], extname[4:])]))
+        hdu_out[-1].header['EXTNAME'] = extname
+    hdu_out.writeto(filename, overwrite=True)
     hdu_out.close()
 
-    print('Making ALL HV Maps')
-    ###make_all_hv_maps()
-
 
 #------------------------------------------------------------
 
@@ -591,7 +1039,7 @@ def add_cumulative_data(ending):
     data_list = glob.glob(os.path.join(MONITOR_DIR,'*%s*gainmap.fits'%ending))
     data_list.sort()
     print('Adding cumulative data to gainmaps for %s'%(ending))
-    shape = fits.getdata(data_list[0], ext=('MOD_GAIN', 1)).shape
+    shape = fits.getdata(data_list[0], ext=('COUNTS', 1)).shape
     total_counts = np.zeros(shape)
     total_charge = np.zeros(shape)
 
@@ -629,18 +1077,27 @@ def add_cumulative_data(ending):
 
 #------------------------------------------------------------
 
-def measure_gainimage(data_cube, mincounts=30, phlow=1, phhigh=31):
+def measure_gainimage(data_cube, mincounts=30, phlow=1, phhigh=31, batch=True, counts_im=None):
     """ measure the modal gain at each pixel
 
     returns a 2d gainmap
 
+    With batch=True all distributions are fit at once by fit_distributions,
+    otherwise each is fit separately with fit_distribution.  Both apply the
+    same acceptance rules.  Modal gains from the two agree to within 0.005,
+    pixels are only accepted by one of them where the per-pixel fitter runs
+    out of iterations (~0.1%).
+
+    counts_im, the sum of the phlow+1 to phhigh-1 layers, can be passed in
+    if already known.
+
     """
 
-    # Suppress certain pharanges
-    for i in list(range(0, phlow+1)) + list(range(phhigh, len(data_cube))):
-        data_cube[i] = 0
+    # Suppress certain pharanges, without modifying data_cube
+    keep = slice(phlow+1, phhigh)
 
-    counts_im = np.sum(data_cube, axis=0)
+    if counts_im is None:
+        counts_im = np.sum(data_cube[keep], axis=0)
 
     out_gain = np.zeros(counts_im.shape)
     out_counts = np.zeros(counts_im.shape)
@@ -650,8 +1107,34 @@ def measure_gainimage(data_cube, mincounts=30, phlow=1, phhigh=31):
     if not len(index_search):
         return out_gain, out_counts, out_std
 
+    if batch:
+        dists = np.zeros((len(index_search[0]), len(data_cube)))
+        dists[:, keep] = data_cube[keep, index_search[0], index_search[1]].T
+        amplitude, mean, std, success = fit_distributions(dists)
+
+        #-- double-check.  Refitting the residuals from a distant start is
+        #-- sensitive to the path the fitter takes, so the few low gain
+        #-- pixels are refit with the per-pixel fitter.
+        x_vals = np.arange(dists.shape[1])
+        for i in np.where(success & (mean <= 3))[0]:
+            sub_dist = dists[i] - gaussian(x_vals, amplitude[i], mean[i], std[i])
+            sub_dist[sub_dist < 0] = 0
+
+            g2, fit2_g, success2 = fit_distribution(sub_dist, start_mean=15)
+
+            if success2 and abs(g2.mean.value - mean[i]) > 1:
+                success[i] = False
+
+        y, x = index_search[0][success], index_search[1][success]
+        out_gain[y, x] = mean[success]
+        out_counts[y, x] = dists[success].sum(axis=1)
+        out_std[y, x] = std[success]
+
+        return out_gain, out_counts, out_std
+
     for y, x in zip(*index_search):
-        dist = data_cube[:, y, x]
+        dist = np.zeros(len(data_cube))
+        dist[keep] = data_cube[keep, y, x]
 
         g, fit_g, success = fit_distribution(dist)
 
@@ -677,6 +1160,86 @@ def measure_gainimage(data_cube, mincounts=30, phlow=1, phhigh=31):
 
 #------------------------------------------------------------
 
+def _measure_band(args):
+    """measure_gainimage on rows y_start:y_end of a cube in shared memory"""
+
+    from multiprocessing import shared_memory
+
+    shm_name, shape, dtype, y_start, y_end, kwargs = args
+
+    shm = shared_memory.SharedMemory(name=shm_name)
+    data_cube = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    try:
+        result = measure_gainimage(data_cube[:, y_start:y_end], **kwargs)
+    finally:
+        #-- the view has to go before the segment can be closed
+        del data_cube
+        shm.close()
+
+    return y_start, y_end, result
+
+#------------------------------------------------------------
+
+def measure_gainimage_tiled(data_cube, num_cpu, band_size=None, **kwargs):
+    """ measure the modal gain at each pixel using num_cpu processes
+
+    The cube is copied once into shared memory and split into bands of
+    rows, which worker processes fit in place without copying.  The gain,
+    counts and std of each band are stitched back into full images.
+
+    Parameters
+    ----------
+    data_cube : np.ndarray
+        (n_pha, y, x) cube of pulse height images
+    num_cpu : int
+        number of worker processes
+    band_size : int, optional
+        rows per band, defaults to 4 bands per process
+    **kwargs
+        passed on to measure_gainimage
+
+    Returns
+    -------
+    out_gain, out_counts, out_std : np.ndarray
+        as returned by measure_gainimage
+    """
+
+    from multiprocessing import shared_memory
+
+    n_pha, ylen, xlen = data_cube.shape
+    band_size = band_size or max(1, -(-ylen // (4 * num_cpu)))
+
+    out_gain = np.zeros((ylen, xlen))
+    out_counts = np.zeros((ylen, xlen))
+    out_std = np.zeros((ylen, xlen))
+
+    shm = shared_memory.SharedMemory(create=True, size=max(1, data_cube.nbytes))
+    try:
+        shared_cube = np.ndarray(data_cube.shape, dtype=data_cube.dtype, buffer=shm.buf)
+        shared_cube[:] = data_cube
+
+        bands = [(shm.name, data_cube.shape, data_cube.dtype.str, y_start, min(y_start + band_size, ylen), kwargs)
+                    for y_start in range(0, ylen, band_size)]
+
+        pool = mp.Pool(processes=num_cpu)
+        try:
+            for y_start, y_end, (gain, counts, std) in pool.imap_unordered(_measure_band, bands):
+                out_gain[y_start:y_end] = gain
+                out_counts[y_start:y_end] = counts
+                out_std[y_start:y_end] = std
+        finally:
+            pool.close()
+            pool.join()
+
+        del shared_cube
+    finally:
+        shm.close()
+        shm.unlink()
+
+    return out_gain, out_counts, out_std
+
+#------------------------------------------------------------
+
 def fit_ok(fit, fitter, start_mean, start_amp, start_std):
 
     #-- Check for success in the LevMarLSQ fitting
@@ -706,9 +1269,16 @@ def fit_ok(fit, fitter, start_mean, start_amp, start_std):
 
 #-------------------------------------------------------------------------------
 
-def write_and_pull_gainmap(cci_name, out_dir=None):
+def write_and_pull_gainmap(cci_name, out_dir=None, num_cpu=1):
     """Make modal gainmap for cos cumulative image.
 
+    With num_cpu > 1 the gain of this one CCI is measured in parallel.
+
+    Returns
+    -------
+    columns : dict
+        gain table columns of every measured superpixel, see gainmap_columns
+
     """
 
     """
@@ -730,30 +1300,49 @@ def write_and_pull_gainmap(cci_name, out_dir=None):
 
     """
 
-    current = CCI(cci_name, xbinning=X_BINNING, ybinning=Y_BINNING)
+    current = CCI(cci_name, xbinning=X_BINNING, ybinning=Y_BINNING, num_cpu=num_cpu)
 
     out_name = os.path.join(out_dir, cci_name.replace('.fits', '_gainmap.fits'))
 
     logger.debug("writing gainmap to {}".format(out_name))
     current.write(out_name)
 
-    index = np.where(current.gain_image > 0)
+    return gainmap_columns(current)
 
-    info = {'segment': current.segment,
-            'dethv': int(current.dethv),
-            'expstart': round(current.expstart, 5)}
+#-------------------------------------------------------------------------------
 
-    if not len(index[0]):
-        yield info
-    else:
-        for y, x in zip(*index):
-            info['gain'] = round(float(current.gain_image[y, x]), 3)
-            info['counts'] = round(float(current.counts_image[y, x]), 3)
-            info['std'] = round(float(current.std_image[y, x]), 3)
-            info['x'] = int(x)
-            info['y'] = int(y)
+def gainmap_columns(current):
+    """Gain table columns for the measured superpixels of a CCI
 
-            yield info
+    Parameters
+    ----------
+    current : CCI
+        measured cumulative image
+
+    Returns
+    -------
+    columns : dict
+        x, y, gain, counts and std arrays of every superpixel with a gain,
+        along with the segment, dethv, expstart and year of the CCI.  Only
+        the scalars are given if no superpixel was measured, so the file
+        is still recorded in the table.
+    """
+
+    columns = {'segment': current.segment,
+               'dethv': int(current.dethv),
+               'expstart': round(current.expstart, 5),
+               'year': mjd_to_year(current.expstart)}
+
+    measured = current.gainmap()
+    if len(measured):
+        #-- rounded in float64, rounding float32 would not give 3 decimals
+        columns.update({'x': measured.x,
+                        'y': measured.y,
+                        'gain': np.round(measured.columns['GAIN'].astype(np.float64), 3),
+                        'counts': np.round(measured.columns['COUNTS'].astype(np.float64), 3),
+                        'std': np.round(measured.columns['STD'].astype(np.float64), 3)})
+
+    return columns
 
 
     """
@@ -803,6 +1392,163 @@ def fit_distribution(dist, start_mean=None, start_amp=None, start_std=None):
 
 #------------------------------------------------------------
 
+def gaussian(x, amplitude, mean, stddev):
+    """Evaluate a Gaussian, broadcasting over the parameters"""
+
+    return amplitude * np.exp(-0.5 * ((x - mean) / stddev)**2)
+
+#------------------------------------------------------------
+
+def fit_distributions(dists, start_mean=None, start_amp=None, start_std=None,
+                      maxiter=100, acc=1e-7, chunk_size=2**16):
+    """Fit a fixed-width Gaussian to many pulse height distributions at once
+
+    Vectorized counterpart of fit_distribution.  Amplitude and mean are
+    fit with Levenberg-Marquardt iterations run on all distributions
+    together, using the same starting values, mean bounds of [1, 30], and
+    fit_ok acceptance rules.
+
+    Parameters
+    ----------
+    dists : np.ndarray
+        (n_dists, n_pha) array of distributions
+    start_mean : float, optional
+        initial mean, defaults to the peak of each distribution
+    start_amp : float, optional
+        initial amplitude, defaults to the (truncated) maximum of each
+        distribution
+    start_std : float, optional
+        fixed width of the Gaussian, defaults to 1.05
+    maxiter : int, optional
+        maximum number of iterations
+    acc : float, optional
+        relative change in the residuals or parameters below which a fit
+        has converged
+    chunk_size : int, optional
+        number of distributions fit together, limits memory use
+
+    Returns
+    -------
+    amplitude, mean, stddev : np.ndarray
+        fit parameters of each distribution
+    success : np.ndarray
+        boolean array, True where the fit passes the fit_ok rules
+    """
+
+    dists = np.asarray(dists, dtype=np.float64)
+    n_dists, n_pha = dists.shape
+    x_vals = np.arange(n_pha, dtype=np.float64)
+
+    stddev = float(start_std or 1.05)
+
+    amplitude = np.zeros(n_dists)
+    mean = np.zeros(n_dists)
+    converged = np.zeros(n_dists, dtype=bool)
+
+    if start_mean:
+        mean0 = np.full(n_dists, float(start_mean))
+    else:
+        mean0 = dists.argmax(axis=1).astype(np.float64)
+
+    if start_amp:
+        amp0 = np.full(n_dists, float(start_amp))
+    else:
+        amp0 = np.trunc(dists.max(axis=1))
+
+    for start in range(0, n_dists, chunk_size):
+        chunk = slice(start, start + chunk_size)
+        amplitude[chunk], mean[chunk], converged[chunk] = _levmar_gaussian(dists[chunk],
+                                                                           x_vals,
+                                                                           amp0[chunk],
+                                                                           mean0[chunk],
+                                                                           stddev,
+                                                                           maxiter,
+                                                                           acc)
+
+    #-- fit_ok rules
+    with np.errstate(invalid='ignore'):
+        success = (converged &
+                   (amplitude >= 12) &
+                   (mean != mean0) &
+                   (amplitude != amp0) &
+                   ~np.isnan(mean) &
+                   (mean > 0) &
+                   (mean < 31))
+
+    return amplitude, mean, np.full(n_dists, stddev), success
+
+#------------------------------------------------------------
+
+def _levmar_gaussian(dists, x_vals, amplitude, mean, stddev, maxiter, acc, bounds=(1, 30)):
+    """Levenberg-Marquardt on amplitude and mean of each row of dists"""
+
+    amplitude = amplitude.copy()
+    mean = np.clip(mean, *bounds)
+    damping = np.full(len(dists), 1e-3)
+    converged = np.zeros(len(dists), dtype=bool)
+
+    def sum_sq(rows, amplitude, mean):
+        return ((dists[rows] - gaussian(x_vals, amplitude[:, None], mean[:, None], stddev))**2).sum(axis=1)
+
+    cost = sum_sq(slice(None), amplitude, mean)
+    active = np.arange(len(dists))
+
+    for i in range(maxiter):
+        if not len(active):
+            break
+
+        amp, mu, lam = amplitude[active], mean[active], damping[active]
+        shape = np.exp(-0.5 * ((x_vals - mu[:, None]) / stddev)**2)
+        resid = dists[active] - amp[:, None] * shape
+
+        #-- Jacobian of the model with respect to amplitude and mean
+        d_amp = shape
+        d_mean = amp[:, None] * shape * (x_vals - mu[:, None]) / stddev**2
+
+        h11 = (d_amp**2).sum(axis=1)
+        h12 = (d_amp * d_mean).sum(axis=1)
+        h22 = (d_mean**2).sum(axis=1)
+        g1 = (d_amp * resid).sum(axis=1)
+        g2 = (d_mean * resid).sum(axis=1)
+
+        a11 = h11 * (1 + lam)
+        a22 = h22 * (1 + lam)
+        det = a11 * a22 - h12**2
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            step_amp = (a22 * g1 - h12 * g2) / det
+            step_mean = (a11 * g2 - h12 * g1) / det
+
+        bad = ~np.isfinite(step_amp) | ~np.isfinite(step_mean)
+        step_amp[bad] = 0
+        step_mean[bad] = 0
+
+        new_amp = amp + step_amp
+        new_mean = np.clip(mu + step_mean, *bounds)
+        new_cost = sum_sq(active, new_amp, new_mean)
+
+        old_cost = cost[active]
+        better = new_cost <= old_cost
+
+        amplitude[active[better]] = new_amp[better]
+        mean[active[better]] = new_mean[better]
+        cost[active[better]] = new_cost[better]
+        damping[active] = np.where(better, lam / 10, lam * 10)
+
+        #-- converged once the residuals or the parameters stop changing
+        with np.errstate(divide='ignore', invalid='ignore'):
+            small_cost = better & ((old_cost - new_cost) <= acc * old_cost)
+            small_step = better & (np.abs(step_amp) <= acc * (np.abs(amp) + acc)) & \
+                                  (np.abs(new_mean - mu) <= acc * (np.abs(mu) + acc))
+        done = small_cost | small_step | bad
+
+        converged[active[done & ~bad]] = True
+        active = active[~done]
+
+    return amplitude, mean, converged
+
+#------------------------------------------------------------
+
 def get_previous(current_cci):
     """Populates list of CCI objects.
 
@@ -25,6 +25,10 @@ __status__ = 'Active'
 import os
 import shutil
 import time
+import json
+import hashlib
+import tempfile
+import multiprocessing as mp
 from datetime import datetime
 import glob
 import sys
@@ -35,27 +39,28 @@ logger = logging.getLogger(__name__)
 from astropy.io import fits
 import numpy as np
 import matplotlib as mpl
+mpl.use('Agg')
 import matplotlib.pyplot as plt
 from sqlalchemy.sql.functions import concat
 
 from ..database.db_tables import open_settings, load_connection
 from ..utils import send_email
+from ..utils.reffiles import get_catalog
 from .constants import *  #Shut yo face
 
 #------------------------------------------------------------
 
-def main(data_dir, run_regress=False):
+def main(data_dir, run_regress=False, num_cpu=1):
     """ Main driver for monitoring program.
     """
-    new_gsagtab = make_gsagtab_db(data_dir, blue=False)
-    blue_gsagtab = make_gsagtab_db(data_dir, blue=True)
+    new_gsagtab, blue_gsagtab = make_gsagtabs_db(data_dir)
 
     old_gsagtab = get_cdbs_gsagtab()
 
     compare_gsag(new_gsagtab, old_gsagtab, data_dir)
 
     if run_regress:
-        test_gsag_calibration(new_gsagtab)
+        test_gsag_calibration(new_gsagtab, num_cpu)
     else:
         print("Regression set skipped")
 
@@ -85,80 +90,184 @@ def get_index( gsag, segment, dethv ):
 
 #------------------------------------------------------------
 
-def compare_gsag(new, old, outdir):
-    """Compare two gainsag tables to see what has changed
+def index_extensions(gsag):
+    """Extension index of every (segment, dethv) in a gsagtab"""
+
+    index = {}
+    for i, ext in enumerate(gsag[1:]):
+        segment = ext.header['SEGMENT']
+        hv_string = 'HVLEVEL' + segment[-1].upper()
+        index.setdefault((segment, ext.header[hv_string]), i + 1)
+
+    return index
+
+#------------------------------------------------------------
+
+def _regions(data):
+    """(y, x, mjd) structured array of the regions in an extension, one per
+    (y, x) and sorted by it"""
+
+    regions = np.zeros(len(data), dtype=[('y', 'i8'), ('x', 'i8'), ('mjd', 'f8')])
+    regions['y'] = data['LY']
+    regions['x'] = data['LX']
+    regions['mjd'] = data['DATE']
+
+    regions = np.sort(regions, order=['y', 'x', 'mjd'])
+    first = np.ones(len(regions), dtype=bool)
+    first[1:] = (regions['y'][1:] != regions['y'][:-1]) | (regions['x'][1:] != regions['x'][:-1])
+
+    return regions[first]
+
+#------------------------------------------------------------
+
+def diff_regions(old_data, new_data):
+    """Join the regions of two gsagtab extensions on (y, x)
+
+    Returns
+    -------
+    added, removed : np.ndarray
+        (y, x, mjd) regions only in the new or only in the old extension
+    changed : np.ndarray
+        (y, x, old_mjd, new_mjd) regions in both with different MJDs
     """
-    ### Needs to be tested ###
 
-    logger.debug("Comparing new: {} to old: {}".format(new, old))
+    old_regions = _regions(old_data)
+    new_regions = _regions(new_data)
+
+    #-- (y, x) as one sortable key, x is below 2**32
+    old_keys = (old_regions['y'] << 32) + old_regions['x']
+    new_keys = (new_regions['y'] << 32) + new_regions['x']
+
+    in_new = np.isin(old_keys, new_keys, assume_unique=True)
+    in_old = np.isin(new_keys, old_keys, assume_unique=True)
+
+    #-- both are sorted by (y, x), so the common regions line up
+    common_old = old_regions[in_new]
+    common_new = new_regions[in_old]
+    differs = common_old['mjd'] != common_new['mjd']
+
+    changed = np.zeros(differs.sum(), dtype=[('y', 'i8'), ('x', 'i8'), ('old_mjd', 'f8'), ('new_mjd', 'f8')])
+    changed['y'] = common_old['y'][differs]
+    changed['x'] = common_old['x'][differs]
+    changed['old_mjd'] = common_old['mjd'][differs]
+    changed['new_mjd'] = common_new['mjd'][differs]
+
+    return new_regions[~in_old], old_regions[~in_new], changed
+
+#------------------------------------------------------------
+
+def diff_gsag(new, old):
+    """Differences between two gsagtabs
+
+    Parameters
+    ----------
+    new, old : str or HDUList
+        gsagtabs to compare
+
+    Returns
+    -------
+    diff : dict
+        'extensions' maps the (segment, dethv) of every extension in both
+        tables to {'added': regions, 'removed': regions, 'changed': regions}
+        (see diff_regions).  'only_new' and 'only_old' list the
+        (segment, dethv) found in one table only.
+    """
 
-    if type(new) == str:
+    if isinstance(new, str):
         new = fits.open(new)
-    if type(old) == str:
+    if isinstance(old, str):
         old = fits.open(old)
 
-    report_file = open(os.path.join(outdir, 'gsag_report.txt'), 'w')
+    new_index = index_extensions(new)
+    old_index = index_extensions(old)
 
-    possible_hv_levels = [0,100] + list(range(100,179))
+    diff = {'only_new': sorted(set(new_index) - set(old_index)),
+            'only_old': sorted(set(old_index) - set(new_index)),
+            'extensions': {}}
 
-    for segment,hv_keyword in zip( ['FUVA','FUVB'], ['HVLEVELA','HVLEVELB'] ):
-        new_hv = set( [ ext.header[hv_keyword] for ext in new[1:] if ext.header['SEGMENT'] == segment ] )
-        old_hv = set( [ ext.header[hv_keyword] for ext in old[1:] if ext.header['SEGMENT'] == segment ] )
+    for key in sorted(set(new_index) & set(old_index)):
+        added, removed, changed = diff_regions(old[old_index[key]].data, new[new_index[key]].data)
+        diff['extensions'][key] = {'added': added, 'removed': removed, 'changed': changed}
 
-        only_new_hv = new_hv.difference( old_hv )
-        only_old_hv = old_hv.difference( new_hv )
+    return diff
 
-        both_hv = list( new_hv.union( old_hv ) )
-        both_hv.sort()
+#------------------------------------------------------------
 
-        #assert ( len(only_old_hv) == 0 ),'There is an HV value found in the old table that is not found in the new.'
-        if len(only_old_hv) > 0:
-            logger.warning('There is an HV value found in the old table that is not found in the new.')
+def write_gsag_diff(diff, filename):
+    """Write a diff from diff_gsag as a FITS table, one row per region
 
-        if len( only_new_hv ):
-            logger.warning("There is at least one new extension, this file should probably be delivered")
-            report_file.write('There is at least one new extension, you should probably deliver this one \n')
-            report_file.write('New HV extensions:\n')
-            report_file.write(','.join( map(str,np.sort( list(only_new_hv) ) ) ) )
-            report_file.write('\n')
+    Columns are SEGMENT, DETHV, CHANGE (added, removed or mjd), Y, X,
+    OLD_MJD and NEW_MJD, with 0 for a missing MJD.
+    """
 
-        for hv in both_hv:
-            report_file.write( '#----- %d \n'%(hv) )
+    rows = []
+    for key, regions in sorted(diff['extensions'].items()):
+        segment, dethv = key
+        for row in regions['added']:
+            rows.append((segment, dethv, 'added', row['y'], row['x'], 0, row['mjd']))
+        for row in regions['removed']:
+            rows.append((segment, dethv, 'removed', row['y'], row['x'], row['mjd'], 0))
+        for row in regions['changed']:
+            rows.append((segment, dethv, 'mjd', row['y'], row['x'], row['old_mjd'], row['new_mjd']))
+
+    table = np.array(rows, dtype=[('SEGMENT', 'S4'), ('DETHV', 'i2'), ('CHANGE', 'S7'),
+                                  ('Y', 'i4'), ('X', 'i4'), ('OLD_MJD', 'f8'), ('NEW_MJD', 'f8')])
+
+    hdu_out = fits.HDUList(fits.PrimaryHDU())
+    hdu_out[0].header['NEW_HV'] = ' '.join('{}/{}'.format(*key) for key in diff['only_new'])
+    hdu_out[0].header['OLD_HV'] = ' '.join('{}/{}'.format(*key) for key in diff['only_old'])
+    hdu_out.append(fits.BinTableHDU(table, name='DIFF'))
+    hdu_out.writeto(filename, overwrite=True)
 
-            old_ext_index = get_index( old, segment, hv )
-            new_ext_index = get_index( new, segment, hv )
+#------------------------------------------------------------
 
-            if old_ext_index == -1:
-                logger.warning('%s %d: not found in old table'%(segment, hv))
-                continue
+def compare_gsag(new, old, outdir):
+    """Compare two gainsag tables to see what has changed
 
-            if new_ext_index == -1:
-                logger.warning('%s %d: not found in new table'%( segment, hv ))
-                continue
+    A text report is written to gsag_report.txt and the full diff to the
+    gsag_diff.fits table.
 
-            else:
-                old_ext = old[ old_ext_index ]
-                new_ext = new[ new_ext_index ]
+    Returns
+    -------
+    diff : dict
+        differences found by diff_gsag
+    """
 
-                #Get (y,x,mjd) triple for each flagged region.  Assumes binning is the same
-                old_regions = set( [ (y,x,mjd) for x,y,mjd in
-                                     zip(old_ext.data['ly'], old_ext.data['lx'], old_ext.data['Date']) ] )
+    logger.debug("Comparing new: {} to old: {}".format(new, old))
 
-                new_regions = set( [ (y,x,mjd) for x,y,mjd in
-                                     zip(new_ext.data['ly'], new_ext.data['lx'], new_ext.data['Date']) ] )
+    diff = diff_gsag(new, old)
+    write_gsag_diff(diff, os.path.join(outdir, 'gsag_diff.fits'))
 
-                #Strip triple down to (y,x) coordinate pair to check just locations
-                old_coords = set( [ (item[0],item[1]) for item in old_regions ] )
-                new_coords = set( [ (item[0],item[1]) for item in new_regions ] )
+    with open(os.path.join(outdir, 'gsag_report.txt'), 'w') as report_file:
+        for segment in ['FUVA', 'FUVB']:
+            only_new_hv = [hv for seg, hv in diff['only_new'] if seg == segment]
+            only_old_hv = [hv for seg, hv in diff['only_old'] if seg == segment]
 
-                only_old_coords = old_coords.difference( new_coords )
-                only_new_coords = new_coords.difference( old_coords )
-                both_coords = old_coords.union( new_coords )
+            if len(only_old_hv) > 0:
+                logger.warning('There is an HV value found in the old table that is not found in the new.')
 
-                N_old = len(only_old_coords)
-                N_new = len(only_new_coords)
+            if len( only_new_hv ):
+                logger.warning("There is at least one new extension, this file should probably be delivered")
+                report_file.write('There is at least one new extension, you should probably deliver this one \n')
+                report_file.write('New HV extensions:\n')
+                report_file.write(','.join( map(str,np.sort( list(only_new_hv) ) ) ) )
+                report_file.write('\n')
 
-                #pdb.set_trace()
+            all_hv = sorted(set([hv for seg, hv in diff['extensions'] if seg == segment]) | set(only_new_hv) | set(only_old_hv))
+            for hv in all_hv:
+                report_file.write( '#----- %d \n'%(hv) )
+
+                if hv in only_new_hv:
+                    logger.warning('%s %d: not found in old table'%(segment, hv))
+                    continue
+
+                if hv in only_old_hv:
+                    logger.warning('%s %d: not found in new table'%( segment, hv ))
+                    continue
+
+                regions = diff['extensions'][(segment, hv)]
+                N_old = len(regions['removed'])
+                N_new = len(regions['added'])
 
                 if not (N_old or N_new):
                     report_file.write( 'Nothing added or deleted \n')
@@ -166,70 +275,249 @@ def compare_gsag(new, old, outdir):
                 if N_old > 0:
                     logger.warning(' %s %d: You apparently got rid of %d from the old table'%(segment, hv, N_old))
                     report_file.write( '%d entries have been removed from the old table. \n'%(N_old) )
-                    report_file.write( '\n'.join( map(str,only_old_coords) ) )
+                    report_file.write( '\n'.join( str((y, x)) for y, x in zip(regions['removed']['y'], regions['removed']['x']) ) )
                     report_file.write('\n\n')
 
                 if N_new > 0:
                     logger.debug('%s %d: You added %d to the new table'%( segment, hv, N_new ))
                     report_file.write( '%d entries have been added to the new table. \n'%( N_new ) )
-                    report_file.write( '\n'.join( map(str,only_new_coords) )  )
+                    report_file.write( '\n'.join( str((y, x)) for y, x in zip(regions['added']['y'], regions['added']['x']) ) )
                     report_file.write('\n\n')
 
-                for old_y,old_x,old_mjd in old_regions:
-                    coord_pair = (old_y,old_x)
-                    if coord_pair not in both_coords: continue
+                for row in regions['changed']:
+                    mjd_difference = row['old_mjd'] - row['new_mjd']
+                    logger.debug('MJD difference of {} days at (y,x) {}'.format(mjd_difference, (row['y'], row['x'])))
+                    report_file.write( 'MJD difference of %5.7f days at (y,x):  (%d,%d)\n'%(mjd_difference, row['y'], row['x']) )
+
+    return diff
+
+#------------------------------------------------------------
+
+#-- Raw files CalCOS reads for a dataset, copied into its scratch directory
+INPUT_SUFFIXES = ('rawtag', 'rawtag_a', 'rawtag_b', 'rawaccum', 'rawaccum_a', 'rawaccum_b', 'spt')
+
+def dataset_inputs(rawtag):
+    """Raw files of the dataset of rawtag, sorted"""
 
-                    ###again, may be confusing syntax
-                    for new_y,new_x,new_mjd in new_regions:
-                        if (new_y,new_x) == coord_pair:
-                            break
+    root = os.path.join(os.path.dirname(rawtag), os.path.basename(rawtag)[:9])
 
-                    mjd_difference = old_mjd - new_mjd
-                    if mjd_difference:
-                        logger.debug('MJD difference of {} days at (y,x) {}'.format(mjd_difference, coord_pair))
-                        report_file.write( 'MJD difference of %5.7f days at (y,x):  (%d,%d)'%(mjd_difference,coord_pair[0],coord_pair[1]) )
+    return sorted(item for item in glob.glob(root + '_*.fits')
+                  if os.path.basename(item)[10:-5] in INPUT_SUFFIXES)
 
 #------------------------------------------------------------
 
-def test_gsag_calibration(gsagtab):
-    """Move gsagtab into TEST_DIR and calibrate with CalCOS.
+def _hash_files(filenames):
+    """sha1 of the names and contents of filenames"""
 
-    Any datasets that fail calibration will be emailed to the user.
+    digest = hashlib.sha1()
+    for item in filenames:
+        digest.update(os.path.basename(item).encode())
+        with open(item, 'rb') as f:
+            for chunk in iter(lambda: f.read(2**20), b''):
+                digest.update(chunk)
+
+    return digest.hexdigest()
+
+#------------------------------------------------------------
+
+def gsag_hash(gsagtab, inputs):
+    """sha1 of the gsagtab extensions a dataset uses
+
+    CalCOS only reads the extension matching the segment and HVLEVEL of
+    each raw file, so other changes to the table do not change the hash.
+    The whole table is hashed if a raw file has no HVLEVEL keyword.
     """
-    print('#-------------------------#')
-    print('Calibrating with %s'%(gsagtab))
-    print('#-------------------------#')
 
-    os.environ['testdir'] = TEST_DIR
-    if not os.path.exists(TEST_DIR):
-        os.mkdir(TEST_DIR)
-    shutil.copy( gsagtab ,os.path.join(TEST_DIR,'new_gsag.fits') )
+    digest = hashlib.sha1()
+    with fits.open(gsagtab) as gsag:
+        index = index_extensions(gsag)
+
+        for item in inputs:
+            with fits.open(item) as hdu:
+                segment = hdu[0].header.get('SEGMENT', None)
+                if not segment in ('FUVA', 'FUVB'):
+                    continue
+
+                hv_string = 'HVLEVEL' + segment[-1]
+                dethv = hdu[1].header.get(hv_string, hdu[0].header.get(hv_string, None))
 
-    test_datasets = glob.glob( os.path.join(TEST_DIR, '*rawtag_a.fits') )
+            if dethv is None or not (segment, dethv) in index:
+                return _hash_files([gsagtab])
+
+            data = gsag[index[(segment, dethv)]].data
+            digest.update('{} {}'.format(segment, dethv).encode())
+            for column in ('DATE', 'LX', 'LY', 'DX', 'DY', 'DQ'):
+                digest.update(np.ascontiguousarray(data[column]).tobytes())
+
+    return digest.hexdigest()
+
+#------------------------------------------------------------
 
-    #Remove products
-    for ext in ('*_counts*.fits','*_flt*.fits','*_x1d*.fits','*lampflash*.fits','*corrtag*.fits'):
-        os.system('rm '+TEST_DIR+'/'+ext)
+def reference_stamp(inputs, directory=None):
+    """Names and mtimes of the $lref reference files a dataset uses
 
-    for item in test_datasets:
-        fits.setval( item,'RANDSEED',value=8675309,ext=0 )
-        fits.setval( item,'GSAGTAB',value='testdir$new_gsag.fits',ext=0 )
+    Every lref$ keyword of the primary headers but GSAGTAB, which is
+    replaced by the candidate table, is resolved in directory.  A newly
+    delivered or rewritten file changes the stamp.
+
+    Parameters
+    ----------
+    inputs : list
+        raw files of the dataset
+    directory : str, optional
+        reference file directory, $lref by default
+
+    Returns
+    -------
+    stamp : str
+        'name mtime' of each reference file, sorted by name, with an mtime
+        of None for missing files
+    """
 
-    failed_runs = []
-    for item in test_datasets:
+    directory = directory or os.environ['lref']
+
+    names = set()
+    for item in inputs:
+        for key, value in fits.getheader(item, 0).items():
+            if key != 'GSAGTAB' and isinstance(value, str) and value.startswith('lref$'):
+                names.add(value[len('lref$'):].strip())
+
+    stamps = []
+    for name in sorted(names):
         try:
-            status = calcos.calcos( item,outdir=TEST_DIR )
-            print(("CalCOS exit status is",status))
-        except:
-            failed_runs.append( item )
+            mtime = os.stat(os.path.join(directory, name)).st_mtime
+        except OSError:
+            mtime = None
+        stamps.append('{} {}'.format(name, mtime))
+
+    return '\n'.join(stamps)
+
+#------------------------------------------------------------
+
+def run_regression_dataset(args):
+    """Calibrate one dataset with a gsagtab in its own scratch directory
+
+    Successful runs are kept in cache_dir.  The products of a failed run
+    are left in its scratch directory, and it is run again next time.
+
+    Parameters
+    ----------
+    args : tuple
+        (rawtag, gsagtab, cache_dir, reference stamp) of the dataset, see
+        reference_stamp
+
+    Returns
+    -------
+    rawtag : str
+        the dataset
+    status : int
+        CalCOS exit status, None if CalCOS raised
+    out_dir : str
+        directory holding the products
+    """
+
+    import calcos
+
+    rawtag, gsagtab, cache_dir, references = args
+    inputs = dataset_inputs(rawtag)
+
+    key = hashlib.sha1('{} {} {} {}'.format(_hash_files(inputs),
+                                            gsag_hash(gsagtab, inputs),
+                                            references,
+                                            calcos.__version__).encode()).hexdigest()
+    out_dir = os.path.join(cache_dir, key)
+    status_file = os.path.join(out_dir, 'status.json')
+
+    if os.path.exists(status_file):
+        with open(status_file) as f:
+            status = json.load(f)['status']
+        logger.debug("{}: cached in {}".format(os.path.basename(rawtag), out_dir))
+        return rawtag, status, out_dir
+
+    scratch = tempfile.mkdtemp(prefix='calcos_', dir=cache_dir)
+    for item in inputs:
+        shutil.copy(item, scratch)
+
+    scratch_rawtag = os.path.join(scratch, os.path.basename(rawtag))
+    with fits.open(scratch_rawtag, mode='update') as hdu:
+        hdu[0].header['RANDSEED'] = 8675309
+        hdu[0].header['GSAGTAB'] = gsagtab
+
+    try:
+        status = calcos.calcos(scratch_rawtag, outdir=os.path.join(scratch, 'out'))
+    except Exception as e:
+        logger.warning("{}: CalCOS failed with {}".format(os.path.basename(rawtag), e))
+        shutil.rmtree(scratch)
+        return rawtag, None, None
+
+    if status != 0:
+        logger.warning("{}: CalCOS returned {}, products left in {}".format(os.path.basename(rawtag), status, scratch))
+        return rawtag, status, os.path.join(scratch, 'out')
+
+    with open(os.path.join(scratch, 'out', 'status.json'), 'w') as f:
+        json.dump({'status': status, 'rawtag': rawtag, 'gsagtab': gsagtab}, f)
+
+    try:
+        os.rename(os.path.join(scratch, 'out'), out_dir)
+    except OSError:
+        #-- another run stored the same result first
+        pass
+    shutil.rmtree(scratch)
+
+    return rawtag, status, out_dir
+
+#------------------------------------------------------------
+
+def test_gsag_calibration(gsagtab, num_cpu=1, cache_dir=None):
+    """Calibrate the datasets in TEST_DIR with a gsagtab using CalCOS.
+
+    Each dataset is calibrated in its own scratch directory, num_cpu at a
+    time.  Products of successful runs are kept in cache_dir under a hash
+    of the raw files, the gsagtab extensions and other reference files
+    they use, so datasets the new table does not change are not
+    calibrated again.
+
+    Any datasets that fail calibration will be emailed to the user.
+
+    Parameters
+    ----------
+    gsagtab : str
+        candidate gsagtab
+    num_cpu : int, optional
+        number of CalCOS processes
+    cache_dir : str, optional
+        directory of cached products, TEST_DIR/cache by default
+
+    Returns
+    -------
+    results : dict
+        (status, product directory) of each rawtag
+    """
+
+    logger.info('Calibrating with {}'.format(gsagtab))
 
-        if status != 0:
-            failed_runs.append( item )
+    cache_dir = cache_dir or os.path.join(TEST_DIR, 'cache')
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+
+    gsagtab = os.path.abspath(gsagtab)
+    test_datasets = sorted(glob.glob(os.path.join(TEST_DIR, '*rawtag_a.fits')))
+    jobs = [(item, gsagtab, cache_dir, reference_stamp(dataset_inputs(item))) for item in test_datasets]
+
+    if num_cpu > 1:
+        pool = mp.Pool(processes=num_cpu)
+        results = pool.map(run_regression_dataset, jobs)
+        pool.close()
+        pool.join()
+    else:
+        results = [run_regression_dataset(job) for job in jobs]
+
+    failed_runs = [rawtag for rawtag, status, out_dir in results if status != 0]
 
     if len(failed_runs):
         send_email(subject='GSAGTAB Calibration Error',message='Failed calibration\n\n'+'\n'+'\n'.join(failed_runs) )
 
-    ###Now run some quick test.
+    return {rawtag: (status, out_dir) for rawtag, status, out_dir in results}
 
 #------------------------------------------------------------
 
@@ -310,7 +598,7 @@ def send_forms(data_dir):
 
     message += os.getcwd()+'\n'
     here = os.getcwd()
-    os.system('ls -la gsag_%s.fits > tmp.txt'%(TIMESTAMP) )
+    os.system('ls -la gsag_%s.fits > tmp.txt'%(timestamp()) )
     tmp = open('tmp.txt','r')
     for line in tmp.readlines():
         message += line
@@ -364,36 +652,36 @@ def populate_down(gsag_file):
         all_hv = [ (ext.header[hv_keyword],i+1) for i,ext in enumerate(gsagtab[1:]) if ext.header['segment'] == segment ]
         all_hv.sort()
 
-        for current_dethv,current_ext in all_hv:
-            current_lines = [ tuple(line) for line in gsagtab[current_ext].data[0].array ]
-            current_coords= [ (line[1],line[2]) for line in current_lines ]
-            N_changes = 0
+        #-- Sweep from the highest HV down, carrying the earliest line of
+        #-- every (lx, ly) flagged at any higher HV.  On equal MJDs the
+        #-- line from the lowest HV is kept.
+        higher = {}
 
-            for higher_dethv,higher_ext in all_hv:
-                if not (higher_dethv > current_dethv):
-                    continue
-                higher_lines = [ tuple(line) for line in gsagtab[higher_ext].data[0].array ]
-                higher_coords= [ (line[1],line[2]) for line in higher_lines ]
+        for current_dethv,current_ext in all_hv[::-1]:
+            current_lines = [ tuple(line) for line in gsagtab[current_ext].data ]
+            position = {}
+            for i, line in enumerate(current_lines):
+                position.setdefault( (line[1],line[2]), i )
+            N_changes = 0
 
-                for coord, line in zip(higher_coords,higher_lines):
-                    if not (coord in current_coords):
-                        # If coordinate from higher HV is not in current HV, append
-                        current_lines.append( line )
-                        current_coords.append( (line[1],line[2]) )
-                        N_changes += 1
+            for coord, line in higher.items():
+                index = position.get( coord )
 
-                    else:
-                        # If coordinated from higher HV is in current HV,
-                        # check to see if MJD is earlier.  If yes, take new value.
-                        # MJD is first element in tuple e.g. line[0]
-                        index = current_coords.index( coord )
-                        current_line = current_lines[index]
+                if index is None:
+                    # If coordinate from higher HV is not in current HV, append
+                    position[coord] = len(current_lines)
+                    current_lines.append( line )
+                    N_changes += 1
 
-                        if line[0] < current_line[0]:
-                            current_lines[ index ] = line
-                            print(('--Earlier time found',line[0],'-->',current_line[0]))
-                            N_changes += 1
+                elif line[0] < current_lines[index][0]:
+                    # If coordinated from higher HV is in current HV,
+                    # check to see if MJD is earlier.  If yes, take new value.
+                    # MJD is first element in tuple e.g. line[0]
+                    print(('--Earlier time found',line[0],'-->',current_lines[index][0]))
+                    current_lines[ index ] = line
+                    N_changes += 1
 
+            higher = { coord:current_lines[index] for coord, index in position.items() }
 
             if N_changes:
                 print(('Updating %s/%d ext:%d with %d changes'%(segment,current_dethv,current_ext,N_changes)))
@@ -408,7 +696,7 @@ def populate_down(gsag_file):
             else:
                 print(('No Changes to %s/%d ext:%d '%(segment,current_dethv,current_ext)))
 
-    gsagtab.writeto(gsag_file,clobber=True)
+    gsagtab.writeto(gsag_file,overwrite=True)
 
 #------------------------------------------------------------
 
@@ -479,7 +767,7 @@ def make_gsagtab():
     new_gsagtab.fits
     """
     logger.info('Making new GSAGTAB')
-    out_fits = os.path.join(MONITOR_DIR,'gsag_%s.fits'%(TIMESTAMP) )
+    out_fits = os.path.join(MONITOR_DIR,'gsag_%s.fits'%(timestamp()) )
     input_list = glob.glob(os.path.join(MONITOR_DIR,'flagged_bad_??_cci_???.txt'))
     input_list.sort()
 
@@ -597,60 +885,144 @@ def in_boundary(segment, ly, dy):
 
 #------------------------------------------------------------
 
-def make_gsagtab_db(out_dir, blue=False):
-    """Create GSAGTAB from flagged locations.
+def in_boundaries(segment, ly, dy):
+    """Vectorized in_boundary over arrays of ly and dy"""
 
-    Grabs txt files of flagged bad regions from MONITOR_DIR
-    and combines them into a gsagtab.
+    boundary = {'FUVA': 493, 'FUVB': 557}
+    padding = 4
+
+    ly = np.asarray(ly)
+    dy = np.asarray(dy)
+
+    return (ly <= boundary[segment] + padding) & (ly + dy >= boundary[segment] - padding)
+
+#------------------------------------------------------------
+
+def first_flagged_dates(segment, dethv, x, y, mjd, hv_levels):
+    """Earliest flagged date of every superpixel at each HV level
+
+    A superpixel flagged at some DETHV is bad at every lower HV level as
+    well, so the date at an HV level is the earliest date it was flagged
+    at that level or any higher one.  This is found for all superpixels
+    and levels at once with a cumulative minimum over descending HV.
 
     Parameters
     ----------
-    None
+    segment, dethv, x, y, mjd : np.ndarray
+        columns of the flagged table
+    hv_levels : list
+        HV levels to give dates for
 
     Returns
     -------
-    None
-
-    Products
-    --------
-    new_gsagtab.fits
+    dates : dict
+        {(segment, hv_level): (x, y, mjd)} arrays of the flagged superpixels
     """
 
-    out_fits = os.path.join(out_dir, 'gsag_%s.fits'%(TIMESTAMP))
-    #Populates regions found in HV == X, Segment Y, to any
-    #extensions of lower HV for same segment.
+    segment = np.asarray(segment)
+    dethv = np.asarray(dethv)
+    mjd = np.asarray(mjd, dtype=np.float64)
+    pixel = np.asarray(y, dtype=np.int64) * XLEN + np.asarray(x, dtype=np.int64)
 
-    hdu_out=fits.HDUList(fits.PrimaryHDU())
+    hv_levels = np.sort(hv_levels)
+
+    dates = {}
+    for seg in np.unique(segment):
+        in_seg = segment == seg
+
+        #-- highest HV level each row applies to
+        level = np.searchsorted(hv_levels, dethv[in_seg], side='right') - 1
+        use = level >= 0
+
+        pixels, index = np.unique(pixel[in_seg][use], return_inverse=True)
+
+        first = np.full((len(pixels), len(hv_levels)), np.inf)
+        np.minimum.at(first, (index, level[use]), mjd[in_seg][use])
+        first = np.minimum.accumulate(first[:, ::-1], axis=1)[:, ::-1]
+
+        for i, hv_level in enumerate(hv_levels):
+            found = np.isfinite(first[:, i])
+            dates[(seg, int(hv_level))] = (pixels[found] % XLEN,
+                                           pixels[found] // XLEN,
+                                           first[found, i])
+
+    return dates
+
+#------------------------------------------------------------
+
+def gsagtab_primary(blue=False):
+    """Primary header HDU of a GSAGTAB"""
+
+    hdu = fits.PrimaryHDU()
     date_time = str(datetime.now())
     date_time = date_time.split()[0]+'T'+date_time.split()[1]
-    hdu_out[0].header['DATE'] = (date_time, 'Creation UTC (CCCC-MM-DD) date')
-    hdu_out[0].header['TELESCOP'] = 'HST'
-    hdu_out[0].header['INSTRUME'] = 'COS'
-    hdu_out[0].header['DETECTOR'] = 'FUV'
-    hdu_out[0].header['COSCOORD'] = 'USER'
-    hdu_out[0].header['VCALCOS'] = '2.0'
-    hdu_out[0].header['USEAFTER'] = 'May 11 2009 00:00:00'
-    hdu_out[0].header['CENWAVE'] = 'N/A'
+    hdu.header['DATE'] = (date_time, 'Creation UTC (CCCC-MM-DD) date')
+    hdu.header['TELESCOP'] = 'HST'
+    hdu.header['INSTRUME'] = 'COS'
+    hdu.header['DETECTOR'] = 'FUV'
+    hdu.header['COSCOORD'] = 'USER'
+    hdu.header['VCALCOS'] = '2.0'
+    hdu.header['USEAFTER'] = 'May 11 2009 00:00:00'
+    hdu.header['CENWAVE'] = 'N/A'
 
     today_string = date_string(datetime.now())
-    hdu_out[0].header['PEDIGREE'] = 'INFLIGHT 25/05/2009 %s'%(today_string)
-    hdu_out[0].header['FILETYPE'] = 'GAIN SAG REFERENCE TABLE'
+    hdu.header['PEDIGREE'] = 'INFLIGHT 25/05/2009 %s'%(today_string)
+    hdu.header['FILETYPE'] = 'GAIN SAG REFERENCE TABLE'
 
     descrip_string = 'Gives locations of gain-sag regions as of %s'%( str(datetime.now().date() ))
     while len(descrip_string) < 67:
         descrip_string += '-'
-    hdu_out[0].header['DESCRIP'] = descrip_string
-    hdu_out[0].header['COMMENT'] = ("= 'This file was created by J. Ely'")
-    hdu_out[0].header.add_history('Flagged regions in higher voltages have been backwards populated')
-    hdu_out[0].header.add_history('to all lower HV levels for the same segment.')
-    hdu_out[0].header.add_history('')
-    hdu_out[0].header.add_history('A region will be flagged as bad when the detected')
-    hdu_out[0].header.add_history('flux is found to drop by 5%.  This happens when')
-    hdu_out[0].header.add_history('the measured modal gain of a region falls to ')
-    hdu_out[0].header.add_history('%d given current lower pulse height filtering.'%(MODAL_GAIN_LIMIT) )
+    hdu.header['DESCRIP'] = descrip_string
+    hdu.header['COMMENT'] = ("= 'This file was created by J. Ely'")
+    hdu.header.add_history('Flagged regions in higher voltages have been backwards populated')
+    hdu.header.add_history('to all lower HV levels for the same segment.')
+    hdu.header.add_history('')
+    hdu.header.add_history('A region will be flagged as bad when the detected')
+    hdu.header.add_history('flux is found to drop by 5%.  This happens when')
+    hdu.header.add_history('the measured modal gain of a region falls to ')
+    hdu.header.add_history('%d given current lower pulse height filtering.'%(MODAL_GAIN_LIMIT) )
+
+    if blue:
+        hdu.header['CENWAVE'] = 'BETWEEN 1055 1097'
+
+        descrip_string = 'Blue-mode gain-sag regions as of %s'%(str(datetime.now().date()))
+        while len(descrip_string) < 67:
+            descrip_string += '-'
+        hdu.header['DESCRIP'] = descrip_string
+
+    return hdu
 
-    possible_hv_strings = ['000', '100'] + list(map(str, list(range(142, 179))))
+#------------------------------------------------------------
+
+def make_gsagtabs_db(out_dir):
+    """Create the normal and blue-mode GSAGTABs from flagged locations.
 
+    The flagged table is read once and the first flagged date of every
+    region at every HV level is found for both tables in the same pass.
+    Regions near the boundary between the blue and normal modes are left
+    out of the blue-mode table.
+
+    Parameters
+    ----------
+    out_dir : str
+        directory to write the tables to
+
+    Returns
+    -------
+    out_fits, blue_fits : str
+        names of the normal and blue-mode GSAGTABs
+
+    Products
+    --------
+    gsag_<timestamp>.fits and gsag_<timestamp>_blue.fits
+    """
+
+    out_fits = os.path.join(out_dir, 'gsag_%s.fits'%(timestamp()))
+    blue_fits = out_fits.replace('.fits', '_blue.fits')
+
+    #Populates regions found in HV == X, Segment Y, to any
+    #extensions of lower HV for same segment.
+    possible_hv_levels = [0, 100] + list(range(142, 179))
 
     SETTINGS = open_settings()
     Session, engine = load_connection(SETTINGS['connection_string'])
@@ -661,86 +1033,78 @@ def make_gsagtab_db(out_dir, blue=False):
 
     segments = [item[0] for item in results]
 
-    for seg in segments:
-        hvlevel_string = 'HVLEVEL' + seg[-1].upper()
+    results = connection.execute("""SELECT segment, dethv, x, y, mjd
+                                    FROM flagged
+                                    WHERE concat(x,y) IS NOT NULL""").fetchall()
 
-        for hv_level in possible_hv_strings:
-            date = []
-            lx = []
-            dx = []
-            ly = []
-            dy = []
-            dq = []
+    connection.close()
+    engine.dispose()
 
-            hv_level = int(hv_level)
-
-            results = connection.execute("""SELECT DISTINCT x,y
-                                            FROM flagged WHERE segment='%s'
-                                            and dethv>='%s'
-                                            and concat(x,y) IS NOT NULL
-                                            """
-                                            %(seg, hv_level)
-                                            )
-
-            coords = [(item[0], item[1]) for item in results]
-
-            for x, y in coords:
-                results = connection.execute("""SELECT MJD
-                                                FROM flagged
-                                                WHERE segment='%s'
-                                                AND x='%s'
-                                                AND y='%s'
-                                                AND dethv>='%s'
-                                                AND concat(x,y) IS NOT NULL
-                                                """
-                                                %(seg, x, y, hv_level)
-                                                )
-
-                flagged_dates = [item[0] for item in results]
-                if len(flagged_dates):
-                    bad_date = min(flagged_dates)
-                else:
-                    continue
+    columns = list(zip(*results)) if len(results) else [[]] * 5
+    dates = first_flagged_dates(*columns, hv_levels=possible_hv_levels)
 
-                if blue and in_boundary(seg, y*Y_BINNING, Y_BINNING):
-                    logger.debug("Excluding for blue modes: {} {} {}".format(seg, y*Y_BINNING, Y_BINNING))
-                    continue
+    outputs = {}
+    for blue, filename in ((False, out_fits), (True, blue_fits)):
+        hdu_out = fits.HDUList(gsagtab_primary(blue))
 
+        for seg in segments:
+            hvlevel_string = 'HVLEVEL' + seg[-1].upper()
 
-                lx.append(x*X_BINNING)
-                dx.append(X_BINNING)
-                ly.append(y*Y_BINNING)
-                dy.append(Y_BINNING)
-                date.append(bad_date)
-                dq.append(8192)
+            for hv_level in possible_hv_levels:
+                x, y, bad_date = dates.get((seg, hv_level), ([], [], []))
 
-            if not len(lx):
-                #Extension tables cannot have 0 entries, a
-                #region of 0 extent centered on (0,0) is
-                #sufficient to prevent CalCOS crash.
-                lx.append(0)
-                ly.append(0)
-                dx.append(0)
-                dy.append(0)
-                date.append(0)
-                dq.append(8192)
-
-            logger.debug('found {} bad regions'.format(len(date)))
-            tab = gsagtab_extension(date, lx, dx, ly, dy, dq, hv_level, hvlevel_string, seg)
-            hdu_out.append(tab)
+                lx = np.asarray(x, dtype=np.int64) * X_BINNING
+                ly = np.asarray(y, dtype=np.int64) * Y_BINNING
+                date = np.asarray(bad_date, dtype=np.float64)
 
-    if blue:
-        out_fits = out_fits.replace('.fits', '_blue.fits')
-        hdu_out[0].header['CENWAVE'] = 'BETWEEN 1055 1097'
+                if blue:
+                    keep = ~in_boundaries(seg, ly, Y_BINNING)
+                    logger.debug("Excluding {} regions for blue modes: {} {}".format((~keep).sum(), seg, hv_level))
+                    lx, ly, date = lx[keep], ly[keep], date[keep]
 
-        descrip_string = 'Blue-mode gain-sag regions as of %s'%(str(datetime.now().date()))
-        while len(descrip_string) < 67:
-            descrip_string += '-'
-        hdu_out[0].header['DESCRIP'] = descrip_string
+                dx = np.full(len(lx), X_BINNING)
+                dy = np.full(len(lx), Y_BINNING)
+                dq = np.full(len(lx), 8192)
 
-    hdu_out.writeto(out_fits, clobber=True)
-    logger.info('WROTE: GSAGTAB to %s'%(out_fits))
-    return out_fits
+                if not len(lx):
+                    #Extension tables cannot have 0 entries, a
+                    #region of 0 extent centered on (0,0) is
+                    #sufficient to prevent CalCOS crash.
+                    lx, ly, dx, dy, date, dq = [0], [0], [0], [0], [0], [8192]
+
+                logger.debug('found {} bad regions'.format(len(date)))
+                tab = gsagtab_extension(date, lx, dx, ly, dy, dq, hv_level, hvlevel_string, seg)
+                hdu_out.append(tab)
+
+        hdu_out.writeto(filename, overwrite=True)
+        logger.info('WROTE: GSAGTAB to %s'%(filename))
+
+    return out_fits, blue_fits
+
+#------------------------------------------------------------
+
+def make_gsagtab_db(out_dir, blue=False):
+    """Create GSAGTAB from flagged locations.
+
+    Both tables are made by make_gsagtabs_db, this returns the one asked
+    for.
+
+    Parameters
+    ----------
+    out_dir : str
+        directory to write the tables to
+    blue : bool, optional
+        return the blue-mode table
+
+    Returns
+    -------
+    out_fits : str
+        name of the GSAGTAB
+    """
+
+    out_fits, blue_fits = make_gsagtabs_db(out_dir)
+
+    return blue_fits if blue else out_fits
 
 #------------------------------------------------------------
 
@@ -748,10 +1112,6 @@ def get_cdbs_gsagtab():
     """Retrieve most recently delivered GSAGTAB from CDBS
     for comparison with the one just made.
     """
-    gsag_tables = glob.glob(os.path.join(os.environ['lref'], '*gsag.fits'))
-    creation_dates = np.array([fits.getval(item, 'DATE') for item in gsag_tables])
-    current_gsagtab = gsag_tables[creation_dates.argmax()]
-
-    return current_gsagtab
+    return get_catalog().latest('gsag')
 
 #------------------------------------------------------------
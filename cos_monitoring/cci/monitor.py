@@ -26,6 +26,7 @@ __status__ = 'Active'
 import os
 import sys
 from astropy.io import fits
+from astropy.time import Time
 import matplotlib as mpl
 mpl.use("Agg")
 import matplotlib.pyplot as plt
@@ -38,7 +39,7 @@ logger = logging.getLogger(__name__)
 #from bokeh import charts
 #from bokeh.plotting import figure
 
-from .gainmap import make_all_hv_maps, make_all_gainmaps, make_total_gain
+from .gainmap import make_all_gainmaps, make_total_gain, read_gainmap
 from ..utils import enlarge, send_email
 from .findbad import time_trends
 from .gsag import main as gsag_main
@@ -62,13 +63,13 @@ def make_quicklooks(gainmap, clobber=True):
         if not clobber:
             return
 
-    hdu = fits.open(gainmap)
+    header = fits.getheader(gainmap, 0)
 
-    image = enlarge(hdu['MOD_GAIN'].data, y=Y_BINNING, x=X_BINNING)
+    image = enlarge(read_gainmap(gainmap).dense('GAIN'), y=Y_BINNING, x=X_BINNING)
 
-    DETHV = hdu[0].header['DETHV']
-    EXPSTART = hdu[0].header['EXPSTART']
-    SEGMENT = hdu[0].header['SEGMENT']
+    DETHV = header['DETHV']
+    EXPSTART = header['EXPSTART']
+    SEGMENT = header['SEGMENT']
 
     if SEGMENT == 'FUVA':
         lower_ext = 1
@@ -160,18 +161,26 @@ def make_cumulative_plots():
     """
 
     print('Making cumulative gainmaps')
+    now = Time.now().mjd
     for filename in glob.glob(os.path.join(MONITOR_DIR, '*proj_bad*.fits')):
         hdu = fits.open(filename)
 
         dethv = hdu[0].header['DETHV']
         segment = hdu[0].header['SEGMENT']
 
+        #-- gain projected to today by the fitted trends, 0 where none was fit
+        slope = hdu['SLOPE'].data
+        intercept = hdu['INTERCEPT'].data
+        gain_image = np.where(intercept != 0, slope * now + intercept, 0)
+
         fig = plt.figure(figsize=(25, 14))
         ax = fig.add_subplot(1, 1, 1)
-        gain_image = enlarge(hdu['PROJGAIN'].data,
-                             y=1024//hdu['PROJGAIN'].header['NAXIS2'],
-                             x=16384//hdu['PROJGAIN'].header['NAXIS1'])
-        cax = ax.imshow(gain_image, aspect='auto')
+        #-- drawn over the full detector, without enlarging the binned image
+        cax = ax.imshow(gain_image,
+                        aspect='auto',
+                        origin='lower',
+                        extent=(0, gain_image.shape[1] * hdu[0].header['XBINNING'],
+                                0, gain_image.shape[0] * hdu[0].header['YBINNING']))
         plot_flagged(ax, segment, dethv, color='white')
         ax.set_xlim(0, 16384)
         ax.set_ylim(0, 1024)
@@ -195,7 +204,7 @@ def plot_flagged(ax, segment, hv, mjd=50000, color='r'):
     if hv == -1:
         return
 
-    gsagtab_filename = '/grp/hst/cos/Monitors/CCI/gsag_%s.fits'% (TIMESTAMP)
+    gsagtab_filename = '/grp/hst/cos/Monitors/CCI/gsag_%s.fits'% (timestamp())
     if os.path.exists(gsagtab_filename):
         gsagtab = fits.open(gsagtab_filename)
         print("Using {}".format(gsagtab_filename))
@@ -286,8 +295,8 @@ def monitor():
     #make_all_gainmaps()
 
     make_phaimages(out_dir)
-    time_trends(out_dir)
-    gsag_main(out_dir)
+    time_trends(out_dir, rebuild=settings.get('rebuild_trends', False))
+    gsag_main(out_dir, num_cpu=settings.get('num_cpu', 1))
 
     #-- quicklooks
     all_gainmaps = glob.glob(os.path.join(out_dir, '*gainmap*.fits'))
@@ -299,7 +308,7 @@ def monitor():
 
     ###make_cumulative_plots()
 
-    #message = 'CCI Monitor run for %s complete.  \n'% (TIMESTAMP)
+    #message = 'CCI Monitor run for %s complete.  \n'% (timestamp())
     #message += '\n'
     #message += 'Calibration with CalCOS has finished \n '
     #message += 'Check over the gsagtab comparison log and see if we need to deliver this file.\n\n\n'
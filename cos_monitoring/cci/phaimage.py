@@ -18,6 +18,7 @@ from astropy.io import fits
 import numpy as np
 
 from ..utils import enlarge, rebin
+from .gainmap import total_gain_at_hv, read_gainmap
 from .constants import * #It's already been said
 
 #------------------------------------------------------------
@@ -106,24 +107,15 @@ class Phaimage:
         self.DETHVA = a_hdu[0].header['DETHV']
         self.DETHVB = b_hdu[0].header['DETHV']
 
-        self.a_image = a_hdu['MOD_GAIN'].data.copy()
-        self.b_image = b_hdu['MOD_GAIN'].data.copy()
+        self.a_image = read_gainmap(self.a_file).dense('GAIN')
+        self.b_image = read_gainmap(self.b_file).dense('GAIN')
 
 
 
     def fill_gaps(self, image, segment, dethv ):
         """ Fill in gaps with available accumulated and extrapolated maps """
 
-        dethv = int( dethv )
-
-        extname = '{}INIT'.format( segment )
-        fill_data = fits.getdata( os.path.join( MONITOR_DIR, 'total_gain.fits' ),
-                                    ext=(extname, 1 ) )
-
-        fill_data = rebin( fill_data, bins=(Y_BINNING, X_BINNING) ) / float((Y_BINNING * X_BINNING))
-
-        index = np.where( fill_data > 0 )
-        fill_data[ index ] += .393 * (dethv - 178)
+        fill_data = total_gain_at_hv( segment, dethv, 'INIT' )
 
         if not fill_data.shape == image.shape:
             raise IOError( 'Input shapes not equal' )
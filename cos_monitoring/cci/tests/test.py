@@ -1,10 +1,17 @@
 import sys
 import os
+import types
+import tempfile
+import fitsio
 import numpy as np
 from astropy.io import fits
+from sqlalchemy import func
+from sqlalchemy.schema import CreateTable
 
 from ..constants import MONITOR_DIR
-from ...cci import findbad, gainmap
+from ...cci import findbad, gainmap, gaincube, gsag
+from ...utils import rebin, enlarge
+from ...database.db_tables import load_connection, Gain, Flagged, GainTrends, GainJumps, TrendProgress
 
 PRECISION = sys.float_info.epsilon
 
@@ -24,3 +31,663 @@ def test_time_fitting():
     assert success == True,"Fitting should have succeeded on this simple test"
 
 #-------------------------------------------------------------------------------
+
+def test_batch_gain_fitting():
+    TOLERANCE = 5e-3
+
+    rng = np.random.RandomState(42)
+    cube = np.zeros((32, 10, 20))
+    for y in range(cube.shape[1]):
+        for x in range(cube.shape[2]):
+            pha = rng.normal(rng.uniform(2, 16), rng.uniform(1, 2.5), rng.randint(0, 300))
+            cube[:, y, x] = np.bincount(np.clip(np.round(pha), 0, 31).astype(int), minlength=32)
+
+    gain, counts, std = gainmap.measure_gainimage(cube.copy(), batch=False)
+    batch_gain, batch_counts, batch_std = gainmap.measure_gainimage(cube.copy(), batch=True)
+
+    both = (gain > 0) & (batch_gain > 0)
+    assert both.sum() >= 0.99 * (gain > 0).sum(), "Batch fitting rejected too many pixels"
+    assert np.all(np.abs(gain - batch_gain)[both] < TOLERANCE), "Batch fitting gave different gains"
+    assert np.all(counts[both] == batch_counts[both]), "Batch fitting gave different counts"
+
+#-------------------------------------------------------------------------------
+
+def test_tiled_gain_fitting():
+    rng = np.random.RandomState(7)
+    cube = rng.poisson(rng.uniform(0, 8, (32, 12, 16))).astype(np.float64)
+
+    gain, counts, std = gainmap.measure_gainimage(cube.copy())
+    tiled_gain, tiled_counts, tiled_std = gainmap.measure_gainimage_tiled(cube.copy(), num_cpu=2, band_size=5)
+
+    assert np.array_equal(gain, tiled_gain), "Tiled gains differ"
+    assert np.array_equal(counts, tiled_counts), "Tiled counts differ"
+    assert np.array_equal(std, tiled_std), "Tiled std differ"
+
+#-------------------------------------------------------------------------------
+
+def test_read_cci_cube():
+    shape = (12, 32)
+    rng = np.random.RandomState(3)
+    images = [rng.randint(0, 100, shape).astype(np.int16) for i in range(32)]
+
+    filename = os.path.join(tempfile.mkdtemp(), 'test_cci.fits')
+    with fitsio.FITS(filename, 'rw') as hdu:
+        hdu.write(np.zeros(1, dtype=np.int16))
+        hdu.write(np.zeros(1, dtype=[('files', 'S24')]))
+        for image in images:
+            hdu.write(image)
+
+    with fitsio.FITS(filename) as hdu:
+        cube = gainmap.read_cci_cube(hdu, ybinning=2, xbinning=8, shape=shape, rows_per_read=5)
+
+    expected = np.array([rebin(image, bins=(2, 8)) for image in images])
+
+    assert cube.dtype == np.int32
+    assert np.array_equal(cube, expected), "Binned cube differs from rebin"
+    assert not cube.flags.writeable, "Cube should be read-only"
+
+    gainmap.measure_gainimage(cube)
+
+#-------------------------------------------------------------------------------
+
+def test_derived_products():
+    rng = np.random.RandomState(5)
+
+    cci = gainmap.CCI.__new__(gainmap.CCI)
+    cci.segment = 'FUVA'
+    cci.cci_name = os.path.join(tempfile.mkdtemp(), 'no_accum')
+    cci.big_array = rng.randint(0, 3, (32, 4, 6)).astype(np.int32)
+
+    cci.derive_products()
+
+    coulombs = 1.0e-12*10**((np.array(range(0,32))-11.75)/20.5)
+    charge = np.zeros((4, 6))
+    for pha, layer in enumerate(cci.big_array):
+        charge += coulombs[pha] * layer
+
+    assert np.array_equal(cci.counts_image, cci.big_array.sum(axis=0))
+    assert np.allclose(cci.extracted_charge, charge, rtol=1e-12, atol=0)
+    assert np.array_equal(cci.cnt02_30_image, cci.big_array[2:31].sum(axis=0))
+    assert cci.cnt00_00 == len(cci.big_array[0].nonzero()[0])
+    assert cci.cnt02_30 == len(cci.big_array[2:31].nonzero()[0])
+    assert cci.cnt31_31 == len(cci.big_array[31:].nonzero()[0])
+
+#-------------------------------------------------------------------------------
+
+def make_gainmaps(gainmap_dir, maps):
+    """Write minimal gainmaps, maps is a list of (name, expstart, dethv, {(y, x): gain})"""
+
+    for name, expstart, dethv, gains in maps:
+        data = np.zeros((gainmap.YLEN, gainmap.XLEN))
+        for (y, x), gain in gains.items():
+            data[y, x] = gain
+
+        hdu_out = fits.HDUList(fits.PrimaryHDU())
+        hdu_out[0].header['EXPSTART'] = expstart
+        hdu_out[0].header['DETHV'] = dethv
+        hdu_out.append(fits.ImageHDU(data=data, name='MOD_GAIN'))
+        hdu_out.writeto(os.path.join(gainmap_dir, name))
+
+#-------------------------------------------------------------------------------
+
+def test_total_gains():
+    gainmap_dir = tempfile.mkdtemp()
+    make_gainmaps(gainmap_dir, [('l_2010001_00_167_cci_gainmap.fits', 55200, 167, {(1, 1): 10, (2, 2): 9}),
+                                ('l_2010002_00_167_cci_gainmap.fits', 55300, 167, {(1, 1): 8}),
+                                ('l_2010003_00_150_cci_gainmap.fits', 55400, 150, {(1, 1): 2}),
+                                ('l_2010004_00_169_cci_gainmap.fits', 55500, 169, {(1, 1): 7, (3, 3): 6}),
+                                ('l_2010001_01_167_cci_gainmap.fits', 55200, 167, {(4, 4): 12})])
+
+    composites = gainmap.make_total_gains(gainmap_dir, end_mjd=55450)
+
+    binned = {key: image[::gainmap.Y_BINNING, ::gainmap.X_BINNING] for key, image in composites.items()}
+    assert composites[('FUVA', 'INIT')].shape == (gainmap.Y_UNBINNED, gainmap.X_UNBINNED)
+    assert binned[('FUVA', 'INIT')][1, 1] == 10 and binned[('FUVA', 'INIT')][2, 2] == 9
+    assert binned[('FUVA', 'LAST')][1, 1] == 8 and binned[('FUVA', 'LAST')][2, 2] == 9
+    assert binned[('FUVB', 'LAST')][4, 4] == 12
+    assert binned[('FUVA', 'LAST')].sum() == 17, "Gainmaps outside the MJD and HV limits were used"
+
+    last = gainmap.make_total_gain(gainmap_dir, 'FUVA', min_hv=160)
+    assert last[::gainmap.Y_BINNING, ::gainmap.X_BINNING][1, 1] == 7
+
+#-------------------------------------------------------------------------------
+
+def test_incremental_total_gain():
+    gainmap_dir = tempfile.mkdtemp()
+    maps = [('l_2010001_00_167_cci_gainmap.fits', 55200, 167, {(1, 1): 10, (2, 2): 9}),
+            ('l_2010003_00_167_cci_gainmap.fits', 55400, 167, {(1, 1): 8}),
+            ('l_2010001_01_150_cci_gainmap.fits', 55200, 150, {(4, 4): 12})]
+    make_gainmaps(gainmap_dir, maps[:2])
+
+    state_file = os.path.join(gainmap_dir, 'state.fits')
+    composite = gainmap.GainComposite()
+    composite.update(gainmap_dir)
+    composite.save(state_file)
+
+    #-- a late-arriving earlier gainmap and one outside the HV bounds
+    make_gainmaps(gainmap_dir, [('l_2010002_00_169_cci_gainmap.fits', 55300, 169, {(1, 1): 11, (3, 3): 6})] + maps[2:])
+
+    composite = gainmap.GainComposite.load(state_file)
+    assert composite.update(gainmap_dir) == 1, "Only the new gainmap in bounds should be read"
+
+    rebuilt = gainmap.GainComposite()
+    rebuilt.update(gainmap_dir)
+
+    #-- source indices follow the order gainmaps were seen in, compare names
+    def source_names(composite, segment, which):
+        names = np.array([item[0] for item in composite.seen] + [''])
+        return names[composite.state[(segment, which, 'SOURCE')]]
+
+    for (segment, which, field), data in rebuilt.state.items():
+        if field == 'SOURCE':
+            assert np.array_equal(source_names(composite, segment, which), source_names(rebuilt, segment, which))
+        else:
+            assert np.array_equal(composite.state[(segment, which, field)], data), "{} differs from a full rebuild".format(field)
+
+    assert composite.state[('FUVA', 'INIT', 'GAIN')][1, 1] == 10
+    assert composite.state[('FUVA', 'LAST', 'GAIN')][1, 1] == 8
+    assert composite.state[('FUVA', 'INIT', 'DETHV')][3, 3] == 169
+    assert composite.seen[composite.state[('FUVA', 'LAST', 'SOURCE')][1, 1]][0] == maps[1][0]
+
+    wider = gainmap.GainComposite(min_hv=150)
+    wider.update(gainmap_dir)
+    assert wider.state[('FUVB', 'LAST', 'GAIN')][4, 4] == 12
+
+#-------------------------------------------------------------------------------
+
+def test_total_gain_at_hv():
+    binned = np.zeros((4, 3))
+    binned[1, 2] = 10
+    binned[3, 0] = 2
+
+    filename = os.path.join(tempfile.mkdtemp(), 'total_gain.fits')
+    hdu_out = fits.HDUList(fits.PrimaryHDU())
+    hdu_out.append(fits.ImageHDU(data=gainmap.enlarge(binned, x=gainmap.X_BINNING, y=gainmap.Y_BINNING), name='FUVAINIT'))
+    hdu_out.writeto(filename)
+
+    gain = gainmap.total_gain_at_hv('FUVA', 168, filename=filename)
+
+    expected = np.where(binned > 0, binned - .393 * 10, 0)
+    assert np.allclose(gain, expected)
+
+    gain[:] = 0
+    assert np.allclose(gainmap.total_gain_at_hv('FUVA', 168, filename=filename), expected), "Cached base map was modified"
+
+    full = gainmap.total_gain_at_hv('FUVA', 178, binned=False, filename=filename)
+    assert full.shape == (4 * gainmap.Y_BINNING, 3 * gainmap.X_BINNING)
+    assert full.max() == 10
+
+#-------------------------------------------------------------------------------
+
+def test_gain_cube():
+    gainmap_dir = tempfile.mkdtemp()
+    rng = np.random.RandomState(3)
+
+    maps = []
+    for i in range(7):
+        gains = {(int(y), int(x)): round(rng.uniform(2, 12), 3) for y, x in zip(rng.randint(0, 20, 30), rng.randint(0, 40, 30))}
+        maps.append(('l_20100{:02d}_00_167_cci_gainmap.fits'.format(i), 55200 + 7 * i, 167, gains))
+    maps[0][3][(5, 6)] = 4.25
+
+    make_gainmaps(gainmap_dir, maps[:5])
+    assert gaincube.update_gain_cubes(gainmap_dir, block_size=3) == 5
+
+    make_gainmaps(gainmap_dir, maps[5:])
+    assert gaincube.update_gain_cubes(gainmap_dir, block_size=3) == 2
+    assert gaincube.update_gain_cubes(gainmap_dir) == 0, "Gainmaps were added twice"
+
+    #-- known gainmaps are skipped without reading them
+    for name, expstart, dethv, gains in maps:
+        with open(os.path.join(gainmap_dir, name), 'w') as f:
+            f.write('unreadable')
+    assert gaincube.update_gain_cubes(gainmap_dir) == 0
+
+    cube = gaincube.GainCube(gainmap_dir, 'FUVA', 167)
+    assert len(cube) == 7 and cube.block_size == 3
+
+    mjd, gain = cube.history(5, 6)
+    expected = [(expstart, gains[(5, 6)]) for name, expstart, dethv, gains in maps if (5, 6) in gains]
+    assert np.allclose(mjd, [item[0] for item in expected])
+    assert np.allclose(gain, [item[1] for item in expected])
+
+    mjd, region = cube.region(0, 20, 10, 30, start_mjd=55210, end_mjd=55235)
+    assert np.allclose(mjd, [55214, 55221, 55228, 55235])
+    for layer, (name, expstart, dethv, gains) in zip(region, maps[2:6]):
+        data = np.zeros((gainmap.YLEN, gainmap.XLEN))
+        for (y, x), value in gains.items():
+            data[y, x] = value
+        assert np.allclose(layer, data[0:20, 10:30])
+
+#-------------------------------------------------------------------------------
+
+def make_gain_db(rows):
+    """sqlite stand-in database holding rows of the gain table
+
+    The result tables are created without their indices, whose names clash
+    with those of the gain table in sqlite.
+    """
+
+    connection_string = 'sqlite:///{}'.format(os.path.join(tempfile.mkdtemp(), 'gain.db'))
+    Session, engine = load_connection(connection_string)
+
+    Gain.__table__.create(engine)
+    TrendProgress.__table__.create(engine)
+    for table in (Flagged, GainTrends, GainJumps):
+        engine.execute(CreateTable(table.__table__))
+
+    session = Session()
+    session.bulk_insert_mappings(Gain, rows)
+    session.commit()
+
+    return session, engine
+
+#-------------------------------------------------------------------------------
+
+def test_flag_superpixels():
+    def row(x, y, expstart, gain, counts=100, segment='FUVA', dethv=167):
+        return {'x': x, 'y': y, 'expstart': expstart, 'gain': gain, 'counts': counts,
+                'segment': segment, 'dethv': dethv, 'year': 2011}
+
+    session, engine = make_gain_db([row(1, 250, 55600, 8), row(1, 250, 55700, 2.5), row(1, 250, 55650, 3),
+                                    #-- first low point has few counts, a later one enough
+                                    row(2, 250, 55610, 2, counts=10), row(2, 250, 55800, 1),
+                                    #-- low points only with few counts
+                                    row(3, 250, 55610, 2, counts=10),
+                                    #-- outside the spectral region, before 2010, other HV
+                                    row(4, 100, 55610, 2), row(5, 250, 55100, 2), row(6, 250, 55610, 2, dethv=169)])
+
+    assert findbad.flag_superpixels(session, 'FUVA', 167) == 2
+
+    flagged = sorted((row.x, row.y, row.mjd) for row in session.query(Flagged))
+    assert flagged == [(1, 250, 55650), (2, 250, 55610)]
+
+#-------------------------------------------------------------------------------
+
+def test_fit_slopes():
+    rng = np.random.RandomState(11)
+
+    x, y, expstart, gain = [], [], [], []
+    for pixel in range(40):
+        n_points = rng.randint(3, 30)
+        mjd = np.sort(rng.uniform(55200, 58000, n_points))
+        values = 10 - rng.uniform(0, 2e-3) * (mjd - 55200) + rng.normal(0, .5, n_points)
+        x += [pixel % 7] * n_points
+        y += [200 + pixel // 7] * n_points
+        expstart += list(mjd)
+        gain += list(values)
+
+    x, y, expstart, gain = map(np.array, (x, y, expstart, gain))
+    order = rng.permutation(len(x))
+    trends = findbad.fit_slopes(x[order], y[order], expstart[order], gain[order])
+
+    n_fit = 0
+    for px in range(7):
+        for py in range(200, 206):
+            index = (x == px) & (y == py)
+            if not index.any():
+                continue
+
+            fit, parameters, success = findbad.time_fitting(expstart[index], gain[index])
+            success = success and index.sum() > 5
+
+            found = (trends['x'] == px) & (trends['y'] == py)
+            assert found.sum() == int(success), "Fit success differs for {}, {}".format(px, py)
+
+            if success:
+                n_fit += 1
+                assert np.allclose([trends['slope'][found][0], trends['intercept'][found][0]], parameters, rtol=1e-6)
+                assert np.isclose(trends['mjd'][found][0], (3 - parameters[1]) / parameters[0], rtol=1e-8)
+
+    assert n_fit > 20
+
+#-------------------------------------------------------------------------------
+
+def test_slope_superpixels():
+    mjd = np.arange(55300, 56300, 100.)
+    rows = [{'x': 3, 'y': 250, 'expstart': float(t), 'gain': float(10 - (t - 55300) / 200.), 'counts': 100,
+             'segment': 'FUVB', 'dethv': 167, 'year': 2011} for t in mjd]
+
+    session, engine = make_gain_db(rows + [dict(row, y=100) for row in rows])
+
+    assert findbad.slope_superpixels(session, 'FUVB', 167) == 1
+
+    trend = session.query(GainTrends).one()
+    assert (trend.x, trend.y) == (3, 250)
+    assert np.isclose(trend.slope, -.005) and np.isclose(trend.mjd, 55300 + 7 * 200)
+
+#-------------------------------------------------------------------------------
+
+def test_incremental_trends():
+    rng = np.random.RandomState(2)
+
+    def rows(x, y, mjds, start_gain, rate):
+        return [{'x': x, 'y': y, 'expstart': float(t), 'gain': round(float(start_gain - rate * (t - 55300)), 3),
+                 'counts': 100, 'segment': 'FUVA', 'dethv': 167, 'year': 2011} for t in mjds]
+
+    first = []
+    for i in range(20):
+        first += rows(i, 250, np.sort(rng.uniform(55300, 56000, 8)), 10, rng.uniform(0, .015))
+    first += rows(50, 250, [55990], 10, 0)
+    #-- low gain at superpixel 60, but with too few counts to flag it yet
+    first += rows(60, 250, [55500], 2.5, 0)
+    first[-1]['counts'] = 10
+
+    session, engine = make_gain_db(first)
+    assert findbad.update_superpixel_trends(session, 'FUVA', 167) is None, "First run should evaluate everything"
+    assert findbad.update_superpixel_trends(session, 'FUVA', 167) == [], "Nothing new to evaluate"
+
+    #-- superpixel 3 degrades quickly, superpixel 30 appears and superpixel 50 jumps
+    new = rows(3, 250, [56100, 56200], 2.5, 0) + rows(30, 250, np.arange(55400, 56200, 100), 9, .002)
+    new += rows(50, 250, [56005], 3, 0) + rows(60, 250, [56100], 2, 0)
+    #-- leave room for an ingest that commits lower ids later
+    for i, row in enumerate(new):
+        row['id'] = len(first) + 10 + i
+    session.bulk_insert_mappings(Gain, new)
+    session.commit()
+
+    assert sorted(findbad.update_superpixel_trends(session, 'FUVA', 167)) == [(3, 250), (30, 250), (50, 250), (60, 250)]
+    progress = session.query(TrendProgress).one()
+    assert (progress.last_gain_id, progress.checked_gain_id) == (0, len(first) + 9 + len(new))
+
+    #-- superpixel 7 sags in rows committed after the higher ids were scanned
+    late = rows(7, 250, [56150], 2, 0)
+    late[0]['id'] = len(first) + 1
+    session.bulk_insert_mappings(Gain, late)
+    session.commit()
+
+    evaluated = findbad.update_superpixel_trends(session, 'FUVA', 167)
+    assert (7, 250) in evaluated and len(evaluated) == 23, "The whole unsettled window should be evaluated again"
+    assert findbad.update_superpixel_trends(session, 'FUVA', 167) == [], "Nothing new to evaluate"
+
+    assert findbad.update_superpixel_trends(session, 'FUVA', 167, settle=0) == []
+    progress = session.query(TrendProgress).one()
+    assert progress.last_gain_id == progress.checked_gain_id == session.query(func.max(Gain.id)).scalar()
+
+    def results(session):
+        return (sorted((row.x, row.y, row.mjd) for row in session.query(Flagged)),
+                sorted((row.x, row.y, row.mjd, row.slope) for row in session.query(GainTrends)))
+
+    incremental = results(session)
+
+    rebuilt_session, engine = make_gain_db(first + new + late)
+    findbad.update_superpixel_trends(rebuilt_session, 'FUVA', 167)
+
+    assert incremental == results(rebuilt_session), "Incremental results differ from a rebuild"
+    assert (3, 250, 56100) in incremental[0]
+    assert (7, 250, 56150) in incremental[0]
+    assert (60, 250, 55500) in incremental[0], "A first flag should date from the earliest low gain"
+
+    jumps = sorted((row.x, row.y, row.mjd, row.previous_mjd) for row in session.query(GainJumps))
+    assert (50, 250, 56005, 55990) in jumps
+    assert jumps == sorted((row.x, row.y, row.mjd, row.previous_mjd) for row in rebuilt_session.query(GainJumps))
+
+#-------------------------------------------------------------------------------
+
+def test_projection_images():
+    session, engine = make_gain_db([])
+    session.bulk_insert_mappings(GainTrends, [{'x': 5, 'y': 250, 'slope': -.01, 'intercept': 560, 'mjd': 55700.5,
+                                               'segment': 'FUVA', 'dethv': 167},
+                                              {'x': 9, 'y': 260, 'slope': -.02, 'intercept': 1100, 'mjd': 54850,
+                                               'segment': 'FUVA', 'dethv': 167},
+                                              {'x': 9, 'y': 260, 'slope': 1, 'intercept': 1, 'mjd': 1,
+                                               'segment': 'FUVA', 'dethv': 169}])
+    session.commit()
+
+    slope_image, intercept_image, bad_image = findbad.projection_images(session, 'FUVA', 167)
+    assert slope_image.shape == (gainmap.YLEN, gainmap.XLEN) and slope_image.dtype == np.float32
+    assert np.isclose(slope_image[250, 5], -.01) and np.isclose(intercept_image[260, 9], 1100)
+    assert np.count_nonzero(bad_image) == 2
+
+    out_dir = tempfile.mkdtemp()
+    findbad.write_projection(out_dir, slope_image, intercept_image, bad_image, 'FUVA', 167)
+
+    with fits.open(findbad.projection_file(out_dir, 'FUVA', 167)) as hdu:
+        assert hdu[0].header['FILETYPE'] == 'PROJ_BAD'
+        assert hdu['SLOPE'].header['XBINNING'] == gainmap.X_BINNING
+        assert np.array_equal(hdu['PROJBAD'].data, bad_image)
+
+#-------------------------------------------------------------------------------
+
+def test_first_flagged_dates():
+    rng = np.random.RandomState(8)
+    n_rows = 300
+
+    segment = rng.choice(['FUVA', 'FUVB'], n_rows)
+    dethv = rng.choice([150, 163, 167, 169, 175], n_rows)
+    x = rng.randint(0, 10, n_rows)
+    y = rng.randint(240, 250, n_rows)
+    mjd = rng.uniform(55200, 57000, n_rows)
+
+    hv_levels = [0, 100] + list(range(142, 179))
+    dates = gsag.first_flagged_dates(segment, dethv, x, y, mjd, hv_levels)
+
+    for seg in ('FUVA', 'FUVB'):
+        for hv_level in hv_levels:
+            expected = {}
+            for row in zip(segment, dethv, x, y, mjd):
+                if row[0] == seg and row[1] >= hv_level:
+                    expected[(row[2], row[3])] = min(expected.get((row[2], row[3]), np.inf), row[4])
+
+            found = dates[(seg, hv_level)]
+            assert dict(zip(zip(found[0], found[1]), found[2])) == expected, "{} {} differs".format(seg, hv_level)
+
+    ly = np.arange(470, 520)
+    assert np.array_equal(gsag.in_boundaries('FUVA', ly, 2), [gsag.in_boundary('FUVA', item, 2) for item in ly])
+
+#-------------------------------------------------------------------------------
+
+def test_populate_down():
+    rng = np.random.RandomState(4)
+
+    regions = {}
+    hdu_out = fits.HDUList(fits.PrimaryHDU())
+    for segment, hv_string in (('FUVA', 'HVLEVELA'), ('FUVB', 'HVLEVELB')):
+        for hv in (163, 167, 169, 175):
+            n_regions = rng.randint(1, 40)
+            lx = rng.randint(0, 20, n_regions) * 8
+            ly = rng.randint(240, 250, n_regions) * 2
+            date = rng.randint(55200, 57000, n_regions).astype(float)
+
+            #-- one row per coordinate, as written by make_gsagtabs_db
+            lines = {}
+            for x, y, mjd in zip(lx, ly, date):
+                lines[(x, y)] = mjd
+            regions[(segment, hv)] = lines
+
+            coords = sorted(lines)
+            hdu_out.append(gsag.gsagtab_extension([lines[coord] for coord in coords],
+                                                  [coord[0] for coord in coords], [8] * len(coords),
+                                                  [coord[1] for coord in coords], [2] * len(coords),
+                                                  [8192] * len(coords), hv, hv_string, segment))
+
+    gsag_file = os.path.join(tempfile.mkdtemp(), 'gsag.fits')
+    hdu_out.writeto(gsag_file)
+
+    gsag.populate_down(gsag_file)
+
+    with fits.open(gsag_file) as hdu:
+        for ext in hdu[1:]:
+            segment = ext.header['SEGMENT']
+            hv = ext.header['HVLEVELA' if segment == 'FUVA' else 'HVLEVELB']
+
+            expected = {}
+            for (seg, level), lines in regions.items():
+                if seg == segment and level >= hv:
+                    for coord, mjd in lines.items():
+                        expected[coord] = min(expected.get(coord, np.inf), mjd)
+
+            found = {(row['LX'], row['LY']): row['DATE'] for row in ext.data}
+            assert found == expected, "{} {} differs".format(segment, hv)
+            assert len(ext.data) == len(expected)
+
+#-------------------------------------------------------------------------------
+
+def test_diff_gsag():
+    def gsagtab(hv_regions):
+        hdu_out = fits.HDUList(fits.PrimaryHDU())
+        for (segment, hv), lines in sorted(hv_regions.items()):
+            hv_string = 'HVLEVEL' + segment[-1]
+            hdu_out.append(gsag.gsagtab_extension([mjd for x, y, mjd in lines],
+                                                  [x for x, y, mjd in lines], [8] * len(lines),
+                                                  [y for x, y, mjd in lines], [2] * len(lines),
+                                                  [8192] * len(lines), hv, hv_string, segment))
+        return hdu_out
+
+    old = gsagtab({('FUVA', 167): [(8, 480, 56000.), (16, 480, 56100.), (24, 490, 56200.)],
+                   ('FUVB', 163): [(8, 500, 55000.)]})
+    new = gsagtab({('FUVA', 167): [(24, 490, 56150.), (16, 480, 56100.), (40, 482, 56300.)],
+                   ('FUVA', 169): [(8, 480, 56000.)],
+                   ('FUVB', 163): [(8, 500, 55000.)]})
+
+    diff = gsag.diff_gsag(new, old)
+
+    assert diff['only_new'] == [('FUVA', 169)]
+    assert diff['only_old'] == []
+    assert sorted(diff['extensions']) == [('FUVA', 167), ('FUVB', 163)]
+
+    regions = diff['extensions'][('FUVA', 167)]
+    assert [(row['y'], row['x'], row['mjd']) for row in regions['added']] == [(482, 40, 56300.)]
+    assert [(row['y'], row['x'], row['mjd']) for row in regions['removed']] == [(480, 8, 56000.)]
+    assert [tuple(row) for row in regions['changed']] == [(490, 24, 56200., 56150.)]
+    assert not any(len(value) for value in diff['extensions'][('FUVB', 163)].values())
+
+    out_dir = tempfile.mkdtemp()
+    gsag.compare_gsag(new, old, out_dir)
+
+    table = fits.getdata(os.path.join(out_dir, 'gsag_diff.fits'), 'DIFF')
+    assert sorted(table['CHANGE']) == ['added', 'mjd', 'removed']
+    assert os.path.exists(os.path.join(out_dir, 'gsag_report.txt'))
+
+#-------------------------------------------------------------------------------
+
+def test_gsag_hash():
+    data_dir = tempfile.mkdtemp()
+
+    def write_gsagtab(filename, dates):
+        hdu_out = fits.HDUList(fits.PrimaryHDU())
+        for segment, hv, date in dates:
+            hdu_out.append(gsag.gsagtab_extension([date], [8], [8], [480], [2], [8192],
+                                                  hv, 'HVLEVEL' + segment[-1], segment))
+        hdu_out.writeto(filename, overwrite=True)
+        return filename
+
+    rawtag = os.path.join(data_dir, 'lbgu17qnq_rawtag_a.fits')
+    hdu = fits.HDUList([fits.PrimaryHDU(), fits.BinTableHDU.from_columns([fits.Column('TIME', 'E', array=[0.])])])
+    hdu[0].header['SEGMENT'] = 'FUVA'
+    hdu[1].header['HVLEVELA'] = 167
+    hdu.writeto(rawtag)
+    fits.PrimaryHDU().writeto(os.path.join(data_dir, 'lbgu17qnq_spt.fits'))
+    fits.PrimaryHDU().writeto(os.path.join(data_dir, 'lbgu17qnq_x1d_a.fits'))
+
+    inputs = gsag.dataset_inputs(rawtag)
+    assert [os.path.basename(item) for item in inputs] == ['lbgu17qnq_rawtag_a.fits', 'lbgu17qnq_spt.fits']
+
+    reference = gsag.gsag_hash(write_gsagtab(os.path.join(data_dir, 'old.fits'),
+                                             [('FUVA', 167, 56000.), ('FUVA', 169, 56000.), ('FUVB', 167, 56000.)]), inputs)
+    other_hv = gsag.gsag_hash(write_gsagtab(os.path.join(data_dir, 'other.fits'),
+                                            [('FUVA', 167, 56000.), ('FUVA', 169, 57000.), ('FUVB', 167, 57000.)]), inputs)
+    same_hv = gsag.gsag_hash(write_gsagtab(os.path.join(data_dir, 'same.fits'),
+                                           [('FUVA', 167, 57000.), ('FUVA', 169, 56000.), ('FUVB', 167, 56000.)]), inputs)
+
+    assert reference == other_hv, "Extensions the dataset does not use should not change the hash"
+    assert reference != same_hv, "The extension the dataset uses changed"
+
+    lref = tempfile.mkdtemp()
+    with fits.open(rawtag, mode='update') as hdu:
+        hdu[0].header['FLATFILE'] = 'lref$x6q17586l_flat.fits'
+        hdu[0].header['GSAGTAB'] = 'lref$x6l1439el_gsag.fits'
+    fits.PrimaryHDU().writeto(os.path.join(lref, 'x6q17586l_flat.fits'))
+
+    stamp = gsag.reference_stamp(inputs, lref)
+    assert stamp.startswith('x6q17586l_flat.fits ') and not 'gsag' in stamp
+    os.utime(os.path.join(lref, 'x6q17586l_flat.fits'), (0, 0))
+    assert gsag.reference_stamp(inputs, lref) != stamp, "A replaced reference file should change the stamp"
+
+#-------------------------------------------------------------------------------
+
+def test_find_jumps():
+    rng = np.random.RandomState(5)
+
+    x = rng.randint(0, 30, 2000)
+    y = rng.randint(240, 260, 2000)
+    expstart = rng.uniform(55300, 57000, 2000)
+    gain = rng.uniform(2, 14, 2000)
+
+    jumps = findbad.find_jumps(x, y, expstart, gain)
+
+    found = set(zip(jumps['x'], jumps['y'], jumps['mjd']))
+    expected = set()
+    for pixel in set(zip(x, y)):
+        index = np.where((x == pixel[0]) & (y == pixel[1]))[0]
+        index = index[np.argsort(expstart[index])]
+        for mjd in findbad.check_rapid_changes(expstart[index], gain[index]):
+            expected.add(pixel + (mjd,))
+
+        #-- the original per-pixel loop
+        for i in range(1, len(index)):
+            if abs(gain[index[i]] - gain[index[i - 1]]) > 5 and expstart[index[i]] - expstart[index[i - 1]] < 28:
+                assert pixel + (expstart[index[i]],) in found
+
+    assert found == expected
+    assert len(found) == len(jumps['mjd'])
+    assert np.all(np.abs(jumps['gain_change']) > 5) and np.all(jumps['mjd'] - jumps['previous_mjd'] < 28)
+
+#-------------------------------------------------------------------------------
+
+def test_sparse_gainmap():
+    rng = np.random.RandomState(6)
+
+    gain = np.where(rng.uniform(size=(gainmap.YLEN, gainmap.XLEN)) < .02, rng.uniform(1, 15, (gainmap.YLEN, gainmap.XLEN)), 0)
+    gain = gain.astype(np.float32)
+    #-- dark counts land everywhere, measured or not
+    counts = rng.randint(0, 3, gain.shape) + np.where(gain > 0, rng.randint(30, 500, gain.shape), 0)
+    std = np.where(gain > 0, rng.uniform(.5, 3, gain.shape), 0).astype(np.float32)
+
+    sparse = gainmap.SparseGainmap.from_dense(gain, std, counts)
+
+    assert len(sparse) == np.count_nonzero(gain)
+    assert np.array_equal(sparse.dense('GAIN'), gain)
+    assert np.array_equal(sparse.dense('STD'), std)
+    assert np.array_equal(sparse.dense('COUNTS'), np.where(gain > 0, counts, 0))
+
+    data_dir = tempfile.mkdtemp()
+    sparse_file = os.path.join(data_dir, 'l_2010001_00_167_cci_gainmap.fits')
+    hdu_out = fits.HDUList([fits.PrimaryHDU(), sparse.to_hdu(),
+                            gainmap.compressed_image(counts, 'COUNTS'),
+                            gainmap.compressed_image(rng.uniform(size=gain.shape) * 1e-12, 'CHARGE')])
+    hdu_out[0].header['EXPSTART'] = 55200
+    hdu_out[0].header['DETHV'] = 167
+    hdu_out.writeto(sparse_file)
+
+    dense_file = os.path.join(data_dir, 'dense.fits')
+    fits.HDUList([fits.PrimaryHDU(), fits.ImageHDU(gain.astype(np.float64), name='MOD_GAIN'),
+                  fits.ImageHDU(counts.astype(np.float64), name='COUNTS')]).writeto(dense_file)
+
+    for filename in (sparse_file, dense_file):
+        read = gainmap.read_gainmap(filename)
+        assert np.array_equal(read.dense('GAIN'), gain)
+        assert np.array_equal(read.dense('COUNTS'), np.where(gain > 0, counts, 0))
+
+    with fits.open(sparse_file) as hdu:
+        assert [ext.name for ext in hdu] == ['PRIMARY', 'GAINMAP', 'COUNTS', 'CHARGE']
+        assert np.array_equal(hdu['COUNTS'].data, counts), "Counts should be stored losslessly"
+        assert hdu['GAINMAP'].header['NAXIS1'] == 16, "Rows should be 16 bytes"
+
+    from_sparse = gainmap.GainComposite()
+    from_sparse.fold('FUVA', sparse_file, 55200, 167, gainmap.read_gainmap(sparse_file))
+    from_dense = gainmap.GainComposite()
+    from_dense.fold('FUVA', dense_file, 55200, 167, gain)
+
+    for key, image in from_sparse.state.items():
+        assert np.array_equal(image, from_dense.state[key]), key
+
+    current = types.SimpleNamespace(segment='FUVA', dethv=167, expstart=55200., gainmap=lambda: sparse)
+    columns = gainmap.gainmap_columns(current)
+    values = columns['gain'].tolist()
+    assert all(value == round(value, 3) for value in values), "Gains should be stored with 3 decimals"
+    assert np.allclose(values, sparse.columns['GAIN'], atol=5e-4)
+
+    composites = gainmap.make_total_gains(data_dir, segments=('FUVA',))
+    assert np.array_equal(composites[('FUVA', 'INIT')], enlarge(gain, x=gainmap.X_BINNING, y=gainmap.Y_BINNING))
+
+#-------------------------------------------------------------------------------
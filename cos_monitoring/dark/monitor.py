@@ -243,6 +243,7 @@ def pull_orbital_info(dataset, step=25):
         for i in range(len(counts)):
             ### - better solution than round?
             info['date'] = round(decyear[i], 3)
+            info['year'] = int(decyear[i])
             info['dark'] = round(counts[i], 7)
             info['ta_dark'] = round(ta_counts[i], 7)
             info['latitude'] = round(lat[i], 7)
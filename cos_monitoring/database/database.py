@@ -9,37 +9,30 @@
 
 from __future__ import print_function, absolute_import, division
 
-from astropy.io import fits
 import os
 from sqlalchemy import and_, or_, text, MetaData
 import sys
-import matplotlib as mpl
-mpl.use('Agg')
-import numpy as np
 import multiprocessing as mp
 import types
 import argparse
 import pprint
 import inspect
 import functools
+import importlib
+import itertools
+import time
 import logging
 logger = logging.getLogger(__name__)
 
-from ..cci.gainmap import make_all_hv_maps
-from ..cci.gainmap import write_and_pull_gainmap
-from ..cci.monitor import monitor as cci_monitor
-from ..dark.monitor import monitor as dark_monitor
-from ..dark.monitor import pull_orbital_info
-from ..filesystem import find_all_datasets
-from ..osm.monitor import pull_flashes
-from ..osm.monitor import monitor as osm_monitor
-from ..stim.monitor import locate_stims
-from ..stim.monitor import stim_monitor
-from ..utils.utils import scrape_cycle
-from .db_tables import load_connection, open_settings
+#-- The monitors pull in matplotlib, scipy, calcos, etc.  They are imported
+#-- inside the functions that need them so the short command line tools
+#-- and freshly spawned workers start quickly.
+from .db_tables import load_connection, open_settings, add_year_columns, partition_tables, compact_tables
 from .db_tables import Base
 from .db_tables import Files, Headers
 from .db_tables import Lampflash, Stims, Darks, sptkeys, Data, Gain, Acqs
+from . import workqueue
+from .pipeline import pipeline_insert
 
 #-------------------------------------------------------------------------------
 
@@ -92,58 +85,175 @@ def mp_insert(args):
 
 #-------------------------------------------------------------------------------
 
-def insert_with_yield(filename, table, function, foreign_key=None, **kwargs):
-    """ Call function on filename and insert results into table
+def column_lists(columns, foreign_key=None):
+    """ Turn a dictionary of column arrays and scalars into equal length lists
+
+    Scalars are repeated on every row.  Values are converted to native
+    python types a whole column at a time.
+
+    Parameters
+    ----------
+    columns : dict
+        column: array or scalar
+    foreign_key : int, optional
+        foreign key to add to each row
+
+    Returns
+    -------
+    columns : dict
+        column: list of values
+    """
+
+    import numpy as np
+
+    columns = dict(columns, file_id=foreign_key)
+    n_rows = max(np.size(value) for value in columns.values() if np.ndim(value))
+
+    return {key: np.broadcast_to(np.asarray(value), (n_rows,)).tolist() for key, value in columns.items()}
+
+#-------------------------------------------------------------------------------
+
+def extract_columns(filename, function, foreign_key=None, **kwargs):
+    """ Call function on filename and collect what it produces as columns
+
+    The function may return a single dictionary, a dictionary of column
+    arrays (see column_lists), or yield dictionaries.
 
     Parameters
     ----------
     filename : str
         name of the file to call the function argument on
-    table : sqlalchemy table object
-        The table of the database to update.
     function : function
         The function to call, should be a generator
     foreign_key : int, optional
-        foreign key to update the table with
+        foreign key to add to each row
+
+    Returns
+    -------
+    columns : dict
+        column: list of values, a single blank row holding only the
+        foreign key if the file could not be read.
     """
 
-    settings = open_settings()
-    Session, engine = load_connection(settings['connection_string'])
-    session = Session()
+    import numpy as np
 
+    rows = []
     try:
         data = function(filename, **kwargs)
 
-        if isinstance(data, dict):
+        if isinstance(data, dict) and any(np.ndim(value) for value in data.values()):
+            return column_lists(data, foreign_key)
+        elif isinstance(data, dict):
             data = [data]
         elif isinstance(data, types.GeneratorType):
             pass
         else:
             raise ValueError("Not designed to work with data of type {}".format(type(data)))
 
-        #-- Pull data from generator and commit
         for i, row in enumerate(data):
+            #-- some extractors update and re-yield the same dictionary
+            row = dict(row)
             row['file_id'] = foreign_key
             if i == 0:
                 logger.debug("Keys to insert: {}".format(row.keys()))
             logger.debug("Values to insert: {}".format(row.values()))
 
-        #-- Converts np arrays to native python type...
-        #-- This is to allow the database to ingest values as type float
-        #-- instead of Decimal Class types in sqlalchemy....
+            #-- Converts np arrays to native python type...
+            #-- This is to allow the database to ingest values as type float
+            #-- instead of Decimal Class types in sqlalchemy....
             for key in row:
                 if isinstance(row[key], np.generic):
                     logger.debug("casting {} to scalar".format(row[key]))
-                    row[key] = np.asscalar(row[key])
-                else:
-                    continue
+                    row[key] = row[key].item()
 
-            session.add(table(**row))
+            rows.append(row)
     except (IOError, ValueError) as e:
         #-- Handle missing files
         logger.warning("Exception hit for {}, adding blank entry".format(filename))
         logger.warning(e)
-        session.add(table(file_id=foreign_key))
+        rows = [{'file_id': foreign_key}]
+
+    keys = ['file_id']
+    for row in rows:
+        keys.extend(key for key in row if key not in keys)
+
+    return {key: [row.get(key) for row in rows] for key in keys}
+
+#-------------------------------------------------------------------------------
+
+def insert_columns(connection, table, columns, chunk_size=10000):
+    """ Insert a dictionary of equal length column lists into table
+
+    The table's insert statement is compiled for the connection's dialect
+    and run through the DBAPI cursor's executemany, chunk_size rows at a
+    time, with the rows zipped from the columns so no dictionary is built
+    per row.  Columns left out take their default.
+
+    Parameters
+    ----------
+    connection : connection object
+        connection to insert with, e.g. session.connection()
+    table : sqlalchemy table object
+        The table of the database to update.
+    columns : dict
+        column: list of values, as returned by extract_columns
+    chunk_size : int, optional
+        number of rows per executemany
+
+    Returns
+    -------
+    n_rows : int
+        number of rows inserted
+    """
+
+    statement = table.__table__.insert().compile(dialect=connection.dialect, column_keys=list(columns))
+
+    #-- the compiled statement also lists columns with a python side default
+    keys = statement.positiontup if statement.positional else list(statement.params)
+    values = [columns[key] if key in columns else itertools.repeat(table.__table__.c[key].default.arg)
+              for key in keys]
+
+    rows = zip(*values)
+    if not statement.positional:
+        rows = (dict(zip(keys, row)) for row in rows)
+
+    cursor = connection.connection.cursor()
+    n_rows = 0
+    try:
+        while True:
+            chunk = list(itertools.islice(rows, chunk_size))
+            if not chunk:
+                break
+
+            cursor.executemany(str(statement), chunk)
+            n_rows += len(chunk)
+    finally:
+        cursor.close()
+
+    return n_rows
+
+#-------------------------------------------------------------------------------
+
+def insert_with_yield(filename, table, function, foreign_key=None, **kwargs):
+    """ Call function on filename and insert results into table
+
+    Parameters
+    ----------
+    filename : str
+        name of the file to call the function argument on
+    table : sqlalchemy table object
+        The table of the database to update.
+    function : function
+        The function to call, should be a generator
+    foreign_key : int, optional
+        foreign key to update the table with
+    """
+
+    settings = open_settings()
+    Session, engine = load_connection(settings['connection_string'])
+    session = Session()
+
+    insert_columns(session.connection(), table, extract_columns(filename, function, foreign_key, **kwargs))
 
     session.commit()
     session.close()
@@ -151,6 +261,79 @@ def insert_with_yield(filename, table, function, foreign_key=None, **kwargs):
 
 #-------------------------------------------------------------------------------
 
+def queue_files(stage, files_to_add):
+    """Put files into the work queue for stage instead of processing them
+
+    Parameters
+    ----------
+    stage : str
+        name of the ingestion stage, a key of INGEST_STAGES
+    files_to_add : list
+        (file id, full filename) pairs
+    """
+
+    settings = open_settings()
+    Session, engine = load_connection(settings['connection_string'])
+    session = Session()
+
+    workqueue.enqueue(session, stage, [f_key for f_key, filename in files_to_add])
+
+    session.close()
+    engine.dispose()
+
+#-------------------------------------------------------------------------------
+
+def ingest_files(files_to_add, table, function, num_cpu=1, cpu_bound=False, **kwargs):
+    """Run function on each file and insert the results into table
+
+    With ``pipeline`` set in the configuration file the files go through
+    the threaded read / batched write pipeline of
+    :func:`cos_monitoring.database.pipeline.pipeline_insert`, otherwise each
+    file is inserted by its own call to insert_with_yield in a process pool.
+
+    Parameters
+    ----------
+    files_to_add : list
+        (file id, full filename) pairs
+    table : sqlalchemy table object
+        The table of the database to update.
+    function : function
+        The function to call on each file, should be a generator
+    num_cpu : int, optional
+        number of processes
+    cpu_bound : bool, optional
+        function is dominated by computation rather than reading the file
+    **kwargs
+        passed on to function
+    """
+
+    logger.info("Found {} files to add".format(len(files_to_add)))
+
+    settings = open_settings()
+    if settings.get('pipeline'):
+        options = settings['pipeline'] if isinstance(settings['pipeline'], dict) else {}
+        pipeline_insert(files_to_add, table, function,
+                        connection_string=settings['connection_string'],
+                        cpu_bound=cpu_bound,
+                        num_cpu=num_cpu,
+                        num_readers=options.get('num_readers', 4),
+                        batch_size=options.get('batch_size', 10000),
+                        queue_size=options.get('queue_size', 8),
+                        **kwargs)
+        return
+
+    functions = [functools.partial(insert_with_yield,
+                                   filename=filename,
+                                   table=table,
+                                   function=function,
+                                   foreign_key=f_key,
+                                   **kwargs) for f_key, filename in files_to_add]
+
+    pool = mp.Pool(processes=num_cpu)
+    pool.map(call, functions)
+
+#-------------------------------------------------------------------------------
+
 def insert_files(**kwargs):
     """Populate the main table of all files in the base directory
 
@@ -164,6 +347,8 @@ def insert_files(**kwargs):
 
     """
 
+    from ..filesystem import find_all_datasets
+
     logger.info("Inserting files into db")
 
     settings = open_settings()
@@ -204,7 +389,7 @@ def insert_files(**kwargs):
 
 #-------------------------------------------------------------------------------
 
-def populate_lampflash(num_cpu=1):
+def populate_lampflash(num_cpu=1, queue=False):
     """ Populate the lampflash table
 
     """
@@ -222,15 +407,17 @@ def populate_lampflash(num_cpu=1):
     session.close()
     engine.dispose()
 
-    args = [(full_filename, Lampflash, pull_flashes, f_key) for f_key, full_filename in files_to_add]
+    if queue:
+        queue_files('lampflash', files_to_add)
+        return
 
-    logger.info("Found {} files to add".format(len(args)))
-    pool = mp.Pool(processes=num_cpu)
-    pool.map(mp_insert, args)
+    from ..osm.monitor import pull_flashes
+
+    ingest_files(files_to_add, Lampflash, pull_flashes, num_cpu)
 
 #-------------------------------------------------------------------------------
 
-def populate_stims(num_cpu=1):
+def populate_stims(num_cpu=1, queue=False):
     """ Populate the stim table
 
     """
@@ -248,15 +435,17 @@ def populate_stims(num_cpu=1):
     session.close()
 
 
-    args = [(full_filename, Stims, locate_stims, f_key) for f_key, full_filename in files_to_add]
+    if queue:
+        queue_files('stims', files_to_add)
+        return
 
-    logger.info("Found {} files to add".format(len(args)))
-    pool = mp.Pool(processes=num_cpu)
-    pool.map(mp_insert, args)
+    from ..stim.monitor import locate_stims
+
+    ingest_files(files_to_add, Stims, locate_stims, num_cpu, cpu_bound=True)
 
 #-------------------------------------------------------------------------------
 
-def populate_darks(num_cpu=1):
+def populate_darks(num_cpu=1, queue=False):
     """ Populate the darks table
 
     """
@@ -277,15 +466,17 @@ def populate_darks(num_cpu=1):
 
     session.close()
 
-    args = [(full_filename, Darks, pull_orbital_info, f_key) for f_key, full_filename in files_to_add]
+    if queue:
+        queue_files('darks', files_to_add)
+        return
 
-    logger.info("Found {} files to add".format(len(args)))
-    pool = mp.Pool(processes=num_cpu)
-    pool.map(mp_insert, args)
+    from ..dark.monitor import pull_orbital_info
+
+    ingest_files(files_to_add, Darks, pull_orbital_info, num_cpu, cpu_bound=True)
 
 #-------------------------------------------------------------------------------
 
-def populate_gain(num_cpu=1):
+def populate_gain(num_cpu=1, queue=False):
     """ Populate the cci gain table
 
     """
@@ -306,20 +497,18 @@ def populate_gain(num_cpu=1):
                             filter(Gain.file_id == None)]
     session.close()
 
-    functions = [functools.partial(insert_with_yield,
-                                   filename=filename,
-                                   table=Gain,
-                                   function=write_and_pull_gainmap,
-                                   foreign_key=f_key,
-                                   out_dir=out_dir) for f_key, filename in files_to_add]
+    if queue:
+        queue_files('gain', files_to_add)
+        return
 
-    logger.info("Found {} files to add".format(len(functions)))
-    pool = mp.Pool(processes=num_cpu)
-    pool.map(call, functions)
+    from ..cci.gainmap import write_and_pull_gainmap
+
+    ingest_files(files_to_add, Gain, write_and_pull_gainmap, num_cpu,
+                 cpu_bound=True, out_dir=out_dir)
 
 #-------------------------------------------------------------------------------
 
-def populate_spt(num_cpu=1):
+def populate_spt(num_cpu=1, queue=False):
     """ Populate the table of primary header information
 
     """
@@ -335,15 +524,16 @@ def populate_spt(num_cpu=1):
                                 outerjoin(sptkeys, Files.id == sptkeys.file_id).\
                                 filter(sptkeys.file_id == None)]
     session.close()
-    args = [(full_filename, sptkeys, get_spt_keys, f_key) for f_key, full_filename in files_to_add]
 
-    logger.info("Found {} files to add".format(len(args)))
-    pool = mp.Pool(processes=num_cpu)
-    pool.map(mp_insert, args)
+    if queue:
+        queue_files('spt', files_to_add)
+        return
+
+    ingest_files(files_to_add, sptkeys, get_spt_keys, num_cpu)
 
 #-------------------------------------------------------------------------------
 
-def populate_data(num_cpu=1):
+def populate_data(num_cpu=1, queue=False):
     logger.info("adding to data table")
 
     settings = open_settings()
@@ -356,15 +546,16 @@ def populate_data(num_cpu=1):
                                 outerjoin(Data, Files.id == Data.file_id).\
                                 filter(Data.file_id == None)]
     session.close()
-    args = [(full_filename, Data, update_data, f_key) for f_key, full_filename in files_to_add]
 
-    logger.info("Found {} files to add".format(len(args)))
-    pool = mp.Pool(processes=num_cpu)
-    pool.map(mp_insert, args)
+    if queue:
+        queue_files('data', files_to_add)
+        return
+
+    ingest_files(files_to_add, Data, update_data, num_cpu)
 
 #-------------------------------------------------------------------------------
 
-def populate_primary_headers(num_cpu=1):
+def populate_primary_headers(num_cpu=1, queue=False):
     """ Populate the table of primary header information
 
     """
@@ -421,21 +612,15 @@ def populate_primary_headers(num_cpu=1):
     files_to_add = [(result.file_id, result.file_to_grab) for result in engine.execute(text(q))
                         if not result.file_id == None]
 
-    #args = [(full_filename, Headers, get_primary_keys, f_key) for f_key, full_filename in files_to_add]
-
-    functions = [functools.partial(insert_with_yield,
-                                   filename=filename,
-                                   table=Headers,
-                                   function=get_primary_keys,
-                                   foreign_key=f_key) for f_key, filename in files_to_add]
+    if queue:
+        queue_files('headers', files_to_add)
+        return
 
-    logger.info("Found {} files to add".format(len(functions)))
-    pool = mp.Pool(processes=num_cpu)
-    pool.map(call, functions)
+    ingest_files(files_to_add, Headers, get_primary_keys, num_cpu)
 
 #-------------------------------------------------------------------------------
 
-def populate_acqs(num_cpu=1):
+def populate_acqs(num_cpu=1, queue=False):
     logger.info("adding to data table")
 
     settings = open_settings()
@@ -448,11 +633,12 @@ def populate_acqs(num_cpu=1):
                                 outerjoin(Acqs, Files.id == Acqs.file_id).\
                                 filter(Acqs.file_id == None)]
     session.close()
-    args = [(full_filename, Acqs, get_acq_keys, f_key) for f_key, full_filename in files_to_add]
 
-    logger.info("Found {} files to add".format(len(args)))
-    pool = mp.Pool(processes=num_cpu)
-    pool.map(mp_insert, args)
+    if queue:
+        queue_files('acqs', files_to_add)
+        return
+
+    ingest_files(files_to_add, Acqs, get_acq_keys, num_cpu)
 
 #-------------------------------------------------------------------------------
 
@@ -470,6 +656,8 @@ def get_spt_keys(filename):
         dictionary of keyword,value pairs
     """
 
+    from astropy.io import fits
+
     with fits.open(filename) as hdu:
         keywords = {'rootname':hdu[0].header.get('rootname', None),
                     'proc_typ':hdu[0].header.get('proc_typ', None),
@@ -501,6 +689,9 @@ def get_spt_keys(filename):
 #-------------------------------------------------------------------------------
 
 def get_primary_keys(filename):
+    from astropy.io import fits
+    from ..utils.utils import scrape_cycle
+
     with fits.open(filename) as hdu:
         keywords = {  'filetype':hdu[0].header['filetype'],
                           'instrume':hdu[0].header['instrume'],
@@ -595,6 +786,8 @@ def update_data(args):
     """Update DB data table in parallel"""
 
     #args is the filename!!! (might want to design this like other functions)
+    from astropy.io import fits
+
     try:
         with fits.open(args) as hdu:
             if len(hdu[1].data):
@@ -618,6 +811,8 @@ def update_data(args):
 #-------------------------------------------------------------------------------
 
 def get_acq_keys(filename):
+    from astropy.io import fits
+
     with fits.open(filename) as hdu:
         keywords = {'rootname':hdu[0].header['rootname'],
                     'obset_id': hdu[1].header.get('obset_id', None),
@@ -753,23 +948,193 @@ def clear_all_databases(settings, nuke=False):
 
 #-------------------------------------------------------------------------------
 
+#-- Stages that can be processed through the work queue.
+#-- stage : (table, 'module:function'), modules are relative to this package
+#-- and only imported when a worker first needs them.
+INGEST_STAGES = {'headers': (Headers, '.database:get_primary_keys'),
+                 'spt': (sptkeys, '.database:get_spt_keys'),
+                 'data': (Data, '.database:update_data'),
+                 'lampflash': (Lampflash, '..osm.monitor:pull_flashes'),
+                 'darks': (Darks, '..dark.monitor:pull_orbital_info'),
+                 'gain': (Gain, '..cci.gainmap:write_and_pull_gainmap'),
+                 'stims': (Stims, '..stim.monitor:locate_stims'),
+                 'acqs': (Acqs, '.database:get_acq_keys')}
+
+#-------------------------------------------------------------------------------
+
+def load_function(path):
+    """Import and return the function named by a 'module:function' string"""
+
+    module, name = path.split(':')
+
+    return getattr(importlib.import_module(module, __package__), name)
+
+#-------------------------------------------------------------------------------
+
+def run_worker(stages=None, batch_size=10, lease=3600, poll=30, forever=False):
+    """Claim and process items from the work queue
+
+    Any number of workers, on any number of hosts, can run at once.  Items
+    held by a worker that dies are picked up again once their lease expires.
+
+    Parameters
+    ----------
+    stages : list, optional
+        only process these stages, default is all
+    batch_size : int, optional
+        number of items to claim at a time
+    lease : float, optional
+        seconds a claim is held before others may take it over
+    poll : float, optional
+        seconds to wait when nothing is claimable
+    forever : bool, optional
+        keep polling for work instead of returning once the queue is empty
+    """
+
+    settings = open_settings()
+    Session, engine = load_connection(settings['connection_string'])
+    session = Session()
+
+    kwargs = {'gain': {'out_dir': os.path.join(settings['monitor_location'], 'CCI')}}
+
+    while True:
+        token, items = workqueue.claim_batch(session, batch_size, lease, stages)
+
+        if not items:
+            if not forever and not workqueue.outstanding(session, stages):
+                break
+
+            #-- Remaining items are held by other workers, wait in
+            #-- case a lease expires.
+            time.sleep(poll)
+            continue
+
+        for item_id, file_id, stage, filename in items:
+            table, path = INGEST_STAGES[stage]
+            function = load_function(path)
+
+            try:
+                columns = extract_columns(filename, function, file_id, **kwargs.get(stage, {}))
+
+                #-- the rows are only written if the claim was not lost
+                #-- to another worker in the meantime
+                if workqueue.complete(session, token, item_id, commit=False):
+                    insert_columns(session.connection(), table, columns)
+                session.commit()
+            except Exception as e:
+                logger.warning("Failed {} for {}, releasing".format(stage, filename))
+                logger.warning(e)
+                session.rollback()
+                workqueue.release(session, token, item_id)
+
+            workqueue.renew(session, token, lease)
+
+    session.close()
+    engine.dispose()
+
+#-------------------------------------------------------------------------------
+
+def run_workers(num_cpu=1, **kwargs):
+    """Run num_cpu local workers until the work queue is empty"""
+
+    workers = [mp.Process(target=run_worker, kwargs=kwargs) for i in range(num_cpu)]
+
+    for worker in workers:
+        worker.start()
+
+    for worker in workers:
+        worker.join()
+
+#-------------------------------------------------------------------------------
+
+def cm_worker():
+    parser = argparse.ArgumentParser(description='Process ingestion work from the shared queue.')
+    parser.add_argument('-n',
+                        '--processes',
+                        type=int,
+                        default=1,
+                        help='number of worker processes on this host')
+    parser.add_argument('-s',
+                        '--stage',
+                        action='append',
+                        choices=sorted(INGEST_STAGES),
+                        help='only process this stage, can be given more than once')
+    parser.add_argument('-b',
+                        '--batch',
+                        type=int,
+                        default=10,
+                        help='number of items to claim at a time')
+    parser.add_argument('-l',
+                        '--lease',
+                        type=float,
+                        default=3600,
+                        help='seconds before an unfinished claim expires')
+    parser.add_argument('--forever',
+                        action='store_true',
+                        help='keep waiting for new work instead of exiting')
+    args = parser.parse_args()
+
+    setup_logging()
+
+    run_workers(args.processes,
+                stages=args.stage,
+                batch_size=args.batch,
+                lease=args.lease,
+                forever=args.forever)
+
+#-------------------------------------------------------------------------------
+
+def cm_compact():
+    parser = argparse.ArgumentParser(description='Convert the gain, darks and stims tables to the compact layout.')
+    parser.add_argument('--dry-run',
+                        action='store_true',
+                        help='only show the statements that would be run')
+    args = parser.parse_args()
+
+    setup_logging()
+
+    settings = open_settings()
+    Session, engine = load_connection(settings['connection_string'])
+
+    for statement in compact_tables(engine, dry_run=args.dry_run):
+        print(statement)
+
+    engine.dispose()
+
+#-------------------------------------------------------------------------------
+
 def ingest_all():
     setup_logging()
 
     settings = open_settings()
     Session, engine = load_connection(settings['connection_string'])
     Base.metadata.create_all(engine)
+    add_year_columns(engine)
+
+    if settings.get('partition_tables', False):
+        partition_tables(engine)
+
+    if settings.get('compact_tables', False):
+        compact_tables(engine)
 
     logger.info("Ingesting all data")
     insert_files(**settings)
-    populate_primary_headers(settings['num_cpu'])
-    populate_spt(settings['num_cpu'])
-    populate_data(settings['num_cpu'])
-    populate_lampflash(settings['num_cpu'])
-    populate_darks(settings['num_cpu'])
-    populate_gain(settings['num_cpu'])
-    populate_stims(settings['num_cpu'])
-    populate_acqs(settings['num_cpu'])
+
+    #-- Later stages rely on the headers being present, so in work queue
+    #-- mode each stage is drained before the next one is queued.
+    for populate in [populate_primary_headers,
+                     populate_spt,
+                     populate_data,
+                     populate_lampflash,
+                     populate_darks,
+                     populate_gain,
+                     populate_stims,
+                     populate_acqs]:
+        if settings.get('work_queue', False):
+            populate(queue=True)
+            run_workers(settings['num_cpu'])
+        else:
+            populate(settings['num_cpu'])
 
 #-------------------------------------------------------------------------------
 
@@ -780,6 +1145,12 @@ def run_all_monitors():
     settings = open_settings()
     Session, engine = load_connection(settings['connection_string'])
     Base.metadata.create_all(engine)
+    add_year_columns(engine)
+
+    from ..cci.monitor import monitor as cci_monitor
+    from ..dark.monitor import monitor as dark_monitor
+    from ..osm.monitor import monitor as osm_monitor
+    from ..stim.monitor import stim_monitor
 
     logger.info("Starting to run all monitors.")
 
@@ -1,9 +1,14 @@
 from __future__ import print_function, absolute_import, division
 
 import os
+import re
+import datetime
+import logging
+logger = logging.getLogger(__name__)
 
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import ForeignKey, Column, Index, Integer, String, Float, Boolean, Numeric, BigInteger, Text
+from sqlalchemy import ForeignKey, Column, Index, Integer, String, Float, Boolean, Numeric, BigInteger, Text, SmallInteger
+from sqlalchemy import inspect, text
 from sqlalchemy.dialects import mysql
 from sqlalchemy.engine import create_engine
 from sqlalchemy.orm import sessionmaker, relationship, backref
@@ -13,10 +18,63 @@ try:
 except ImportError:
     from .yaml import yaml
 
-__all__ = ['open_settings', 'load_connection']
+__all__ = ['open_settings', 'load_connection', 'add_year_columns', 'partition_tables', 'extend_partitions',
+           'compact_tables']
 
 Base = declarative_base()
 
+#-- Primary key of the very large tables.  SQLite only autoincrements
+#-- INTEGER keys, which are 64 bit there anyway.
+BigID = BigInteger().with_variant(Integer, 'sqlite')
+
+#-- Partitioning layout of the high-volume tables:
+#-- table name : segment column
+PARTITION_LAYOUT = {'gain': 'segment',
+                    'darks': 'detector',
+                    'stims': 'segment'}
+
+#-- SQL expression for the calendar year of each row of the tables with a
+#-- year column, by dialect, used to fill it in on existing tables
+YEAR_EXPRESSIONS = {'mysql': {'gain': "YEAR(DATE_ADD('1858-11-17', INTERVAL FLOOR(expstart) DAY))",
+                              'darks': "FLOOR(date)",
+                              'stims': "YEAR(DATE_ADD('1858-11-17', INTERVAL FLOOR(abs_time) DAY))"},
+                    'sqlite': {'gain': "CAST(strftime('%Y', julianday('1858-11-17') + expstart) AS INTEGER)",
+                               'darks': "CAST(date AS INTEGER)",
+                               'stims': "CAST(strftime('%Y', julianday('1858-11-17') + abs_time) AS INTEGER)"}}
+
+#-- Compact storage profile of the high-volume tables:
+#-- table name : [(column, MySQL type), ...]
+#-- FLOAT is single precision on MySQL, which is plenty for the measured
+#-- values, but only resolves MJDs to a few minutes, so those are DOUBLE.
+#-- Decimal years are stored to 3 places and fit in a FLOAT.
+SEGMENT_ENUM = "ENUM('','FUVA','FUVB')"
+DETECTOR_ENUM = "ENUM('','FUV','NUV')"
+COMPACT_LAYOUT = {'gain': [('x', 'SMALLINT UNSIGNED'),
+                           ('y', 'SMALLINT UNSIGNED'),
+                           ('gain', 'FLOAT'),
+                           ('counts', 'FLOAT'),
+                           ('std', 'FLOAT'),
+                           ('segment', SEGMENT_ENUM),
+                           ('dethv', 'SMALLINT'),
+                           ('expstart', 'DOUBLE')],
+                  'darks': [('detector', DETECTOR_ENUM),
+                            ('date', 'FLOAT'),
+                            ('dark', 'FLOAT'),
+                            ('ta_dark', 'FLOAT'),
+                            ('latitude', 'FLOAT'),
+                            ('longitude', 'FLOAT'),
+                            ('sun_lat', 'FLOAT'),
+                            ('sun_lon', 'FLOAT'),
+                            ('temp', 'FLOAT')],
+                  'stims': [('time', 'FLOAT'),
+                            ('abs_time', 'DOUBLE'),
+                            ('stim1_x', 'FLOAT'),
+                            ('stim1_y', 'FLOAT'),
+                            ('stim2_x', 'FLOAT'),
+                            ('stim2_y', 'FLOAT'),
+                            ('counts', 'FLOAT'),
+                            ('segment', SEGMENT_ENUM)]}
+
 #-------------------------------------------------------------------------------
 
 def open_settings(config_file=None):
@@ -75,6 +133,305 @@ def load_connection(connection_string, echo=False):
 
 #-------------------------------------------------------------------------------
 
+def add_year_columns(engine):
+    """Add the year column to gain, darks and stims tables created without it
+
+    The models expect the column whether or not the tables are partitioned,
+    so this is run every time the tables are set up.  Existing rows are
+    filled in from their dates where the dialect is known, and are 0
+    otherwise.  Tables that have the column, or do not exist yet, are left
+    alone.
+
+    Parameters
+    ----------
+    engine : engine object
+        Connection to the database.
+
+    Returns
+    -------
+    added : list
+        names of the tables the column was added to
+    """
+
+    inspector = inspect(engine)
+    existing = inspector.get_table_names()
+    expressions = YEAR_EXPRESSIONS.get(engine.dialect.name, {})
+
+    added = []
+    for table in sorted(PARTITION_LAYOUT):
+        if not table in existing:
+            continue
+
+        if 'year' in [column['name'] for column in inspector.get_columns(table)]:
+            continue
+
+        logger.info("Adding year column to {}".format(table))
+        engine.execute("ALTER TABLE {} ADD COLUMN year SMALLINT NOT NULL DEFAULT 0".format(table))
+
+        if table in expressions:
+            engine.execute("UPDATE {} SET year = COALESCE({}, 0)".format(table, expressions[table]))
+        else:
+            logger.warning("Can not fill in {}.year on {}, left at 0".format(table, engine.dialect.name))
+
+        added.append(table)
+
+    return added
+
+#-------------------------------------------------------------------------------
+
+def partition_statement(table, first_year=2009, last_year=None):
+    """ALTER TABLE statement partitioning table by year and segment
+
+    See partition_tables.
+    """
+
+    last_year = last_year or datetime.date.today().year + 1
+
+    partitions = ["PARTITION p_early VALUES LESS THAN ({})".format(first_year)]
+    partitions += ["PARTITION p{} VALUES LESS THAN ({})".format(year, year + 1)
+                   for year in range(first_year, last_year + 1)]
+    partitions.append("PARTITION p_future VALUES LESS THAN MAXVALUE")
+
+    return ("ALTER TABLE {} PARTITION BY RANGE (year) "
+            "SUBPARTITION BY KEY ({}) SUBPARTITIONS 3 "
+            "({})".format(table, PARTITION_LAYOUT[table], ', '.join(partitions)))
+
+#-------------------------------------------------------------------------------
+
+def extend_statement(table, last_partition, last_year=None):
+    """ALTER TABLE statement splitting yearly partitions off p_future
+
+    Parameters
+    ----------
+    table : str
+        name of a table partitioned by partition_statement
+    last_partition : int
+        year of the last yearly partition the table has
+    last_year : int, optional
+        last yearly partition wanted, defaults to next year
+
+    Returns
+    -------
+    statement : str or None
+        None if the table already has the partitions
+    """
+
+    last_year = last_year or datetime.date.today().year + 1
+    if last_partition >= last_year:
+        return None
+
+    partitions = ["PARTITION p{} VALUES LESS THAN ({})".format(year, year + 1)
+                  for year in range(last_partition + 1, last_year + 1)]
+    partitions.append("PARTITION p_future VALUES LESS THAN MAXVALUE")
+
+    return "ALTER TABLE {} REORGANIZE PARTITION p_future INTO ({})".format(table, ', '.join(partitions))
+
+#-------------------------------------------------------------------------------
+
+def extend_partitions(engine, last_year=None):
+    """Add the yearly partitions up to last_year to the partitioned tables
+
+    Rows past the last yearly partition land in p_future, where queries on
+    the year can no longer skip them, so this is run every time the tables
+    are set up.
+
+    Parameters
+    ----------
+    engine : engine object
+        Connection to the (MySQL) database.
+    last_year : int, optional
+        Last yearly partition, defaults to next year.
+    """
+
+    if not engine.dialect.name == 'mysql':
+        return
+
+    for table in sorted(PARTITION_LAYOUT):
+        names = [row[0] for row in engine.execute(text("""SELECT DISTINCT partition_name FROM information_schema.partitions
+                                                          WHERE table_schema = DATABASE()
+                                                          AND table_name = :table
+                                                          AND partition_name IS NOT NULL"""), table=table)]
+        years = [int(name[1:]) for name in names if name[1:].isdigit()]
+        if not years:
+            continue
+
+        statement = extend_statement(table, max(years), last_year)
+        if statement:
+            logger.info("Adding partitions after p{} to {}".format(max(years), table))
+            engine.execute(statement)
+
+#-------------------------------------------------------------------------------
+
+def partition_tables(engine, first_year=2009, last_year=None):
+    """Partition the gain, darks and stims tables by year and segment.
+
+    Each table is range partitioned on its integer ``year`` column, with every
+    year sub-partitioned by segment (or detector for the darks).  Queries that
+    constrain both keys only have to read the matching sub-partitions.
+
+    MySQL cannot partition on FLOAT columns or on tables with foreign keys, so
+    the ``year`` column is used as the range key and the ``file_id`` foreign
+    key constraints are dropped.  NULL segments are stored as ''.  Tables that
+    are already partitioned only get the yearly partitions they are missing
+    (see extend_partitions).
+
+    Parameters
+    ----------
+    engine : engine object
+        Connection to the (MySQL) database.
+    first_year : int, optional
+        First yearly partition, anything earlier goes into one partition.
+    last_year : int, optional
+        Last yearly partition, defaults to next year.  Later rows go into a
+        catch-all partition.
+    """
+
+    if not engine.dialect.name == 'mysql':
+        logger.warning("Partitioning only supported on MySQL, not {}".format(engine.dialect.name))
+        return
+
+    add_year_columns(engine)
+    inspector = inspect(engine)
+
+    for table, segment_col in PARTITION_LAYOUT.items():
+        n_partitions = engine.execute(text("""SELECT COUNT(*) FROM information_schema.partitions
+                                               WHERE table_schema = DATABASE()
+                                               AND table_name = :table
+                                               AND partition_name IS NOT NULL"""), table=table).scalar()
+        if n_partitions:
+            logger.debug("{} is already partitioned".format(table))
+            continue
+
+        logger.info("Partitioning {} by year and {}".format(table, segment_col))
+
+        engine.execute("UPDATE {0} SET {1} = '' WHERE {1} IS NULL".format(table, segment_col))
+
+        for foreign_key in inspector.get_foreign_keys(table):
+            engine.execute("ALTER TABLE {} DROP FOREIGN KEY {}".format(table, foreign_key['name']))
+
+        #-- keep the current type, the column may already be compacted
+        segment_type = engine.execute(text("""SELECT column_type FROM information_schema.columns
+                                              WHERE table_schema = DATABASE()
+                                              AND table_name = :table
+                                              AND column_name = :column"""), table=table, column=segment_col).scalar()
+        engine.execute("ALTER TABLE {} MODIFY {} {} NOT NULL DEFAULT ''".format(table, segment_col, segment_type))
+        engine.execute("ALTER TABLE {} DROP PRIMARY KEY, ADD PRIMARY KEY (id, year, {})".format(table, segment_col))
+        engine.execute(partition_statement(table, first_year, last_year))
+
+    extend_partitions(engine, last_year)
+
+#-------------------------------------------------------------------------------
+
+def _out_of_range(column, sql_type):
+    """SQL condition matching values that do not fit in sql_type"""
+
+    if sql_type.startswith('ENUM'):
+        return "{} NOT IN {}".format(column, sql_type[len('ENUM'):])
+    elif sql_type == 'SMALLINT UNSIGNED':
+        return "{} NOT BETWEEN 0 AND 65535".format(column)
+    elif sql_type == 'SMALLINT':
+        return "{} NOT BETWEEN -32768 AND 32767".format(column)
+
+    return None
+
+#-------------------------------------------------------------------------------
+
+def compact_statement(table, current):
+    """ALTER TABLE statement converting table to the compact layout
+
+    Parameters
+    ----------
+    table : str
+        name of a table in COMPACT_LAYOUT
+    current : dict
+        column name : (column type, nullable) as currently in the database
+
+    Returns
+    -------
+    statement : str or None
+        None if every column already has its compact type
+    """
+
+    changes = []
+    for column, sql_type in COMPACT_LAYOUT[table]:
+        if not column in current:
+            continue
+
+        column_type, nullable = current[column]
+        #-- older servers report integer display widths, e.g. smallint(5)
+        column_type = re.sub(r'\(\d+\)', '', column_type)
+        if column_type.replace(' ', '').lower() == sql_type.replace(' ', '').lower():
+            continue
+
+        definition = "MODIFY {} {}".format(column, sql_type)
+        if not nullable:
+            definition += " NOT NULL DEFAULT {}".format("''" if sql_type.startswith('ENUM') else 0)
+        changes.append(definition)
+
+    if not changes:
+        return None
+
+    return "ALTER TABLE {} {}".format(table, ', '.join(changes))
+
+#-------------------------------------------------------------------------------
+
+def compact_tables(engine, dry_run=False):
+    """Convert the gain, darks and stims tables to the compact layout in place.
+
+    Coordinates and high voltages become SMALLINTs and segment and detector
+    names become ENUMs, cutting the width of every row that the monitors
+    scan.  All columns of a table are changed in a single ALTER so each
+    table is only rebuilt once.  Columns holding values that would not fit
+    their compact type are left as they are.  Running it again only
+    converts what is left.
+
+    Parameters
+    ----------
+    engine : engine object
+        Connection to the (MySQL) database.
+    dry_run : bool, optional
+        Only log the statements that would be run.
+
+    Returns
+    -------
+    statements : list
+        ALTER TABLE statements that were (or would be) run
+    """
+
+    if not engine.dialect.name == 'mysql':
+        logger.warning("Compact layout only supported on MySQL, not {}".format(engine.dialect.name))
+        return []
+
+    statements = []
+    for table in sorted(COMPACT_LAYOUT):
+        current = {row.column_name: (row.column_type, row.is_nullable == 'YES')
+                   for row in engine.execute(text("""SELECT column_name, column_type, is_nullable
+                                                     FROM information_schema.columns
+                                                     WHERE table_schema = DATABASE()
+                                                     AND table_name = :table"""), table=table)}
+
+        for column, sql_type in COMPACT_LAYOUT[table]:
+            condition = _out_of_range(column, sql_type)
+            if column in current and condition is not None:
+                n_bad = engine.execute("SELECT COUNT(*) FROM {} WHERE {}".format(table, condition)).scalar()
+                if n_bad:
+                    logger.warning("{} rows of {}.{} do not fit {}, leaving it as is".format(n_bad, table, column, sql_type))
+                    del current[column]
+
+        statement = compact_statement(table, current)
+        if statement is None:
+            logger.debug("{} is already compact".format(table))
+            continue
+
+        logger.info(statement)
+        statements.append(statement)
+        if not dry_run:
+            engine.execute(statement)
+
+    return statements
+
+#-------------------------------------------------------------------------------
+
 class Darks(Base):
     __tablename__ = "darks"
 
@@ -91,6 +448,7 @@ class Darks(Base):
     sun_lat = Column(Float)
     sun_lon = Column(Float)
     temp = Column(Float)
+    year = Column(SmallInteger, nullable=False, default=0, server_default='0')
 
     file_id = Column(Integer, ForeignKey('files.id'))
     #file = relationship("Files", backref=backref('lampflash', order_by=id))
@@ -269,6 +627,7 @@ class Stims(Base):
     stim2_y = Column(Float)
     counts = Column(Float)
     segment = Column(String(4))
+    year = Column(SmallInteger, nullable=False, default=0, server_default='0')
     file_id = Column(Integer, ForeignKey('files.id'))
 
     __table_args__ = (Index('idx_rootname', 'rootname', unique=False), )
@@ -322,7 +681,7 @@ class Phd(Base):
 class Gain(Base):
     __tablename__ = 'gain'
 
-    id = Column(BigInteger, primary_key=True)
+    id = Column(BigID, primary_key=True)
 
     x = Column(Integer)
     y = Column(Integer)
@@ -332,6 +691,7 @@ class Gain(Base):
     segment = Column(String(4))
     dethv = Column(Integer)
     expstart = Column(Float)
+    year = Column(SmallInteger, nullable=False, default=0, server_default='0')
 
     file_id = Column(Integer, ForeignKey('files.id'))
     __table_args__ = (Index('coord', 'x', 'y', unique=False), )
@@ -392,7 +752,7 @@ class Acqs(Base):
 class Flagged(Base):
     __tablename__ = 'flagged'
 
-    id = Column(BigInteger, primary_key=True)
+    id = Column(BigID, primary_key=True)
 
     mjd = Column(Float)
     segment = Column(String(4))
@@ -407,7 +767,7 @@ class Flagged(Base):
 class GainTrends(Base):
     __tablename__ = 'gain_trends'
 
-    id = Column(BigInteger, primary_key=True)
+    id = Column(BigID, primary_key=True)
 
     mjd = Column(Float)
     segment = Column(String(4))
@@ -420,3 +780,59 @@ class GainTrends(Base):
     __table_args__ = (Index('coord', 'x', 'y', unique=False), )
 
 #-------------------------------------------------------------------------------
+
+class GainJumps(Base):
+    """Changes of more than 5 PHA between consecutive measurements of a
+    superpixel taken within 28 days"""
+    __tablename__ = 'gain_jumps'
+
+    id = Column(BigID, primary_key=True)
+
+    mjd = Column(Float)
+    previous_mjd = Column(Float)
+    gain_change = Column(Float)
+    segment = Column(String(4))
+    dethv = Column(Integer)
+    x = Column(Integer)
+    y = Column(Integer)
+
+    __table_args__ = (Index('coord', 'x', 'y', unique=False), )
+
+#-------------------------------------------------------------------------------
+
+class TrendProgress(Base):
+    """Gain rows included in the flagged and gain_trends results
+
+    See findbad.update_superpixel_trends.
+    """
+    __tablename__ = 'trend_progress'
+
+    id = Column(Integer, primary_key=True)
+
+    segment = Column(String(4))
+    dethv = Column(Integer)
+    last_gain_id = Column(BigInteger)
+    checked_gain_id = Column(BigInteger)
+    checked_rows = Column(BigInteger)
+    checked_at = Column(Float)
+
+#-------------------------------------------------------------------------------
+
+class WorkQueue(Base):
+    """Outstanding (file, ingestion stage) items for distributed workers"""
+    __tablename__ = 'work_queue'
+
+    id = Column(Integer, primary_key=True)
+
+    stage = Column(String(20))
+    status = Column(String(10))
+    worker = Column(String(64))
+    lease_expires = Column(Float)
+    attempts = Column(Integer, default=0)
+
+    file_id = Column(Integer, ForeignKey('files.id'))
+
+    __table_args__ = (Index('idx_stage_status', 'stage', 'status', unique=False),
+                      Index('idx_worker', 'worker', unique=False))
+
+#-------------------------------------------------------------------------------
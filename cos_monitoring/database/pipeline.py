@@ -0,0 +1,302 @@
+""" Pipelined ingestion: threaded readers feeding a single batched writer.
+
+Files pass through up to three stages connected by bounded queues, so a slow
+stage holds back the ones before it instead of filling memory.
+
+1. A pool of reader threads.  For I/O-bound extractors (header keywords,
+   lampflash tables, ...) the threads run the extractor itself.  For
+   CPU-bound extractors they read each file through once so that it is local
+   and in the page cache when a worker process opens it.  Decompressing .gz
+   files and waiting on network disk both release the GIL.
+2. For CPU-bound extractors (gain fitting, stim finding, dark rates) a pool of
+   worker processes runs the extractor on the prefetched files.
+3. A single writer thread collects the extracted columns and inserts them
+   in batches, committing once per batch.
+
+If the writer or the worker pool fails, the queues behind it keep being
+emptied so that nothing upstream blocks.  No more files are fed in, and the
+error is raised by pipeline_insert once the pipeline has drained.
+
+"""
+
+from __future__ import print_function, absolute_import, division
+
+import threading
+import collections
+import multiprocessing as mp
+import logging
+logger = logging.getLogger(__name__)
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from .db_tables import load_connection
+
+__all__ = ['pipeline_insert']
+
+#-- Sentinel marking the end of a queue
+_DONE = None
+
+#-------------------------------------------------------------------------------
+
+def prefetch(filename, chunk_size=16*1024*1024):
+    """Read filename through once so later reads come from the page cache"""
+
+    with open(filename, 'rb') as f:
+        while f.read(chunk_size):
+            pass
+
+#-------------------------------------------------------------------------------
+
+def _extract(args):
+    """Run extract_columns on a (file id, filename, function, kwargs) tuple
+
+    Module level so it can be sent to worker processes.  Unexpected errors
+    are logged rather than raised so one bad file cannot stall the pipeline.
+    """
+
+    #-- imported here to avoid a circular import with database.py
+    from .database import extract_columns
+
+    f_key, filename, function, kwargs = args
+
+    try:
+        columns = extract_columns(filename, function, f_key, **kwargs)
+    except Exception:
+        #-- Nothing is written, so the file is picked up again next ingest
+        logger.exception("Failed to extract rows from {}".format(filename))
+        columns = {'file_id': []}
+
+    return f_key, columns
+
+#-------------------------------------------------------------------------------
+
+def _reader(in_queue, out_queue, function, kwargs, cpu_bound):
+    while True:
+        item = in_queue.get()
+        if item is _DONE:
+            break
+
+        f_key, filename = item
+        if cpu_bound:
+            try:
+                prefetch(filename)
+            except IOError as e:
+                #-- the extractor will hit this again and record a blank entry
+                logger.warning(e)
+            out_queue.put((f_key, filename, function, kwargs))
+        else:
+            out_queue.put(_extract((f_key, filename, function, kwargs)))
+
+#-------------------------------------------------------------------------------
+
+def _merge_columns(batch):
+    """Join the column dictionaries of batch that share the same columns"""
+
+    merged = collections.OrderedDict()
+    for columns in batch:
+        key = tuple(columns)
+        if key not in merged:
+            merged[key] = columns
+        else:
+            for name in key:
+                merged[key][name].extend(columns[name])
+
+    return list(merged.values())
+
+#-------------------------------------------------------------------------------
+
+def _writer(row_queue, connection_string, table, batch_size, counts, errors):
+    """Insert the columns from row_queue in batches
+
+    The first error is appended to errors, after which the queue is only
+    emptied until _DONE.
+    """
+
+    #-- imported here to avoid a circular import with database.py
+    from .database import insert_columns
+
+    session = engine = None
+    batch = []
+    n_rows = 0
+    while True:
+        item = row_queue.get()
+        if errors:
+            if item is _DONE:
+                break
+            continue
+
+        if item is not _DONE:
+            f_key, columns = item
+            batch.append(columns)
+            n_rows += len(columns['file_id'])
+            counts['files'] += 1
+
+        try:
+            if session is None:
+                Session, engine = load_connection(connection_string)
+                session = Session()
+
+            if n_rows >= batch_size or (item is _DONE and n_rows):
+                connection = session.connection()
+                for columns in _merge_columns(batch):
+                    insert_columns(connection, table, columns, batch_size)
+                session.commit()
+                counts['rows'] += n_rows
+                logger.debug("wrote {} rows to {}".format(n_rows, table.__tablename__))
+                batch = []
+                n_rows = 0
+        except Exception as e:
+            logger.exception("Failed to write to {}".format(table.__tablename__))
+            errors.append(e)
+            batch = []
+            n_rows = 0
+            if session is not None:
+                session.rollback()
+
+        if item is _DONE:
+            break
+
+    if session is not None:
+        session.close()
+        engine.dispose()
+
+#-------------------------------------------------------------------------------
+
+def _iter_queue(in_queue):
+    while True:
+        item = in_queue.get()
+        if item is _DONE:
+            break
+        yield item
+
+#-------------------------------------------------------------------------------
+
+def _run_pool(ready_queue, row_queue, num_cpu, errors):
+    """Extract the files from ready_queue in worker processes
+
+    If a result can not be collected, e.g. it does not pickle, the error is
+    appended to errors so no more files are fed in, and ready_queue is
+    emptied so the readers finish before the error is raised.
+    """
+
+    #-- at most window files are handed to the pool at once, so the
+    #-- bounded ready_queue holds back the readers
+    window = 2 * num_cpu
+    pending = collections.deque()
+    drained = False
+
+    pool = mp.Pool(processes=num_cpu)
+    try:
+        for args in _iter_queue(ready_queue):
+            pending.append(pool.apply_async(_extract, (args,)))
+            if len(pending) >= window:
+                row_queue.put(pending.popleft().get())
+        drained = True
+
+        while pending:
+            row_queue.put(pending.popleft().get())
+        pool.close()
+    except BaseException as e:
+        logger.exception("Failed to collect extracted rows")
+        errors.append(e)
+        pool.terminate()
+        if not drained:
+            for args in _iter_queue(ready_queue):
+                pass
+        raise
+    finally:
+        pool.join()
+
+#-------------------------------------------------------------------------------
+
+def pipeline_insert(files_to_add, table, function, connection_string,
+                    cpu_bound=False, num_cpu=1, num_readers=4,
+                    batch_size=10000, queue_size=8, **kwargs):
+    """Extract rows from files_to_add and insert them into table
+
+    Parameters
+    ----------
+    files_to_add : list
+        (file id, full filename) pairs
+    table : sqlalchemy table object
+        The table of the database to update.
+    function : function
+        extractor to call on each file, as used by insert_with_yield
+    connection_string : str
+        database to write to
+    cpu_bound : bool, optional
+        run the extractor in worker processes instead of the reader threads
+    num_cpu : int, optional
+        number of worker processes for cpu_bound extractors
+    num_readers : int, optional
+        number of reader threads
+    batch_size : int, optional
+        number of rows per insert and commit
+    queue_size : int, optional
+        maximum number of files waiting between two stages
+    **kwargs
+        passed on to function
+
+    Returns
+    -------
+    counts : dict
+        number of files and rows written
+    """
+
+    counts = {'files': 0, 'rows': 0}
+    errors = []
+
+    file_queue = queue.Queue(maxsize=queue_size)
+    ready_queue = queue.Queue(maxsize=queue_size)
+    row_queue = queue.Queue(maxsize=queue_size)
+
+    writer = threading.Thread(target=_writer,
+                              args=(row_queue, connection_string, table, batch_size, counts, errors))
+    writer.start()
+
+    readers = [threading.Thread(target=_reader,
+                                args=(file_queue,
+                                      ready_queue if cpu_bound else row_queue,
+                                      function,
+                                      kwargs,
+                                      cpu_bound))
+                for i in range(num_readers)]
+    for reader in readers:
+        reader.start()
+
+    def feed():
+        for item in files_to_add:
+            if errors:
+                break
+            file_queue.put(item)
+        for reader in readers:
+            file_queue.put(_DONE)
+        for reader in readers:
+            reader.join()
+        if cpu_bound:
+            ready_queue.put(_DONE)
+
+    feeder = threading.Thread(target=feed)
+    feeder.start()
+
+    try:
+        if cpu_bound:
+            _run_pool(ready_queue, row_queue, num_cpu, errors)
+    finally:
+        feeder.join()
+        row_queue.put(_DONE)
+        writer.join()
+
+    if errors:
+        raise errors[0]
+
+    logger.info("Inserted {} rows from {} files into {}".format(counts['rows'],
+                                                                counts['files'],
+                                                                table.__tablename__))
+
+    return counts
+
+#-------------------------------------------------------------------------------
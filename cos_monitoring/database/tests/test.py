@@ -0,0 +1,381 @@
+import os
+import sys
+import subprocess
+import tempfile
+import threading
+import multiprocessing as mp
+import numpy as np
+from sqlalchemy.schema import CreateTable
+
+from ..db_tables import load_connection, Files, WorkQueue, Lampflash, Gain, compact_statement
+from ..db_tables import add_year_columns, partition_statement, extend_statement
+from .. import workqueue
+from ..pipeline import pipeline_insert
+from ..database import extract_columns, insert_columns
+
+#-------------------------------------------------------------------------------
+
+def make_queue(n_files):
+    """Create a sqlite stand-in database holding n_files queued items"""
+
+    db_file = os.path.join(tempfile.mkdtemp(), 'queue.db')
+    connection_string = 'sqlite:///{}'.format(db_file)
+
+    Session, engine = load_connection(connection_string)
+    Files.__table__.create(engine)
+    WorkQueue.__table__.create(engine)
+
+    session = Session()
+    session.add_all([Files(path='/data', name='file_{}.fits'.format(i)) for i in range(n_files)])
+    session.commit()
+
+    file_ids = [row.id for row in session.query(Files.id)]
+    workqueue.enqueue(session, 'test', file_ids)
+    session.close()
+    engine.dispose()
+
+    return connection_string, file_ids
+
+#-------------------------------------------------------------------------------
+
+def drain(connection_string, done):
+    Session, engine = load_connection(connection_string)
+    session = Session()
+
+    while True:
+        token, items = workqueue.claim_batch(session, batch_size=3)
+        if not items:
+            break
+
+        for item_id, file_id, stage, filename in items:
+            done.put(file_id)
+            workqueue.complete(session, token, item_id)
+
+    session.close()
+    engine.dispose()
+
+#-------------------------------------------------------------------------------
+
+def test_enqueue_skips_queued():
+    connection_string, file_ids = make_queue(5)
+
+    Session, engine = load_connection(connection_string)
+    session = Session()
+
+    assert workqueue.enqueue(session, 'test', file_ids) == 0, "Items were queued twice"
+    assert workqueue.enqueue(session, 'other', file_ids) == 5, "Stages should be queued separately"
+
+#-------------------------------------------------------------------------------
+
+def test_claims_are_exclusive():
+    connection_string, file_ids = make_queue(60)
+
+    done = mp.Queue()
+    workers = [mp.Process(target=drain, args=(connection_string, done)) for i in range(4)]
+    for worker in workers:
+        worker.start()
+
+    processed = [done.get(timeout=60) for file_id in file_ids]
+
+    for worker in workers:
+        worker.join()
+
+    assert sorted(processed) == sorted(file_ids), "Every item should be processed once"
+    assert done.empty(), "Items were processed more than once"
+
+#-------------------------------------------------------------------------------
+
+def test_expired_lease_reclaimed():
+    connection_string, file_ids = make_queue(4)
+
+    Session, engine = load_connection(connection_string)
+    session = Session()
+
+    crashed_token, crashed_items = workqueue.claim_batch(session, batch_size=10, lease=-1)
+    assert len(crashed_items) == 4
+
+    token, items = workqueue.claim_batch(session, batch_size=10)
+    assert sorted(items) == sorted(crashed_items), "Expired items should be claimable"
+
+    token, items = workqueue.claim_batch(session, batch_size=10)
+    assert not items, "Items with a live lease should not be claimable"
+
+#-------------------------------------------------------------------------------
+
+def test_lost_claim_not_completed():
+    connection_string, file_ids = make_queue(3)
+
+    Session, engine = load_connection(connection_string)
+    engine.execute(CreateTable(Lampflash.__table__))
+    slow, fast = Session(), Session()
+
+    slow_token, slow_items = workqueue.claim_batch(slow, batch_size=10, lease=-1)
+    fast_token, fast_items = workqueue.claim_batch(fast, batch_size=10)
+    assert sorted(slow_items) == sorted(fast_items)
+
+    #-- both workers finish, results go in with the completion
+    for session, token, items in ((slow, slow_token, slow_items), (fast, fast_token, fast_items)):
+        for item_id, file_id, stage, filename in items:
+            if workqueue.complete(session, token, item_id, commit=False):
+                session.add(Lampflash(file_id=file_id))
+            session.commit()
+
+    assert sorted(row.file_id for row in fast.query(Lampflash.file_id)) == sorted(file_ids), "Rows should be written once"
+    assert not workqueue.outstanding(fast)
+
+#-------------------------------------------------------------------------------
+
+def read_flashes(filename):
+    """Stand-in extractor that re-yields one dictionary, like pull_flashes"""
+
+    with open(filename) as f:
+        n_flash = int(f.read())
+
+    info = {'rootname': os.path.basename(filename)[:9]}
+    for i in range(n_flash):
+        info['flash'] = i
+        info['x_shift'] = np.float64(i / 2.)
+        yield info
+
+#-------------------------------------------------------------------------------
+
+def run_pipeline(cpu_bound):
+    data_dir = tempfile.mkdtemp()
+    connection_string = 'sqlite:///{}'.format(os.path.join(data_dir, 'pipe.db'))
+
+    Session, engine = load_connection(connection_string)
+    Lampflash.__table__.create(engine)
+
+    files_to_add = []
+    for i in range(20):
+        filename = os.path.join(data_dir, 'l{:08d}_lampflash.fits'.format(i))
+        with open(filename, 'w') as f:
+            f.write(str(i % 4))
+        files_to_add.append((i, filename))
+    files_to_add.append((99, os.path.join(data_dir, 'missing')))
+
+    counts = pipeline_insert(files_to_add, Lampflash, read_flashes, connection_string,
+                             cpu_bound=cpu_bound, num_cpu=2, num_readers=3,
+                             batch_size=7, queue_size=2)
+
+    session = Session()
+    rows = session.query(Lampflash.file_id, Lampflash.flash, Lampflash.x_shift).all()
+    session.close()
+    engine.dispose()
+
+    expected = sorted([(i, j, j / 2.) for i in range(20) for j in range(i % 4)] + [(99, None, None)])
+
+    assert counts['files'] == len(files_to_add)
+    assert counts['rows'] == len(expected)
+    assert sorted(rows, key=str) == sorted(expected, key=str), "Rows differ from the extractor output"
+
+#-------------------------------------------------------------------------------
+
+def test_pipeline_threads():
+    run_pipeline(cpu_bound=False)
+
+#-------------------------------------------------------------------------------
+
+def test_pipeline_processes():
+    run_pipeline(cpu_bound=True)
+
+#-------------------------------------------------------------------------------
+
+#-- Import time allowed for the database module used by the command line
+#-- tools, and the packages it should leave to the monitors.
+IMPORT_BUDGET = 1.0
+HEAVY_MODULES = ['matplotlib', 'scipy', 'calcos', 'fitsio', 'bs4', 'astropy']
+
+def test_import_budget():
+    code = ("import sys, time; start = time.time(); "
+            "import cos_monitoring.database.database; "
+            "print(time.time() - start); print(' '.join(sys.modules))")
+    package_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+    #-- run twice so the first run can write the bytecode cache
+    for i in range(2):
+        output = subprocess.check_output([sys.executable, '-c', code],
+                                         cwd=package_dir,
+                                         universal_newlines=True).splitlines()
+
+    elapsed = float(output[0])
+    loaded = {name.split('.')[0] for name in output[1].split()}
+
+    assert not loaded.intersection(HEAVY_MODULES), "Loaded {}".format(sorted(loaded.intersection(HEAVY_MODULES)))
+    assert elapsed < IMPORT_BUDGET, "Import took {:.2f}s".format(elapsed)
+
+#-------------------------------------------------------------------------------
+
+def test_pipeline_write_error():
+    data_dir = tempfile.mkdtemp()
+    connection_string = 'sqlite:///{}'.format(os.path.join(data_dir, 'empty.db'))
+
+    files_to_add = []
+    for i in range(30):
+        filename = os.path.join(data_dir, 'l{:08d}_lampflash.fits'.format(i))
+        with open(filename, 'w') as f:
+            f.write('2')
+        files_to_add.append((i, filename))
+
+    #-- the lampflash table was never created, so every insert fails
+    for cpu_bound in (False, True):
+        errors = []
+
+        def run():
+            try:
+                pipeline_insert(files_to_add, Lampflash, read_flashes, connection_string,
+                                cpu_bound=cpu_bound, num_cpu=2, num_readers=3,
+                                batch_size=1, queue_size=2)
+            except Exception as e:
+                errors.append(e)
+
+        thread = threading.Thread(target=run)
+        thread.start()
+        thread.join(60)
+
+        assert not thread.is_alive(), "Pipeline hung after a write error"
+        assert len(errors) == 1, "The write error should be raised"
+
+def read_unpicklable(filename):
+    """Stand-in extractor whose rows can not be sent back from a worker"""
+
+    return {'x': np.arange(3), 'callback': lambda: None}
+
+#-------------------------------------------------------------------------------
+
+def test_pipeline_worker_error():
+    data_dir = tempfile.mkdtemp()
+    connection_string = 'sqlite:///{}'.format(os.path.join(data_dir, 'gain.db'))
+    Session, engine = load_connection(connection_string)
+    Gain.__table__.create(engine)
+
+    files_to_add = []
+    for i in range(30):
+        filename = os.path.join(data_dir, str(i))
+        with open(filename, 'w') as f:
+            f.write('3')
+        files_to_add.append((i, filename))
+
+    errors = []
+
+    def run():
+        try:
+            pipeline_insert(files_to_add, Gain, read_unpicklable, connection_string,
+                            cpu_bound=True, num_cpu=2, num_readers=3, queue_size=2)
+        except Exception as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    thread.join(60)
+
+    assert not thread.is_alive(), "Pipeline hung after a worker error"
+    assert len(errors) == 1, "The worker error should be raised"
+    engine.dispose()
+
+#-------------------------------------------------------------------------------
+
+def test_compact_statement():
+    current = {'x': ('int(11)', True),
+               'y': ('smallint(5) unsigned', True),
+               'segment': ('varchar(4)', False),
+               'expstart': ('float', True)}
+
+    statement = compact_statement('gain', current)
+
+    assert statement == ("ALTER TABLE gain MODIFY x SMALLINT UNSIGNED, "
+                         "MODIFY segment ENUM('','FUVA','FUVB') NOT NULL DEFAULT '', "
+                         "MODIFY expstart DOUBLE"), statement
+
+    current = {'x': ('smallint unsigned', True),
+               'segment': ("enum('','FUVA','FUVB')", True)}
+
+    assert compact_statement('gain', current) is None, "Compact columns should be left alone"
+
+#-------------------------------------------------------------------------------
+
+def read_gain(filename):
+    """Stand-in extractor returning columns, like write_and_pull_gainmap"""
+
+    n_pixels = int(os.path.basename(filename))
+    if not n_pixels:
+        return {'segment': 'FUVA', 'dethv': 167}
+
+    return {'segment': 'FUVA',
+            'dethv': 167,
+            'x': np.arange(n_pixels, dtype=np.int32),
+            'y': np.full(n_pixels, 3, dtype=np.int32),
+            'gain': np.linspace(2, 12, n_pixels)}
+
+#-------------------------------------------------------------------------------
+
+def test_column_rows():
+    columns = extract_columns('4', read_gain, 12)
+
+    assert all(len(value) == 4 for value in columns.values())
+    assert {key: value[-1] for key, value in columns.items()} == {'segment': 'FUVA', 'dethv': 167, 'x': 3, 'y': 3,
+                                                                  'gain': 12.0, 'file_id': 12}
+    assert all(type(value[0]) in (int, float, str) for value in columns.values()), "Values should be native types"
+
+    assert extract_columns('0', read_gain, 13) == {'segment': ['FUVA'], 'dethv': [167], 'file_id': [13]}
+
+    data_dir = tempfile.mkdtemp()
+    connection_string = 'sqlite:///{}'.format(os.path.join(data_dir, 'gain.db'))
+    Session, engine = load_connection(connection_string)
+    Gain.__table__.create(engine)
+
+    with engine.begin() as connection:
+        assert insert_columns(connection, Gain, extract_columns('7', read_gain, 20), chunk_size=3) == 7
+    assert engine.execute("SELECT COUNT(*), MAX(x), MIN(year) FROM gain WHERE file_id = 20").fetchone() == (7, 6, 0)
+    engine.execute("DELETE FROM gain")
+
+    counts = pipeline_insert([(1, '1000'), (2, '0'), (3, '10')], Gain, read_gain, connection_string,
+                             num_readers=2, batch_size=100)
+
+    session = Session()
+    assert counts['rows'] == session.query(Gain).count() == 1011
+    assert session.query(Gain).filter(Gain.file_id == 2).one().gain is None
+    session.close()
+    engine.dispose()
+
+#-------------------------------------------------------------------------------
+
+def test_year_column():
+    connection_string = 'sqlite:///{}'.format(os.path.join(tempfile.mkdtemp(), 'old.db'))
+    Session, engine = load_connection(connection_string)
+
+    #-- a gain table from before the year column
+    engine.execute("""CREATE TABLE gain (id INTEGER PRIMARY KEY, x INTEGER, y INTEGER, gain FLOAT,
+                                         counts FLOAT, std FLOAT, segment VARCHAR(4), dethv INTEGER,
+                                         expstart FLOAT, file_id INTEGER)""")
+    engine.execute("INSERT INTO gain (x, y, gain, segment, dethv, expstart) VALUES (1, 2, 8.5, 'FUVA', 167, 55400.5)")
+
+    assert add_year_columns(engine) == ['gain']
+    assert add_year_columns(engine) == [], "The column should only be added once"
+
+    session = Session()
+    session.add(Gain(x=3, y=2, gain=7., segment='FUVA', dethv=167, expstart=57000., year=2014))
+    session.commit()
+
+    rows = sorted((row.x, row.year) for row in session.query(Gain).filter(Gain.year>=2010))
+    assert rows == [(1, 2010), (3, 2014)]
+    session.close()
+    engine.dispose()
+
+    statement = partition_statement('gain', first_year=2009, last_year=2011)
+    assert statement == ("ALTER TABLE gain PARTITION BY RANGE (year) "
+                         "SUBPARTITION BY KEY (segment) SUBPARTITIONS 3 "
+                         "(PARTITION p_early VALUES LESS THAN (2009), "
+                         "PARTITION p2009 VALUES LESS THAN (2010), "
+                         "PARTITION p2010 VALUES LESS THAN (2011), "
+                         "PARTITION p2011 VALUES LESS THAN (2012), "
+                         "PARTITION p_future VALUES LESS THAN MAXVALUE)"), statement
+
+    statement = extend_statement('gain', 2011, last_year=2013)
+    assert statement == ("ALTER TABLE gain REORGANIZE PARTITION p_future INTO "
+                         "(PARTITION p2012 VALUES LESS THAN (2013), "
+                         "PARTITION p2013 VALUES LESS THAN (2014), "
+                         "PARTITION p_future VALUES LESS THAN MAXVALUE)"), statement
+    assert extend_statement('gain', 2013, last_year=2013) is None, "Nothing to add"
+
+#-------------------------------------------------------------------------------
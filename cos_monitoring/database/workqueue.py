@@ -0,0 +1,226 @@
+""" Database-backed work queue to spread ingestion over several hosts.
+
+Pending (file_id, stage) items are written to the work_queue table.  Workers
+on any host claim batches of them and hold the claim under a lease.  Items are
+removed once processed, and items whose lease has run out (e.g. the worker
+crashed) can be claimed again by anyone.
+
+Claims are made with a conditional UPDATE that re-checks the claimable state
+of every row, so two workers can never both own an item.  A slow worker can
+still lose an expired claim to another one while it is processing, so the
+results of an item must be written in the same transaction as complete(),
+which only removes the item while the caller still holds the claim.  The
+results of a lost claim are then rolled back instead of written twice.  Where the database
+supports it the candidate rows are first selected with
+``SELECT ... FOR UPDATE SKIP LOCKED`` so concurrent workers do not contend for
+the same rows.
+
+"""
+
+from __future__ import print_function, absolute_import, division
+
+import os
+import socket
+import time
+import uuid
+import logging
+logger = logging.getLogger(__name__)
+
+from sqlalchemy import and_, or_
+
+from .db_tables import Files, WorkQueue
+
+__all__ = ['enqueue', 'claim_batch', 'renew', 'complete', 'release', 'outstanding']
+
+PENDING = 'pending'
+CLAIMED = 'claimed'
+FAILED = 'failed'
+
+#-------------------------------------------------------------------------------
+
+def _claimable(now):
+    return or_(WorkQueue.status == PENDING,
+               and_(WorkQueue.status == CLAIMED,
+                    WorkQueue.lease_expires < now))
+
+#-------------------------------------------------------------------------------
+
+def enqueue(session, stage, file_ids):
+    """Add work items for stage that are not already in the queue
+
+    Parameters
+    ----------
+    session : session object
+        database session
+    stage : str
+        name of the ingestion stage
+    file_ids : list
+        ids from the files table to be processed
+
+    Returns
+    -------
+    n_added : int
+        number of new items
+    """
+
+    queued = {row.file_id for row in session.query(WorkQueue.file_id).filter(WorkQueue.stage == stage)}
+    new_ids = sorted(set(file_ids) - queued)
+
+    session.bulk_insert_mappings(WorkQueue, [{'file_id': file_id,
+                                              'stage': stage,
+                                              'status': PENDING,
+                                              'attempts': 0} for file_id in new_ids])
+    session.commit()
+
+    logger.info("Queued {} new items for {}".format(len(new_ids), stage))
+
+    return len(new_ids)
+
+#-------------------------------------------------------------------------------
+
+def claim_batch(session, batch_size=10, lease=3600, stages=None, skip_locked=None):
+    """Atomically claim up to batch_size claimable items
+
+    Parameters
+    ----------
+    session : session object
+        database session
+    batch_size : int, optional
+        maximum number of items to claim
+    lease : float, optional
+        seconds before the claim expires and the items can be taken by others
+    stages : list, optional
+        only claim items from these stages
+    skip_locked : bool, optional
+        select candidates with FOR UPDATE SKIP LOCKED, defaults to True on
+        MySQL and PostgreSQL.
+
+    Returns
+    -------
+    token : str
+        identifier of this claim, needed to renew, complete or release it
+    items : list
+        (item id, file id, stage, full path) of each claimed item
+    """
+
+    now = time.time()
+    token = '{}:{}:{}'.format(socket.gethostname(), os.getpid(), uuid.uuid4().hex)[-64:]
+
+    if skip_locked is None:
+        skip_locked = session.bind.dialect.name in ('mysql', 'postgresql')
+
+    query = session.query(WorkQueue.id).filter(_claimable(now))
+    if stages:
+        query = query.filter(WorkQueue.stage.in_(stages))
+    query = query.order_by(WorkQueue.id).limit(batch_size)
+    if skip_locked:
+        query = query.with_for_update(skip_locked=True)
+
+    candidates = [row.id for row in query]
+
+    if candidates:
+        #-- Rows taken by someone else since the select fail the re-check
+        session.query(WorkQueue).\
+            filter(WorkQueue.id.in_(candidates)).\
+            filter(_claimable(now)).\
+            update({WorkQueue.status: CLAIMED,
+                    WorkQueue.worker: token,
+                    WorkQueue.lease_expires: now + lease,
+                    WorkQueue.attempts: WorkQueue.attempts + 1},
+                   synchronize_session=False)
+    session.commit()
+
+    if not candidates:
+        return token, []
+
+    items = [(row.id, row.file_id, row.stage, os.path.join(row.path, row.name))
+                for row in session.query(WorkQueue.id, WorkQueue.file_id, WorkQueue.stage, Files.path, Files.name).\
+                    join(Files, Files.id == WorkQueue.file_id).\
+                    filter(WorkQueue.worker == token).\
+                    order_by(WorkQueue.id)]
+
+    logger.debug("{} claimed {} items".format(token, len(items)))
+
+    return token, items
+
+#-------------------------------------------------------------------------------
+
+def renew(session, token, lease=3600):
+    """Extend the lease on all items still held under token"""
+
+    session.query(WorkQueue).\
+        filter(WorkQueue.worker == token).\
+        filter(WorkQueue.status == CLAIMED).\
+        update({WorkQueue.lease_expires: time.time() + lease},
+               synchronize_session=False)
+    session.commit()
+
+#-------------------------------------------------------------------------------
+
+def complete(session, token, item_id, commit=True):
+    """Remove a processed item from the queue if the claim is still held
+
+    Parameters
+    ----------
+    session : session object
+        database session
+    token : str
+        claim the item was taken under
+    item_id : int
+        id of the item
+    commit : bool, optional
+        commit straight away.  Pass False to write the results of the item
+        in the same transaction, and only if True is returned.
+
+    Returns
+    -------
+    held : bool
+        False if the claim was lost to another worker
+    """
+
+    n_removed = session.query(WorkQueue).\
+                    filter(WorkQueue.id == item_id).\
+                    filter(WorkQueue.worker == token).\
+                    filter(WorkQueue.status == CLAIMED).\
+                    delete(synchronize_session=False)
+    if commit:
+        session.commit()
+
+    if not n_removed:
+        logger.warning("Lease on item {} was lost before it completed".format(item_id))
+
+    return bool(n_removed)
+
+#-------------------------------------------------------------------------------
+
+def release(session, token, item_id, max_attempts=3):
+    """Give a failed item back to the queue
+
+    Items that have already been attempted max_attempts times are marked as
+    failed and will not be claimed again.
+    """
+
+    item = session.query(WorkQueue).\
+               filter(WorkQueue.id == item_id).\
+               filter(WorkQueue.worker == token).\
+               first()
+
+    if item is not None:
+        item.status = FAILED if item.attempts >= max_attempts else PENDING
+        item.worker = None
+        item.lease_expires = None
+
+    session.commit()
+
+#-------------------------------------------------------------------------------
+
+def outstanding(session, stages=None):
+    """Number of items that are pending or claimed"""
+
+    query = session.query(WorkQueue).filter(WorkQueue.status.in_([PENDING, CLAIMED]))
+    if stages:
+        query = query.filter(WorkQueue.stage.in_(stages))
+
+    return query.count()
+
+#-------------------------------------------------------------------------------
@@ -10,6 +10,8 @@ import multiprocessing as mp
 
 from scipy.signal import medfilt
 
+from cos_monitoring.cci.gainmap import total_gain_at_hv
+
 #-------------------------------------------------------------------------------
 
 def enlarge(a, x=2, y=None):
@@ -421,12 +423,11 @@ def simulate(args_list):
 
     all_cenwaves = [1055, 1096, 1105, 1222, 1280, 1291, 1300, 1309, 1318, 1327, 1577, 1589, 1600, 1611, 1623]
 
-    seg_ext = {'FUVA':1, 'FUVB':2}
     gainmap_dir = '/grp/hst/cos/Monitors/CCI'
 
     print('Creating usage arrays')
-    gainmap = pyfits.getdata( os.path.join( gainmap_dir, 'total_gain_{}.fits'.format( gain_start ) ),
-                              ext=seg_ext[segment] )
+    gainmap = total_gain_at_hv( segment, gain_start, 'INIT', binned=False,
+                                filename=os.path.join( gainmap_dir, 'total_gain.fits' ) )
 
     all_degrade_array = assemble_degrade( life_adj, segment, *all_cenwaves )
 
@@ -1,26 +1,30 @@
+import os
 import matplotlib.pyplot as plt
 import pyfits
 import numpy as np
 
+from cos_monitoring.cci.gainmap import total_gain_at_hv
+
 #plt.ioff()
 plt.ion()
 
 gsagtab = pyfits.open('/grp/hst/cdbs/lref/x6l1439el_gsag.fits')
 xtractab = pyfits.open('/grp/hst/cdbs/lref/x6q17586l_1dx.fits')
-gainmap = pyfits.open('/grp/hst/cos/coslife/gainmaps/total_gain_163.fits')
+gainmap_dir = '/grp/hst/cos/coslife/gainmaps'
 
 def show( segment='FUVB' ):
     fig = plt.figure( figsize=(24,12) )
     ax = fig.add_subplot( 1,1,1 )
 
     if segment == 'FUVA':
-        ext = 1
         gsag_ext = 24
     elif segment == 'FUVB':
-        ext = 2
         gsag_ext = 63
 
-    ax.imshow( gainmap[ext].data, aspect='auto', interpolation='nearest', vmin=0, vmax=20, cmap=plt.get_cmap('Greys') )
+    gainmap = total_gain_at_hv( segment, 163, 'INIT', binned=False,
+                                filename=os.path.join( gainmap_dir, 'total_gain.fits' ) )
+
+    ax.imshow( gainmap, aspect='auto', interpolation='nearest', vmin=0, vmax=20, cmap=plt.get_cmap('Greys') )
     
     for i, row in enumerate( gsagtab[gsag_ext].data ):
         lx = row['lx']
@@ -31,7 +31,7 @@ from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 
 from ..database.db_tables import open_settings, load_connection
-from ..utils import remove_if_there
+from ..utils import remove_if_there, mjd_to_year
 
 #-------------------------------------------------------------------------------
 
@@ -173,6 +173,7 @@ def locate_stims(fits_file, start=0, increment=None, brf_file=None):
 
             stim_info['time'] = round(sub_start, 5)
             stim_info['abs_time'] = round(ABS_TIME, 5)
+            stim_info['year'] = mjd_to_year(ABS_TIME)
             stim_info['stim1_x'] = round(found_ul_x, 3)
             stim_info['stim1_y'] = round(found_ul_y, 3)
             stim_info['stim2_x'] = round(found_lr_x, 3)
@@ -357,6 +358,7 @@ def make_plots(out_dir, connection_string):
                                     FROM stims
                                     JOIN headers on stims.rootname = headers.rootname
                                     WHERE headers.segment = 'FUVA' AND
+                                        stims.segment = 'FUVA' AND
                                         stims.stim1_x != -999 AND
                                         stims.stim1_y != -999 AND
                                         stims.stim2_x != -999 AND
@@ -394,6 +396,7 @@ def make_plots(out_dir, connection_string):
                                     FROM stims
                                     JOIN headers on stims.rootname = headers.rootname
                                     WHERE headers.segment = 'FUVA' AND
+                                        stims.segment = 'FUVA' AND
                                         stims.stim1_x != -999 AND
                                         stims.stim1_y != -999 AND
                                         stims.stim2_x != -999 AND
@@ -429,6 +432,7 @@ def make_plots(out_dir, connection_string):
                                     FROM stims
                                     JOIN headers on stims.rootname = headers.rootname
                                     WHERE headers.segment = 'FUVB' AND
+                                        stims.segment = 'FUVB' AND
                                         stims.stim1_x != -999 AND
                                         stims.stim1_y != -999 AND
                                         stims.stim2_x != -999 AND
@@ -464,6 +468,7 @@ def make_plots(out_dir, connection_string):
                                     FROM stims
                                     JOIN headers on stims.rootname = headers.rootname
                                     WHERE headers.segment = 'FUVB' AND
+                                        stims.segment = 'FUVB' AND
                                         stims.stim1_x != -999 AND
                                         stims.stim1_y != -999 AND
                                         stims.stim2_x != -999 AND
@@ -519,11 +524,12 @@ def make_plots(out_dir, connection_string):
             query = """SELECT stims.abs_time, stims.{}
                               FROM stims
                               JOIN headers ON stims.rootname = headers.rootname
-                              WHERE headers.segment = '{}' AND
+                              WHERE headers.segment = '{segment}' AND
+                                  stims.segment = '{segment}' AND
                                   stims.stim1_x != -999 AND
                                   stims.stim1_y != -999 AND
                                   stims.stim2_x != -999 AND
-                                  stims.stim2_y != -999;""".format(column, segment)
+                                  stims.stim2_y != -999;""".format(column, segment=segment)
             data = [line for line in engine.execute(query)]
 
 
@@ -551,11 +557,12 @@ def make_plots(out_dir, connection_string):
         query = """SELECT stims.abs_time, stims.stim2_x - stims.stim1_x as stretch
                           FROM stims
                           JOIN headers ON stims.rootname = headers.rootname
-                          WHERE headers.segment = '{}' AND
+                          WHERE headers.segment = '{segment}' AND
+                              stims.segment = '{segment}' AND
                               stims.stim1_x != -999 AND
                               stims.stim1_y != -999 AND
                               stims.stim2_x != -999 AND
-                              stims.stim2_y != -999;""".format(segment)
+                              stims.stim2_y != -999;""".format(segment=segment)
         data = [line for line in engine.execute(query)]
         stretch = [line.stretch for line in data]
         times = [line.abs_time for line in data]
@@ -568,11 +575,12 @@ def make_plots(out_dir, connection_string):
         query = """SELECT stims.abs_time, .5*(stims.stim2_x + stims.stim1_x) as midpoint
                           FROM stims
                           JOIN headers ON stims.rootname = headers.rootname
-                          WHERE headers.segment = '{}' AND
+                          WHERE headers.segment = '{segment}' AND
+                              stims.segment = '{segment}' AND
                               stims.stim1_x != -999 AND
                               stims.stim1_y != -999 AND
                               stims.stim2_x != -999 AND
-                              stims.stim2_y != -999;""".format(segment)
+                              stims.stim2_y != -999;""".format(segment=segment)
         data = [line for line in engine.execute(query)]
         midpoint = [line.midpoint for line in data]
         times = [line.abs_time for line in data]
@@ -585,11 +593,12 @@ def make_plots(out_dir, connection_string):
         query = """SELECT stims.abs_time, stims.stim2_y - stims.stim1_y as stretch
                           FROM stims
                           JOIN headers ON stims.rootname = headers.rootname
-                          WHERE headers.segment = '{}' AND
+                          WHERE headers.segment = '{segment}' AND
+                              stims.segment = '{segment}' AND
                               stims.stim1_x != -999 AND
                               stims.stim1_y != -999 AND
                               stims.stim2_x != -999 AND
-                              stims.stim2_y != -999;""".format(segment)
+                              stims.stim2_y != -999;""".format(segment=segment)
         data = [line for line in engine.execute(query)]
         stretch = [line.stretch for line in data]
         times = [line.abs_time for line in data]
@@ -601,11 +610,12 @@ def make_plots(out_dir, connection_string):
         query = """SELECT stims.abs_time, .5*(stims.stim2_y + stims.stim1_y) as midpoint
                           FROM stims
                           JOIN headers ON stims.rootname = headers.rootname
-                          WHERE headers.segment = '{}' AND
+                          WHERE headers.segment = '{segment}' AND
+                              stims.segment = '{segment}' AND
                               stims.stim1_x != -999 AND
                               stims.stim1_y != -999 AND
                               stims.stim2_x != -999 AND
-                              stims.stim2_y != -999;""".format(segment)
+                              stims.stim2_y != -999;""".format(segment=segment)
         ax4.plot(times, midpoint, 'o')
         ax4.set_xlabel('MJD')
         ax4.set_ylabel('Midpoint Y')
@@ -626,6 +636,7 @@ def make_plots(out_dir, connection_string):
                                     FROM stims
                                     JOIN headers on stims.rootname = headers.rootname
                                     WHERE headers.segment = 'FUVA' AND
+                                        stims.segment = 'FUVA' AND
                                         stims.stim1_x != -999 AND
                                         stims.stim1_y != -999 AND
                                         stims.stim2_x != -999 AND
@@ -651,6 +662,7 @@ def make_plots(out_dir, connection_string):
                                     FROM stims
                                     JOIN headers on stims.rootname = headers.rootname
                                     WHERE headers.segment = 'FUVA' AND
+                                        stims.segment = 'FUVA' AND
                                         stims.stim1_x != -999 AND
                                         stims.stim1_y != -999 AND
                                         stims.stim2_x != -999 AND
@@ -676,6 +688,7 @@ def make_plots(out_dir, connection_string):
                                         FROM stims
                                         JOIN headers on stims.rootname = headers.rootname
                                         WHERE headers.segment = 'FUVB' AND
+                                            stims.segment = 'FUVB' AND
                                             stims.stim1_x != -999 AND
                                             stims.stim1_y != -999 AND
                                             stims.stim2_x != -999 AND
@@ -701,6 +714,7 @@ def make_plots(out_dir, connection_string):
                                         FROM stims
                                         JOIN headers on stims.rootname = headers.rootname
                                         WHERE headers.segment = 'FUVB' AND
+                                            stims.segment = 'FUVB' AND
                                             stims.stim1_x != -999 AND
                                             stims.stim1_y != -999 AND
                                             stims.stim2_x != -999 AND
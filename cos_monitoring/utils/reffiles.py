@@ -0,0 +1,188 @@
+""" In-memory catalog of the reference files in $lref.
+
+$lref holds thousands of files on network disk.  Rather than globbing it and
+opening every candidate to compare DATE keywords each time a reference file
+is needed, the headers of each kind of file (e.g. all '*hv.fits') are read
+once and kept.  The directory is only listed again when its mtime changes,
+and then only new or modified files are re-read.
+
+Table contents are kept in an LRU cache keyed on file name and mtime.
+
+"""
+
+from __future__ import print_function, absolute_import, division
+
+import os
+import datetime
+import functools
+import logging
+logger = logging.getLogger(__name__)
+
+__all__ = ['RefCatalog', 'get_catalog', 'read_table']
+
+#-- Primary header keywords recorded for every reference file
+CATALOG_KEYS = ['FILETYPE', 'DATE', 'USEAFTER', 'DETECTOR', 'SEGMENT', 'PEDIGREE']
+
+#-------------------------------------------------------------------------------
+
+def useafter_to_mjd(useafter):
+    """Convert a USEAFTER string such as 'Aug 01 2009 00:00:00' to MJD"""
+
+    for fmt in ('%b %d %Y %H:%M:%S', '%b %d %Y'):
+        try:
+            date = datetime.datetime.strptime(useafter.strip(), fmt)
+        except (AttributeError, ValueError):
+            continue
+
+        return (date - datetime.datetime(1858, 11, 17)).total_seconds() / 86400.
+
+    return None
+
+#-------------------------------------------------------------------------------
+
+class RefCatalog(object):
+    """Catalog of the reference files in one directory
+
+    Files are grouped by kind, the part of the name between the rootname
+    and the extension: 'hv' for x1u1459il_hv.fits, 'spot' for
+    *_spot.fits, etc.
+    """
+
+    def __init__(self, directory=None):
+        self.directory = directory or os.environ['lref']
+
+        self._dir_mtime = None
+        self._names = []
+        self._entries = {}
+
+        #-- directory mtime each kind was last catalogued at
+        self._kind_mtimes = {}
+
+    def _refresh(self):
+        """List the directory again if it changed since last time"""
+
+        mtime = os.stat(self.directory).st_mtime
+        if mtime == self._dir_mtime:
+            return
+
+        logger.debug("listing {}".format(self.directory))
+        self._names = os.listdir(self.directory)
+        self._dir_mtime = mtime
+
+    def entries(self, kind):
+        """Header information of all files of one kind
+
+        Parameters
+        ----------
+        kind : str
+            type of reference file, e.g. 'hv', 'spot', 'brf', 'gsag'
+
+        Returns
+        -------
+        entries : list
+            dictionaries of path, mtime, and CATALOG_KEYS values
+        """
+
+        from astropy.io import fits
+
+        self._refresh()
+        if self._kind_mtimes.get(kind) == self._dir_mtime:
+            return [entry for entry in self._entries.values() if entry['kind'] == kind]
+
+        suffix = '{}.fits'.format(kind)
+        paths = {os.path.join(self.directory, name) for name in self._names if name.endswith(suffix)}
+
+        #-- drop files that have gone
+        for path in [path for path, entry in self._entries.items() if entry['kind'] == kind]:
+            if not path in paths:
+                del self._entries[path]
+
+        for path in paths:
+            try:
+                mtime = os.stat(path).st_mtime
+            except OSError:
+                continue
+
+            if path in self._entries and self._entries[path]['mtime'] == mtime:
+                continue
+
+            header = fits.getheader(path, 0)
+            entry = {'path': path, 'kind': kind, 'mtime': mtime}
+            entry.update({key: header.get(key, None) for key in CATALOG_KEYS})
+            entry['USEAFTER_MJD'] = useafter_to_mjd(entry['USEAFTER'])
+
+            self._entries[path] = entry
+
+        self._kind_mtimes[kind] = self._dir_mtime
+
+        return [entry for entry in self._entries.values() if entry['kind'] == kind]
+
+    def latest(self, kind):
+        """Most recently created (by DATE keyword) file of one kind"""
+
+        entries = [entry for entry in self.entries(kind) if entry['DATE']]
+        if not entries:
+            raise IOError("No {} files found in {}".format(kind, self.directory))
+
+        return max(entries, key=lambda entry: (str(entry['DATE']), entry['path']))['path']
+
+    def valid_at(self, kind, mjd, **selection):
+        """File of one kind in use at mjd
+
+        The file with the latest USEAFTER at or before mjd is chosen, ties
+        going to the most recently created one.
+
+        Parameters
+        ----------
+        kind : str
+            type of reference file
+        mjd : float
+            date of the observation
+        **selection
+            header values the file must also match, e.g. SEGMENT='FUVA'
+        """
+
+        entries = [entry for entry in self.entries(kind)
+                   if entry['USEAFTER_MJD'] is not None and entry['USEAFTER_MJD'] <= mjd
+                   and all(entry.get(key.upper()) == value for key, value in selection.items())]
+        if not entries:
+            raise IOError("No {} file valid at {} in {}".format(kind, mjd, self.directory))
+
+        return max(entries, key=lambda entry: (entry['USEAFTER_MJD'], str(entry['DATE']), entry['path']))['path']
+
+#-------------------------------------------------------------------------------
+
+_catalogs = {}
+
+def get_catalog(directory=None):
+    """Shared RefCatalog of directory, $lref by default"""
+
+    directory = directory or os.environ['lref']
+
+    if not directory in _catalogs:
+        _catalogs[directory] = RefCatalog(directory)
+
+    return _catalogs[directory]
+
+#-------------------------------------------------------------------------------
+
+@functools.lru_cache(maxsize=32)
+def _read_table(filename, ext, mtime):
+    from astropy.io import fits
+
+    data = fits.getdata(filename, ext)
+    data.flags.writeable = False
+
+    return data
+
+#-------------------------------------------------------------------------------
+
+def read_table(filename, ext=1):
+    """Read a table extension, from the cache if the file has not changed
+
+    The returned table is shared between callers and is read-only.
+    """
+
+    return _read_table(filename, ext, os.stat(filename).st_mtime)
+
+#-------------------------------------------------------------------------------
@@ -1,6 +1,10 @@
+import os
+import tempfile
 import numpy as np
+from astropy.io import fits
 
 from ..utils import rebin
+from ..reffiles import RefCatalog, read_table
 
 #-------------------------------------------------------------------------------
 
@@ -12,3 +16,41 @@ def test_rebin_default():
     assert np.array_equal(rebin(data, (2, 2)), out), "Failure on simple integer array"
 
 #-------------------------------------------------------------------------------
+
+def make_reffile(directory, name, date, useafter):
+    hdu = fits.HDUList([fits.PrimaryHDU(),
+                        fits.BinTableHDU.from_columns([fits.Column('SEGMENT', '4A', array=['FUVA', 'FUVB'])])])
+    hdu[0].header['DATE'] = date
+    hdu[0].header['USEAFTER'] = useafter
+    hdu.writeto(os.path.join(directory, name))
+
+    return os.path.join(directory, name)
+
+#-------------------------------------------------------------------------------
+
+def test_reference_catalog():
+    lref = tempfile.mkdtemp()
+    old = make_reffile(lref, 'a_hv.fits', '2012-01-01', 'Aug 01 2009 00:00:00')
+    new = make_reffile(lref, 'b_hv.fits', '2015-01-01', 'Jan 01 2014 00:00:00')
+    make_reffile(lref, 'c_spot.fits', '2016-01-01', 'Jan 01 2014 00:00:00')
+
+    catalog = RefCatalog(lref)
+
+    assert catalog.latest('hv') == new
+    assert catalog.valid_at('hv', 56000) == old, "Should pick the file in use at the MJD"
+    assert catalog.valid_at('hv', 57000) == new
+
+    newest = make_reffile(lref, 'd_hv.fits', '2017-01-01', 'Jan 01 2014 00:00:00')
+    assert catalog.latest('hv') == newest, "New files should be found"
+
+    assert read_table(newest) is read_table(newest), "Tables should come from the cache"
+
+    #-- a change to the directory is seen by every kind, not only the first looked up
+    catalog.latest('spot')
+    new_spot = make_reffile(lref, 'e_spot.fits', '2018-01-01', 'Jan 01 2014 00:00:00')
+    new_hv = make_reffile(lref, 'f_hv.fits', '2018-01-01', 'Jan 01 2014 00:00:00')
+
+    assert catalog.latest('spot') == new_spot
+    assert catalog.latest('hv') == new_hv, "New hv files should be found after a spot lookup"
+
+#-------------------------------------------------------------------------------
@@ -1,9 +1,8 @@
 import os
+import datetime
 
 from astropy.io import fits
 import numpy as np
-from calcos import ccos
-from bs4 import BeautifulSoup
 from six.moves.urllib.request import urlopen
 import re
 
@@ -13,6 +12,8 @@ def scrape_cycle(asn_id):
     if asn_id == 'NONE' or asn_id is None:
         return None
 
+    from bs4 import BeautifulSoup
+
     url = 'http://archive.stsci.edu/cgi-bin/mastpreview?mission=hst&dataid={}'.format(asn_id)
     page = urlopen(url)
     soup = BeautifulSoup(page, "html.parser")
@@ -28,6 +29,13 @@ def scrape_cycle(asn_id):
     return cycle_number
 #-------------------------------------------------------------------------------
 
+def mjd_to_year(mjd):
+    """Calendar year of an MJD, as used to partition the database tables"""
+
+    return (datetime.datetime(1858, 11, 17) + datetime.timedelta(days=float(mjd))).year
+
+#-------------------------------------------------------------------------------
+
 def remove_if_there(filename):
     if os.path.exists(filename):
         os.remove(filename)
@@ -151,6 +159,8 @@ def bin_corrtag(corrtag_list, xtype='XCORR', ytype='YCORR', times=None):
 
     """
 
+    from calcos import ccos
+
     if not isinstance(corrtag_list, list):
         corrtag_list = [corrtag_list]
 
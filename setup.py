@@ -9,12 +9,14 @@ setup(
     keywords = ['astronomy'],
     classifiers = ['Programming Language :: Python',
                    'Programming Language :: Python :: 3',
+                   'Programming Language :: Python :: 3 :: Only',
                    'Development Status :: 1 - Planning',
                    'Intended Audience :: Science/Research',
                    'Topic :: Scientific/Engineering :: Astronomy',
                    'Topic :: Scientific/Engineering :: Physics',
                    'Topic :: Software Development :: Libraries :: Python Modules'],
     packages = find_packages(),
+    python_requires = '>=3.8',
     requires = ['numpy', 'scipy', 'astropy', 'matplotlib'],
     entry_points = {'console_scripts': ['clean_slate=cos_monitoring.database:clean_slate',
                                         'cm_ingest=cos_monitoring.database:ingest_all',
@@ -24,7 +26,10 @@ setup(
                                         'cm_reports=cos_monitoring.database.report:query_all',
                                         'cm_delete=cos_monitoring.database.database:cm_delete',
                                         'cm_describe=cos_monitoring.database.database:cm_describe',
-                                        'cm_tot_gain=cos_monitoring.cci.gainmap:make_all_gainmaps_entry'],
+                                        'cm_worker=cos_monitoring.database.database:cm_worker',
+                                        'cm_compact=cos_monitoring.database.database:cm_compact',
+                                        'cm_tot_gain=cos_monitoring.cci.gainmap:make_all_gainmaps_entry',
+                                        'cm_gain_cubes=cos_monitoring.cci.gaincube:update_gain_cubes_entry'],
     },
     install_requires = ['setuptools',
                         'numpy>=1.11.1',